@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Persistent queue of archiving jobs, retried with exponential backoff."""
+
+import argparse
+import random
+import time
+from ArticleDB import ArticleDB
+
+
+def backoff_secs(attempts, base, cap, rand=random):
+    """Delay before the next try after attempts failures: doubles with each
+    failure up to cap, with jitter so failed jobs spread out.
+    """
+    delay = min(cap, base * 2 ** max(0, attempts - 1))
+    return rand.uniform(delay / 2.0, delay)
+
+
+class ArchiveQueue:
+    """Tracks an archiving job per article and kind of blob in ArticleDB.
+
+    A job is pending until a worker claims it, then running until its
+    attempt is recorded: done on success, failed with a retry time after
+    a failure or timeout, and dead once max_attempts tries have failed.
+    Dead jobs stay in the table until revived, as do skipped ones, which
+    the Ranker found not worth archiving.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    DEAD = "dead"
+    SKIPPED = "skipped"
+
+    def __init__(self, db, max_attempts=5, base_secs=60, max_secs=86400,
+                 lease_secs=3600):
+        self.db = db
+        self.max_attempts = max(1, max_attempts)
+        self.base_secs = base_secs
+        self.max_secs = max_secs
+        # Running jobs not heard from in this long were abandoned
+        self.lease_secs = lease_secs
+
+    def enqueue(self, articles, kind, running=False):
+        """Queue jobs for articles, running if about to be attempted now."""
+        state = self.RUNNING if running else self.PENDING
+        self.db.enqueue_jobs([article.title for article in articles], kind,
+                             state)
+
+    def defer(self, articles, kind, secs=0):
+        """Queue jobs for articles, first due in secs, ex: to be archived
+        by a drain once more relevant articles are done.
+        """
+        self.db.enqueue_jobs([article.title for article in articles], kind,
+                             self.PENDING, time.time() + secs)
+
+    def skip(self, articles, kind):
+        """Record articles as not to be archived, unless revived."""
+        self.db.enqueue_jobs([article.title for article in articles], kind,
+                             self.SKIPPED)
+
+    def claim(self, kind, limit):
+        """Claim up to limit due jobs of kind. Return their articles."""
+        now = time.time()
+        self.db.release_jobs(now - self.lease_secs, self.PENDING)
+        jobs = self.db.claim_jobs(kind, [self.PENDING, self.FAILED], limit,
+                                  now)
+        return [article for article, _ in jobs]
+
+    def record(self, outcomes, kind):
+        """Record ArchiveResults of attempted jobs of kind.
+        Return {state: number of jobs moved to state}.
+        """
+        counts = {}
+        for outcome in outcomes:
+            title = outcome.article.title
+            if outcome.success:
+                state, next_try = self.DONE, 0
+            else:
+                job = self.db.get_job(title, kind)
+                attempts = (job[1] if job else 0) + 1
+                if attempts >= self.max_attempts:
+                    state, next_try = self.DEAD, 0
+                else:
+                    state = self.FAILED
+                    next_try = time.time() + backoff_secs(
+                        attempts, self.base_secs, self.max_secs)
+            self.db.set_job_state(title, kind, state, next_try,
+                                  outcome.error or None)
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def requeue(self, titles, kind):
+        """Archive titles again, ex: after their blob turned out broken."""
+        self.db.reset_jobs(titles, kind, self.PENDING)
+
+    def revive(self, kind, state=DEAD):
+        """Give dead, or skipped, jobs of kind a fresh set of attempts."""
+        return self.db.revive_jobs(kind, state, self.PENDING)
+
+
+def main(args):
+    db = ArticleDB(args.dbfile)
+    queue = ArchiveQueue(db)
+    if args.command == "status":
+        for (kind, state), count in sorted(db.job_counts().items()):
+            print "%-6s %-8s %d" % (kind, state, count)
+    elif args.command == "backfill":
+        print "ArchiveQueue: Queued %d %s jobs" % \
+              (db.enqueue_missing(args.kind), args.kind)
+    elif args.command == "revive":
+        state = queue.SKIPPED if args.skipped else queue.DEAD
+        print "ArchiveQueue: Revived %d %s %s jobs" % \
+              (queue.revive(args.kind, state), state, args.kind)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-db", "--dbfile", type=str, default=ArticleDB.DB_NAME,
+        help="specify database file")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("status", help="count jobs by kind and state")
+    for name, help_text in [("backfill", "queue articles missing a blob"),
+                            ("revive", "retry dead-lettered jobs")]:
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("-k", "--kind", type=str, default="pdf",
+            choices=["pdf", "html"], help="specify kind of blob")
+        if name == "revive":
+            command.add_argument("--skipped", action="store_true",
+                help="flag to archive jobs the ranker skipped instead")
+    args = parser.parse_args()
+
+    main(args)
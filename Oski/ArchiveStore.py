@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Content-addressed, optionally compressed store of archived pages."""
+
+import argparse
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from ArticleDB import ArticleDB
+
+
+def file_digest(file_name, block_size=2**16):
+    """Return (sha256 hex digest, size in bytes) of a file."""
+    sha = hashlib.sha256()
+    size = 0
+    with open(file_name, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:  break
+            sha.update(block)
+            size += len(block)
+    return sha.hexdigest(), size
+
+
+class ArchiveStore:
+    """Stores archived pages by the SHA-256 of their content.
+
+    Blobs live in objects/ab/cd/<digest><ext> under root, so identical pages
+    fetched under different titles are stored once and no directory grows
+    past a few hundred entries. Writes land in tmp/ first and are renamed
+    into place, so a blob is either complete or absent. Older pdfs can be
+    moved to a gzip-compressed tier, html snapshots are stored compressed.
+    """
+    EXTS = {"pdf": ".pdf", "html": ".html.gz"}
+    EXT = EXTS["pdf"]
+    GZ_EXT = ".gz"
+
+    def __init__(self, root):
+        self.root = root or os.curdir
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        self.objects_dir = os.path.join(self.root, "objects")
+        self.broken_dir = os.path.join(self.root, "broken")
+        for directory in [self.tmp_dir, self.objects_dir]:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Created meanwhile by another worker
+                    if not os.path.isdir(directory):  raise
+
+    def temp_path(self, kind="pdf"):
+        """Reserve a temporary file to write a new blob into."""
+        handle, path = tempfile.mkstemp(suffix=self.EXTS[kind],
+                                        dir=self.tmp_dir)
+        os.close(handle)
+        return path
+
+    def blob_path(self, digest, kind="pdf", compressed=False):
+        path = os.path.join(self.objects_dir, digest[:2], digest[2:4],
+                            digest + self.EXTS[kind])
+        return path + self.GZ_EXT if compressed else path
+
+    def find(self, digest, kind="pdf"):
+        """Return the stored path of a blob, None if missing."""
+        for compressed in [False, True]:
+            path = self.blob_path(digest, kind, compressed)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def put(self, src, kind="pdf"):
+        """Move a finished file into the store. Return (digest, size)."""
+        digest, size = file_digest(src)
+        if self.find(digest, kind):
+            os.remove(src)
+            return digest, size
+        dest = self.blob_path(digest, kind)
+        if not os.path.isdir(os.path.dirname(dest)):
+            try:
+                os.makedirs(os.path.dirname(dest))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(dest)):  raise
+        os.rename(src, dest)
+        return digest, size
+
+    def open(self, digest, kind="pdf"):
+        """Open a stored blob for reading, decompressing if needed."""
+        path = self.find(digest, kind)
+        if path is None:
+            raise IOError("ArchiveStore: No blob %s" % digest)
+        if path.endswith(self.GZ_EXT):
+            return gzip.open(path, 'rb')
+        return open(path, 'rb')
+
+    def quarantine(self, digest, kind="pdf"):
+        """Move a broken blob out of the store into broken/, for a look
+        before it is deleted. Return its new path, None if missing.
+        """
+        path = self.find(digest, kind)
+        if path is None:  return None
+        if not os.path.isdir(self.broken_dir):
+            os.makedirs(self.broken_dir)
+        dest = os.path.join(self.broken_dir, os.path.basename(path))
+        os.rename(path, dest)
+        return dest
+
+    def compress(self, digest):
+        """Move a blob to the compressed tier. Return True if compressed."""
+        src = self.blob_path(digest)
+        if not os.path.exists(src):  return False
+        tmp = self.temp_path()
+        with open(src, 'rb') as f_in:
+            with gzip.open(tmp, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        os.rename(tmp, self.blob_path(digest, "pdf", compressed=True))
+        os.remove(src)
+        return True
+
+    def compress_older(self, db, days):
+        """Compress blobs first stored more than days ago."""
+        count = 0
+        for digest in db.blobs_stored_before(time.time() - days * 86400):
+            if self.compress(digest):
+                db.set_compressed(digest)
+                count += 1
+        return count
+
+    def import_legacy(self, db):
+        """Move flat <title>.pdf files from older archives into the store."""
+        count = 0
+        for article in db.iter_articles():
+            legacy = os.path.join(self.root, article.title + self.EXT)
+            if not os.path.isfile(legacy):  continue
+            tmp = self.temp_path()
+            os.rename(legacy, tmp)
+            digest, size = self.put(tmp)
+            db.set_blob(article.title, digest, size)
+            count += 1
+        return count
+
+
+def main(args):
+    store = ArchiveStore(args.path)
+    db = ArticleDB(args.dbfile)
+    if args.command == "import":
+        print "ArchiveStore: Imported %d pdfs" % store.import_legacy(db)
+    elif args.command == "compress":
+        print "ArchiveStore: Compressed %d pdfs" % \
+              store.compress_older(db, args.days)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--path", type=str, required=True,
+        help="specify archive directory")
+    parser.add_argument("-db", "--dbfile", type=str, default=ArticleDB.DB_NAME,
+        help="specify database file")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("import", help="move <title>.pdf files into store")
+    compress = commands.add_parser("compress", help="compress older pdfs")
+    compress.add_argument("-d", "--days", type=float, default=90,
+        help="specify age in days of pdfs to compress")
+    args = parser.parse_args()
+
+    main(args)
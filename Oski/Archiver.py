@@ -1,56 +1,332 @@
 #!/usr/bin/env python
-"""Saves web articles as pdfs."""
+"""Saves web articles as pdfs or compressed html snapshots."""
 
 import argparse
-import pdfkit
-import signal
-import os
 import errno
-from functools import wraps
+import gzip
+import multiprocessing
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from Queue import Queue
+from ArticleDB import Article
+from ArchiveStore import ArchiveStore
+from Metrics import METRICS
+from Readability import extract
 
 
-class TimeoutError(Exception):
-    pass
+class ArchiveResult:
+    """Outcome of a single archiving job."""
+    SAVED = "saved"
+    TIMEOUT = "timeout"
+    FAILED = "failed"
 
-def timeout(secs=60, default=False):
-    def decorator(func):
-        def handler(signum, frame):
-            msg = os.strerror(errno.ETIME)
-            raise TimeoutError(msg)
+    def __init__(self, article, status, error="", text="", digest=None,
+                 size=0):
+        self.article = article
+        self.status = status
+        self.error = error
+        # Text extracted from the saved page, if requested
+        self.text = text
+        # Blob of the saved page in the ArchiveStore
+        self.digest = digest
+        self.size = size
+        # Wall time of the job, set by the ArchivePool
+        self.secs = 0.0
 
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, handler)
-            signal.alarm(secs)
-            try:
-                result = func(*args, **kwargs)
-            except TimeoutError:
-                result = default
-            finally:
-                signal.alarm(0) # disable alarm
-            return result
+    @property
+    def success(self):
+        return self.status == self.SAVED
 
-        return wrapper
+    def __repr__(self):
+        return "%s: %s" % (self.status, self.article)
 
-    return decorator
 
+def extract_pdf_text(pdf_file):
+    """Extract text from a pdf with pdftotext (poppler-utils).
+    Return an empty string if the text cannot be extracted.
+    """
+    try:
+        proc = subprocess.Popen(["pdftotext", "-q", pdf_file, "-"],
+                                stdout=subprocess.PIPE)
+        text = proc.communicate()[0]
+    except OSError:  return ""
+    if proc.returncode != 0:  return ""
+    return text.decode("utf-8", "ignore")
 
-@timeout()
-def save_article(url, title, path=""):
-    """Save url as a pdf."""
+def _render_pdf(url, output_path):
+    """Render url to a pdf with wkhtmltopdf. Return True if saved."""
+    import pdfkit
     options = {'quiet': ''}
     try:
         # If wkhtmltopdf.exe not on path, add configuration:
         # config = pdfkit.configuration(wkhtmltopdf="path/to/wkhtmltopdf")
         # pdfkit.from_url(..., configuration=config)
-        output_path = path + os.sep + title + '.pdf'
         pdfkit.from_url(url, output_path, options=options)
         return True
     except IOError:  return False
+
+def page_text(response):
+    """Decode a fetched page. Without a charset in the Content-Type,
+    requests assumes ISO-8859-1 for html, so use the charset its meta tags
+    declare instead, or else one guessed from its bytes.
+    """
+    import requests
+    if "charset" in response.headers.get("Content-Type", "").lower():
+        return response.text
+    for encoding in requests.utils.get_encodings_from_content(
+            response.content):
+        try:
+            return response.content.decode(encoding, "replace")
+        except LookupError:  continue
+    # Guessing runs chardet over the whole page, so only as a last resort
+    response.encoding = response.apparent_encoding
+    return response.text
+
+
+class ArchiveTimeout(Exception):
+    pass
+
+
+class PdfBackend:
+    """Renders pages to pdf with wkhtmltopdf.
+
+    A render costs a browser process, so every job runs isolated in its own
+    child process where a hung page load can be killed.
+    """
+    KIND = "pdf"
+    ISOLATED = True
+
+    def save(self, url, output_path, secs, extract_text):
+        """Save url to output_path. Return the page text, if requested."""
+        if not _render_pdf(url, output_path):
+            raise IOError("wkhtmltopdf IOError")
+        return extract_pdf_text(output_path) if extract_text else ""
+
+
+class SnapshotBackend:
+    """Fetches pages over a pooled HTTP session and stores the readable
+    article as gzip-compressed html.
+
+    Jobs run in threads sharing the session's keep-alive connections.
+    """
+    KIND = "html"
+    ISOLATED = False
+    USER_AGENT = "Mozilla/5.0 (compatible; Oski)"
+
+    def __init__(self, pool_size=10):
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = self.USER_AGENT
+
+    def save(self, url, output_path, secs, extract_text):
+        """Save url to output_path. Return the article text, if requested."""
+        import requests
+        try:
+            response = self.session.get(url, timeout=secs)
+        except requests.Timeout as e:
+            raise ArchiveTimeout(str(e))
+        response.raise_for_status()
+        article = extract(page_text(response))
+        # Fixed gzip header, so the same article always has the same digest
+        with open(output_path, 'wb') as f:
+            with gzip.GzipFile("", 'wb', fileobj=f, mtime=0) as f_out:
+                f_out.write(article.document(url).encode("utf-8"))
+        return article.text if extract_text else ""
+
+
+BACKENDS = {"pdf": PdfBackend, "snapshot": SnapshotBackend}
+
+def _archive_job(backend, url, store, tmp_path, extract_text, secs):
+    """Save url with backend into store. Return ArchiveResult fields."""
+    try:
+        text = backend.save(url, tmp_path, secs, extract_text)
+        digest, size = store.put(tmp_path, backend.KIND)
+        return {"status": ArchiveResult.SAVED, "text": text,
+                "digest": digest, "size": size}
+    except ArchiveTimeout as e:
+        return {"status": ArchiveResult.TIMEOUT, "error": str(e)}
+    except Exception as e:
+        return {"status": ArchiveResult.FAILED, "error": repr(e)}
+
+def _archive_worker(conn, backend, url, root, tmp_path, extract_text, secs):
+    """Child process entry point, reports outcome through conn.
+    Leads its own process group, so the renderer it starts can be killed
+    along with it.
+    """
+    os.setsid()
+    try:
+        conn.send(_archive_job(backend, url, ArchiveStore(root), tmp_path,
+                               extract_text, secs))
+    finally:
+        conn.close()
+
+
+class ArchivePool:
+    """Archives articles in parallel with a bounded set of workers.
+
+    Jobs of an isolated backend each run in their own child process with
+    their own deadline, so a hung wkhtmltopdf page load is terminated
+    instead of stalling the run. Killing a job kills its whole process
+    group, wkhtmltopdf included. Unlike SIGALRM, this timeout is safe to use
+    from any thread. Other backends run in a pool of threads and rely on
+    their own socket timeouts. Saved pages go to an ArchiveStore rooted at
+    path.
+    """
+    POLL_SECS = 0.1
+
+    def __init__(self, path="", workers=4, secs=60, extract_text=False,
+                 backend=None):
+        self.path = path
+        self.store = ArchiveStore(path)
+        self.workers = max(1, workers)
+        self.secs = secs
+        self.extract_text = extract_text
+        self.backend = backend or PdfBackend()
+
+    @property
+    def kind(self):
+        return self.backend.KIND
+
+    def _start(self, article):
+        recv_conn, send_conn = multiprocessing.Pipe(False)
+        tmp_path = self.store.temp_path(self.kind)
+        proc = multiprocessing.Process(target=_archive_worker,
+                                       args=(send_conn, self.backend,
+                                             article.url, self.store.root,
+                                             tmp_path, self.extract_text,
+                                             self.secs))
+        proc.daemon = True
+        proc.start()
+        send_conn.close()
+        return proc, recv_conn, time.time() + self.secs, tmp_path
+
+    def _cleanup(self, tmp_path):
+        """Drop what a failed or killed job left in the store's tmp dir."""
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    def _finish(self, proc, recv_conn, article):
+        """Collect outcome of an exited job."""
+        try:
+            if recv_conn.poll():
+                return ArchiveResult(article, **recv_conn.recv())
+        except EOFError:  pass
+        finally:
+            recv_conn.close()
+            proc.join()
+        msg = "worker exited with code %s" % proc.exitcode
+        return ArchiveResult(article, ArchiveResult.FAILED, msg)
+
+    def _kill(self, proc, recv_conn, article):
+        """Kill a job that exceeded its deadline, and its renderer."""
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            # Not yet leading its own group
+            proc.terminate()
+        proc.join()
+        recv_conn.close()
+        msg = os.strerror(errno.ETIME)
+        return ArchiveResult(article, ArchiveResult.TIMEOUT, msg)
+
+    def save_articles(self, articles):
+        """Archive articles, return an ArchiveResult per article, in order."""
+        if self.backend.ISOLATED:
+            outcomes = self._save_in_processes(articles)
+        else:
+            outcomes = self._save_in_threads(articles)
+        for outcome in outcomes:
+            METRICS.inc("oski_archive_total", kind=self.kind,
+                        status=outcome.status)
+            METRICS.observe("oski_archive_seconds", outcome.secs,
+                            kind=self.kind)
+        return outcomes
+
+    def _save_in_processes(self, articles):
+        outcomes = [None] * len(articles)
+        pending = deque(enumerate(articles))
+        running = {}
+
+        while pending or running:
+            # Keep the pool full
+            while pending and len(running) < self.workers:
+                idx, article = pending.popleft()
+                running[idx] = self._start(article)
+
+            time.sleep(self.POLL_SECS)
+            now = time.time()
+            for idx in list(running.keys()):
+                proc, recv_conn, deadline, tmp_path = running[idx]
+                # Read outcomes as soon as they arrive, a large extracted
+                # text would otherwise block the worker on a full pipe
+                if recv_conn.poll() or not proc.is_alive():
+                    outcomes[idx] = self._finish(proc, recv_conn,
+                                                 articles[idx])
+                elif now > deadline:
+                    outcomes[idx] = self._kill(proc, recv_conn,
+                                               articles[idx])
+                else:
+                    continue
+                outcomes[idx].secs = now - (deadline - self.secs)
+                self._cleanup(tmp_path)
+                del running[idx]
+
+        return outcomes
+
+    def _save_in_threads(self, articles):
+        outcomes = [None] * len(articles)
+        jobs = Queue()
+        for job in enumerate(articles):
+            jobs.put(job)
+
+        def work():
+            while True:
+                idx, article = jobs.get()
+                if article is None:  return
+                start = time.time()
+                tmp_path = self.store.temp_path(self.kind)
+                outcomes[idx] = ArchiveResult(article, **_archive_job(
+                    self.backend, article.url, self.store, tmp_path,
+                    self.extract_text, self.secs))
+                outcomes[idx].secs = time.time() - start
+                self._cleanup(tmp_path)
+
+        threads = []
+        for _ in range(min(self.workers, len(articles))):
+            jobs.put((None, None))
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+
+def save_article(url, title, path="", secs=60):
+    """Save url as a pdf. Return False if the save failed or timed out."""
+    article = Article(title, url, "")
+    outcome = ArchivePool(path, workers=1, secs=secs).save_articles([article])
+    return outcome[0].success
     
 
 def main(args):
-    return save_article(args.url, args.title, args.path)
+    article = Article(args.title, args.url, "")
+    pool = ArchivePool(args.path, backend=BACKENDS[args.backend]())
+    outcome = pool.save_articles([article])[0]
+    if outcome.success:
+        print "Archiver: Saved %s" % outcome.digest
+    else:
+        print "Archiver: Save %s, %s" % (outcome.status, outcome.error)
+    return outcome.success
 
 
 if __name__ == "__main__":
@@ -61,6 +337,8 @@ if __name__ == "__main__":
         help="specify article title")
     parser.add_argument("--path", type=str,
         help="specify output directory path")
+    parser.add_argument("--backend", type=str, default="pdf",
+        choices=sorted(BACKENDS.keys()), help="specify archiver backend")
     args = parser.parse_args()
 
     if args.path and not os.path.isdir(args.path):
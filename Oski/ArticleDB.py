@@ -1,20 +1,60 @@
 #!/usr/bin/env python
 """Creates and adds article entries to database."""
 
+import argparse
 import os
 import sqlite3
+import time
+from ConnectionPool import ConnectionPool
+from Deduplicator import canonicalize_url, simhash, simhash_bands
+from Metrics import METRICS
 
 
-class Article:
-    """Stores article data."""
-    def __init__(self, title, url, snippet):
+# Rows pulled from sqlite per round trip when streaming results
+FETCH_SIZE = 256
+# Articles columns selected into Article records, in constructor order
+ARTICLE_COLUMNS = "title, url, snippet, published, source, query_id, id"
+
+
+class Article(object):
+    """Stores article data.
+
+    Search results and database rows both map straight onto this record.
+    A new-style class, so its fields live in slots instead of a
+    per-instance dict: all eight take less memory than the three fields
+    of a dict-backed record.
+    """
+    __slots__ = ("title", "url", "snippet", "published", "source",
+                 "query_id", "id", "score")
+
+    def __init__(self, title, url, snippet, published=None, source=None,
+                 query_id=None, id=None, score=None):
         self.title = title
         self.url = url
         self.snippet = snippet
+        # ISO date the page was published, if known
+        self.published = published
+        # Host of the site that published the article
+        self.source = source
+        # Search that found the article
+        self.query_id = query_id
+        # Row id, once stored
+        self.id = id
+        # Relevance from 0 to 1 given by the Ranker in this run, if any
+        self.score = score
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        """sqlite3 row_factory for rows selecting ARTICLE_COLUMNS."""
+        return cls(*row)
 
     def _tuple(self):
         return (self.title, self.url, self.snippet)
 
+    def __reduce__(self):
+        return (Article, tuple(getattr(self, name)
+                               for name in self.__slots__))
+
     def __str__(self):
         return self.title
 
@@ -23,92 +63,785 @@ class Article:
 
 
 class ArticleDB:
-    """Stores articles in sqlite database."""
+    """Stores articles in sqlite database.
+
+    Safe to share between threads: each thread reads over its own pooled
+    connection, and writes run one at a time in writer sessions. Close it,
+    or use it as a context manager, to close every connection.
+    """
     DB_NAME = "Oski.db"
     TABLE_NAME = "Articles"
+    # SQLite limits the number of bound parameters in one statement
+    MAX_VARIABLES = 500
+    # Schema upgrades, MIGRATIONS[i] moves user_version from i to i + 1.
+    # Entries are SQL scripts or methods taking the ArticleDB.
+    MIGRATIONS = [
+        # Unique title index, so lookups no longer scan the table
+        """DELETE FROM Articles WHERE rowid NOT IN
+               (SELECT MIN(rowid) FROM Articles GROUP BY title);
+           CREATE UNIQUE INDEX IF NOT EXISTS idx_articles_title
+               ON Articles (title);""",
+        # Canonical url and snippet fingerprint for deduplication
+        lambda db: db.add_dedup_columns(),
+        # Stable integer id, so the full-text index can point at rows
+        """CREATE TABLE Articles_v3 (
+               id INTEGER PRIMARY KEY,
+               title TEXT, url TEXT, snippet TEXT,
+               canon_url TEXT, simhash INTEGER,
+               band0 INTEGER, band1 INTEGER, band2 INTEGER, band3 INTEGER,
+               body TEXT);
+           INSERT INTO Articles_v3
+               SELECT rowid, title, url, snippet, canon_url, simhash,
+                      band0, band1, band2, band3, NULL FROM Articles;
+           DROP TABLE Articles;
+           ALTER TABLE Articles_v3 RENAME TO Articles;
+           CREATE UNIQUE INDEX idx_articles_title ON Articles (title);
+           CREATE INDEX idx_articles_canon_url ON Articles (canon_url);
+           CREATE INDEX idx_articles_band0 ON Articles (band0);
+           CREATE INDEX idx_articles_band1 ON Articles (band1);
+           CREATE INDEX idx_articles_band2 ON Articles (band2);
+           CREATE INDEX idx_articles_band3 ON Articles (band3);""",
+        # Full-text index over title, snippet and archived text
+        """CREATE VIRTUAL TABLE ArticlesFTS USING fts5(
+               title, snippet, body,
+               content='Articles', content_rowid='id');
+           CREATE TRIGGER articles_fts_insert AFTER INSERT ON Articles BEGIN
+               INSERT INTO ArticlesFTS (rowid, title, snippet, body)
+               VALUES (new.id, new.title, new.snippet, new.body);
+           END;
+           CREATE TRIGGER articles_fts_delete AFTER DELETE ON Articles BEGIN
+               INSERT INTO ArticlesFTS (ArticlesFTS, rowid, title, snippet,
+                                        body)
+               VALUES ('delete', old.id, old.title, old.snippet, old.body);
+           END;
+           CREATE TRIGGER articles_fts_update
+           AFTER UPDATE OF title, snippet, body ON Articles BEGIN
+               INSERT INTO ArticlesFTS (ArticlesFTS, rowid, title, snippet,
+                                        body)
+               VALUES ('delete', old.id, old.title, old.snippet, old.body);
+               INSERT INTO ArticlesFTS (rowid, title, snippet, body)
+               VALUES (new.id, new.title, new.snippet, new.body);
+           END;
+           INSERT INTO ArticlesFTS (ArticlesFTS) VALUES ('rebuild');""",
+        # Per-query high-water marks for incremental searches
+        """CREATE TABLE CrawlState (
+               query TEXT PRIMARY KEY,
+               last_run REAL,
+               newest_url TEXT,
+               newest_title TEXT,
+               known_page INTEGER);""",
+        # Maps each archived article to its blob in the ArchiveStore
+        """CREATE TABLE Manifest (
+               article_id INTEGER PRIMARY KEY REFERENCES Articles (id)
+                   ON DELETE CASCADE,
+               digest TEXT,
+               size INTEGER,
+               compressed INTEGER DEFAULT 0,
+               stored REAL);
+           CREATE INDEX idx_manifest_digest ON Manifest (digest);
+           CREATE INDEX idx_manifest_stored ON Manifest (stored);""",
+        # An article can have a blob of each kind, e.g. snapshot and pdf
+        """CREATE TABLE Manifest_v7 (
+               article_id INTEGER REFERENCES Articles (id)
+                   ON DELETE CASCADE,
+               kind TEXT NOT NULL DEFAULT 'pdf',
+               digest TEXT,
+               size INTEGER,
+               compressed INTEGER DEFAULT 0,
+               stored REAL,
+               PRIMARY KEY (article_id, kind));
+           INSERT INTO Manifest_v7
+               SELECT article_id, 'pdf', digest, size, compressed, stored
+               FROM Manifest;
+           DROP TABLE Manifest;
+           ALTER TABLE Manifest_v7 RENAME TO Manifest;
+           CREATE INDEX idx_manifest_digest ON Manifest (digest);
+           CREATE INDEX idx_manifest_stored ON Manifest (stored);""",
+        # Persistent queue of archiving jobs, see ArchiveQueue
+        """CREATE TABLE ArchiveJobs (
+               article_id INTEGER REFERENCES Articles (id)
+                   ON DELETE CASCADE,
+               kind TEXT NOT NULL,
+               state TEXT NOT NULL DEFAULT 'pending',
+               attempts INTEGER DEFAULT 0,
+               next_try REAL DEFAULT 0,
+               updated REAL,
+               error TEXT,
+               PRIMARY KEY (article_id, kind));
+           CREATE INDEX idx_archive_jobs_due
+               ON ArchiveJobs (kind, state, next_try);""",
+        # Publication date, source site and query of each article
+        """ALTER TABLE Articles ADD COLUMN published TEXT;
+           ALTER TABLE Articles ADD COLUMN source TEXT;
+           ALTER TABLE Articles ADD COLUMN query_id TEXT;""",
+        # Last verification of each blob file, see Verifier
+        """CREATE TABLE BlobChecks (
+               digest TEXT,
+               kind TEXT NOT NULL DEFAULT 'pdf',
+               path TEXT,
+               mtime REAL,
+               size INTEGER,
+               sha256 TEXT,
+               status TEXT,
+               error TEXT,
+               checked REAL,
+               PRIMARY KEY (digest, kind));""",
+        # New articles waiting for subscribers' digests, see Outbox. Ids
+        # are never reused, digest cursors point past them once pruned
+        """CREATE TABLE Outbox (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               article_id INTEGER REFERENCES Articles (id)
+                   ON DELETE CASCADE,
+               queued REAL);
+           CREATE TABLE DigestCursors (
+               digest TEXT PRIMARY KEY,
+               last_id INTEGER DEFAULT 0,
+               sent REAL DEFAULT 0);""",
+        # Relevance scores, and sources indexed for their reputation
+        """ALTER TABLE Articles ADD COLUMN score REAL;
+           CREATE INDEX idx_articles_source ON Articles (source);""",
+    ]
+    FTS_TABLE_NAME = "ArticlesFTS"
+    # bm25 weights of title, snippet and body matches
+    FTS_WEIGHTS = (10.0, 5.0, 1.0)
 
-    def __init__(self):
-        create_table = not os.path.exists(self.DB_NAME)
+    def __init__(self, db_name=DB_NAME,
+                 busy_timeout=ConnectionPool.BUSY_TIMEOUT):
+        create_table = not os.path.exists(db_name)
+        self.db_name = db_name
+        db_dir = os.path.dirname(db_name)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
 
-        self.connection = sqlite3.connect(self.DB_NAME)
-        self.cursor = self.connection.cursor()
+        self.pool = ConnectionPool(db_name, busy_timeout)
         if create_table:
-            create_cmd = """CREATE TABLE %s (
+            create_cmd = """CREATE TABLE IF NOT EXISTS %s (
                             title TEXT, 
                             url TEXT, 
                             snippet TEXT);""" % self.TABLE_NAME
-            self.cursor.execute(create_cmd)
-            self.connection.commit()
+            with self.pool.writer() as cursor:
+                cursor.execute(create_cmd)
+        self.migrate()
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def __del__(self):
-        self.connection.close()
+        if "pool" in self.__dict__:
+            self.close()
+
+    @property
+    def connection(self):
+        """This thread's connection."""
+        return self.pool.connection()
+
+    @property
+    def cursor(self):
+        """This thread's cursor."""
+        return self.pool.cursor()
+
+    @property
+    def article_cursor(self):
+        """This thread's cursor returning Article records for queries
+        selecting ARTICLE_COLUMNS.
+        """
+        return self.pool.cursor(Article.from_row)
+
+    def articles_cursor(self):
+        """New cursor mapping rows straight to Article records."""
+        cursor = self.connection.cursor()
+        cursor.row_factory = Article.from_row
+        return cursor
+
+    def migrate(self):
+        """Upgrade an existing database in place to the latest schema.
+        Each migration commits along with its user_version bump, or not
+        at all.
+        """
+        connection = self.connection
+        # Keep sqlite3 from committing before each DDL statement
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        try:
+            while True:
+                with self.pool.writer() as cursor:
+                    version = cursor.execute(
+                        "PRAGMA user_version").fetchone()[0]
+                    if version >= len(self.MIGRATIONS):  break
+                    migration = self.MIGRATIONS[version]
+                    if callable(migration):
+                        migration(self)
+                    else:
+                        for statement in sql_statements(migration):
+                            cursor.execute(statement)
+                    cursor.execute("PRAGMA user_version = %d" % (version + 1))
+        finally:
+            connection.isolation_level = isolation_level
+
+    def add_dedup_columns(self):
+        """Add and backfill canonical url and SimHash band columns."""
+        for column in ["canon_url TEXT", "simhash INTEGER", "band0 INTEGER",
+                       "band1 INTEGER", "band2 INTEGER", "band3 INTEGER"]:
+            self.cursor.execute("ALTER TABLE %s ADD COLUMN %s" %
+                                (self.TABLE_NAME, column))
+        select_cmd = """SELECT rowid, url, snippet FROM %s""" % self.TABLE_NAME
+        rows = [(dedup_fields(url, snippet), rowid) for rowid, url, snippet
+                in self.cursor.execute(select_cmd).fetchall()]
+        update_cmd = """UPDATE %s SET canon_url = ?, simhash = ?, band0 = ?,
+                        band1 = ?, band2 = ?, band3 = ?
+                        WHERE rowid = ?""" % self.TABLE_NAME
+        self.cursor.executemany(update_cmd,
+                                [fields + (rowid, ) for fields, rowid in rows])
+        self.cursor.execute("""CREATE INDEX idx_articles_canon_url
+                               ON %s (canon_url)""" % self.TABLE_NAME)
+        for band in range(4):
+            self.cursor.execute("""CREATE INDEX idx_articles_band%d
+                                   ON %s (band%d)""" %
+                                (band, self.TABLE_NAME, band))
 
     def add_article(self, article):
         """Add article to database."""
-        if self.in_database(article.title):  return False
-
-        insert_cmd = """
-            INSERT INTO %s (title, url, snippet) 
-            VALUES (?, ?, ?)""" % self.TABLE_NAME
-        self.cursor.execute(insert_cmd, article._tuple())
-        self.connection.commit()
-        return True
+        return len(self.add_articles([article])) > 0
 
+    @METRICS.timed("oski_db_seconds", op="add_articles")
     def add_articles(self, articles):
-        """Add multiple articles to database. Return True if any added."""
-        added = []
+        """Add multiple articles to database in a single transaction.
+        Return the list of newly added articles.
+        """
+        # Keep the first occurrence of each title within the batch
+        batch, seen = [], set()
         for article in articles:
-            success = self.add_article(article) 
-            if success:
-                added.append(article)
+            if article.title not in seen:
+                seen.add(article.title)
+                batch.append(article)
+        if not batch:  return []
+
+        # Hold the write lock so the known titles cannot change under us
+        with self.pool.writer() as cursor:
+            known = self.known_titles([article.title for article in batch])
+            added = [article for article in batch
+                     if article.title not in known]
+            insert_cmd = """
+                INSERT INTO %s (title, url, snippet, canon_url, simhash,
+                                band0, band1, band2, band3,
+                                published, source, query_id, score)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (title) DO NOTHING""" % self.TABLE_NAME
+            rows = [article._tuple() +
+                    dedup_fields(article.url, article.snippet) +
+                    (article.published, article.source, article.query_id,
+                     article.score)
+                    for article in added]
+            cursor.executemany(insert_cmd, rows)
         return added
 
+    @METRICS.timed("oski_db_seconds", op="known_titles")
+    def known_titles(self, titles):
+        """Return the subset of input titles already in the database."""
+        known = set()
+        step = self.MAX_VARIABLES
+        for idx in range(0, len(titles), step):
+            chunk = titles[idx:idx + step]
+            select_cmd = """SELECT title FROM %s WHERE title IN (%s)""" % \
+                         (self.TABLE_NAME, ", ".join("?" * len(chunk)))
+            self.cursor.execute(select_cmd, chunk)
+            known.update(row[0] for row in self.cursor.fetchall())
+        return known
+
+    @METRICS.timed("oski_db_seconds", op="has_canon_url")
+    def has_canon_url(self, canon_url):
+        """Check if an article with this canonical url is stored."""
+        search_cmd = """SELECT 1 FROM %s
+                        WHERE canon_url = ? LIMIT 1""" % self.TABLE_NAME
+        self.cursor.execute(search_cmd, (canon_url, ))
+        return self.cursor.fetchone() is not None
+
+    @METRICS.timed("oski_db_seconds", op="similar_simhashes")
+    def similar_simhashes(self, bands):
+        """Return stored snippet fingerprints sharing a band with bands."""
+        search_cmd = """SELECT simhash FROM %s WHERE band0 = ? OR band1 = ?
+                        OR band2 = ? OR band3 = ?""" % self.TABLE_NAME
+        self.cursor.execute(search_cmd, bands)
+        return [row[0] for row in self.cursor.fetchall()]
+
     def delete_article(self, title):
         """Delete article with matching title."""
-        if self.in_database(title):
-            delete_cmd = """DELETE FROM %s WHERE title = ?""" % self.TABLE_NAME
-            self.cursor.execute(delete_cmd, (title, ))
-            self.connection.commit()
-            return True
-        return False
+        delete_cmd = """DELETE FROM %s WHERE title = ?""" % self.TABLE_NAME
+        with self.pool.writer() as cursor:
+            cursor.execute(delete_cmd, (title, ))
+            return cursor.rowcount > 0
 
     def get_article(self, title):
         """Return article matching input title."""
-        select_cmd = """SELECT * FROM %s WHERE title = ?""" % self.TABLE_NAME
-        self.cursor.execute(select_cmd, (title, ))
-        results = self.cursor.fetchall()
-        if len(results) > 0:
-            return Article(*results[0])
-        return None
+        select_cmd = """SELECT %s FROM %s
+                        WHERE title = ? LIMIT 1""" % (ARTICLE_COLUMNS,
+                                                      self.TABLE_NAME)
+        self.article_cursor.execute(select_cmd, (title, ))
+        return self.article_cursor.fetchone()
 
     def get_articles(self):
         """Return all articles in database."""
-        select_cmd = """SELECT * FROM %s""" % self.TABLE_NAME
-        self.cursor.execute(select_cmd)
-        results = self.cursor.fetchall()
-        articles = [Article(*result) for result in results]
-        return articles
+        return list(self.iter_articles())
+
+    def iter_articles(self, batch_size=FETCH_SIZE):
+        """Yield all articles in database, fetching rows in batches."""
+        select_cmd = """SELECT %s FROM %s
+                        ORDER BY rowid""" % (ARTICLE_COLUMNS, self.TABLE_NAME)
+        # Own cursor, so other queries can run while iterating
+        cursor = self.articles_cursor()
+        try:
+            cursor.execute(select_cmd)
+            while True:
+                articles = cursor.fetchmany(batch_size)
+                if not articles:  break
+                for article in articles:
+                    yield article
+        finally:
+            cursor.close()
+
+    @METRICS.timed("oski_db_seconds", op="get_page")
+    def get_page(self, after=0, limit=FETCH_SIZE):
+        """Return up to limit articles inserted after rowid after, with the
+        rowid to pass as after for the next page (None when exhausted).
+        """
+        select_cmd = """SELECT %s FROM %s
+                        WHERE rowid > ? ORDER BY rowid
+                        LIMIT ?""" % (ARTICLE_COLUMNS, self.TABLE_NAME)
+        self.article_cursor.execute(select_cmd, (after, limit))
+        articles = self.article_cursor.fetchall()
+        last = articles[-1].id if len(articles) == limit else None
+        return articles, last
+
+    def iter_pages(self, limit=FETCH_SIZE):
+        """Yield keyset-paginated lists of articles, oldest first."""
+        after = 0
+        while after is not None:
+            articles, after = self.get_page(after, limit)
+            if articles:
+                yield articles
+
+    @METRICS.timed("oski_db_seconds", op="set_text")
+    def set_text(self, title, text):
+        """Store extracted article text, so full-text search covers it."""
+        update_cmd = """UPDATE %s SET body = ? WHERE title = ?""" % \
+                     self.TABLE_NAME
+        with self.pool.writer() as cursor:
+            cursor.execute(update_cmd, (text, title))
+            return cursor.rowcount > 0
+
+    @METRICS.timed("oski_db_seconds", op="set_texts")
+    def set_texts(self, texts):
+        """Store extracted text of many articles, from (title, text) pairs."""
+        update_cmd = """UPDATE %s SET body = ? WHERE title = ?""" % \
+                     self.TABLE_NAME
+        with self.pool.writer() as cursor:
+            cursor.executemany(update_cmd,
+                               [(text, title) for title, text in texts])
+
+    @METRICS.timed("oski_db_seconds", op="search")
+    def search(self, text, limit=20, raw=False):
+        """Return (article, score) pairs matching text, best first.
+
+        Every word of text must match. Pass raw=True to use FTS5 query
+        syntax instead, ex: 'title:kicker AND (oregon OR stanford)'.
+        """
+        query = text if raw else fts_query(text)
+        if not query:  return []
+        search_cmd = """SELECT %s, bm25(%s, %s) AS score
+                        FROM %s JOIN %s AS a ON a.id = %s.rowid
+                        WHERE %s MATCH ? ORDER BY score LIMIT ?""" % \
+                     (article_columns("a"), self.FTS_TABLE_NAME,
+                      ", ".join(str(w) for w in self.FTS_WEIGHTS),
+                      self.FTS_TABLE_NAME, self.TABLE_NAME,
+                      self.FTS_TABLE_NAME, self.FTS_TABLE_NAME)
+        self.cursor.execute(search_cmd, (query, limit))
+        return [(Article(*result[:-1]), -result[-1])
+                for result in self.cursor.fetchall()]
+
+    @METRICS.timed("oski_db_seconds", op="all_known")
+    def all_known(self, results):
+        """Check whether every result's canonical url or title is stored.
+        Safe to call from search threads, it uses its own cursor.
+        """
+        canon_urls = list(set(canonicalize_url(res.url) for res in results))
+        titles = list(set(res.title for res in results))
+        select_cmd = """SELECT %s FROM %s WHERE %s IN (%s)"""
+        known = {}
+        for column, values in [("canon_url", canon_urls), ("title", titles)]:
+            marks = ", ".join("?" * len(values))
+            rows = self.connection.execute(select_cmd % (column,
+                self.TABLE_NAME, column, marks), values).fetchall()
+            known[column] = set(row[0] for row in rows)
+        return all(canonicalize_url(res.url) in known["canon_url"] or
+                   res.title in known["title"] for res in results)
+
+    @METRICS.timed("oski_db_seconds", op="source_history")
+    def source_history(self, sources, kind="pdf"):
+        """Return {source: (scored articles, sum of their scores, archive
+        jobs of kind done, dead)} of the given sources.
+        """
+        history = {}
+        step = self.MAX_VARIABLES
+        for idx in range(0, len(sources), step):
+            chunk = sources[idx:idx + step]
+            select_cmd = """SELECT a.source, COUNT(a.score),
+                                   TOTAL(a.score), TOTAL(j.state = 'done'),
+                                   TOTAL(j.state = 'dead')
+                            FROM %s AS a LEFT JOIN ArchiveJobs AS j
+                            ON j.article_id = a.id AND j.kind = ?
+                            WHERE a.source IN (%s)
+                            GROUP BY a.source""" % \
+                         (self.TABLE_NAME, ", ".join("?" * len(chunk)))
+            for row in self.connection.execute(select_cmd, [kind] + chunk):
+                history[row[0]] = (row[1], row[2], int(row[3]), int(row[4]))
+        return history
 
+    @METRICS.timed("oski_db_seconds", op="get_crawl_state")
+    def get_crawl_state(self, query):
+        """Return the crawl state of a query as a dict, None if never run."""
+        select_cmd = """SELECT last_run, newest_url, newest_title, known_page
+                        FROM CrawlState WHERE query = ?"""
+        result = self.connection.execute(select_cmd, (query, )).fetchone()
+        if result is None:  return None
+        return dict(zip(["last_run", "newest_url", "newest_title",
+                         "known_page"], result))
+
+    @METRICS.timed("oski_db_seconds", op="set_crawl_state")
+    def set_crawl_state(self, query, last_run, newest=None, known_page=None):
+        """Record a completed search. newest is the top result, if any."""
+        newest_url = newest.url if newest else None
+        newest_title = newest.title if newest else None
+        upsert_cmd = """INSERT INTO CrawlState
+                            (query, last_run, newest_url, newest_title,
+                             known_page)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (query) DO UPDATE SET
+                            last_run = excluded.last_run,
+                            newest_url = COALESCE(excluded.newest_url,
+                                                  newest_url),
+                            newest_title = COALESCE(excluded.newest_title,
+                                                    newest_title),
+                            known_page = excluded.known_page"""
+        with self.pool.writer() as cursor:
+            cursor.execute(upsert_cmd, (query, last_run, newest_url,
+                                        newest_title, known_page))
+
+    @METRICS.timed("oski_db_seconds", op="set_blob")
+    def set_blob(self, title, digest, size, kind="pdf"):
+        """Record the archived blob of an article."""
+        insert_cmd = """INSERT OR REPLACE INTO Manifest
+                            (article_id, kind, digest, size, compressed,
+                             stored)
+                        SELECT id, ?, ?, ?,
+                               COALESCE((SELECT compressed FROM Manifest
+                                         WHERE digest = ? LIMIT 1), 0), ?
+                        FROM %s WHERE title = ?""" % self.TABLE_NAME
+        with self.pool.writer() as cursor:
+            cursor.execute(insert_cmd, (kind, digest, size, digest,
+                                        time.time(), title))
+            return cursor.rowcount > 0
+
+    def get_blob(self, title, kind="pdf"):
+        """Return the blob digest archived for title, None if not archived."""
+        select_cmd = """SELECT m.digest FROM Manifest AS m
+                        JOIN %s AS a ON a.id = m.article_id
+                        WHERE a.title = ? AND m.kind = ?""" % self.TABLE_NAME
+        result = self.cursor.execute(select_cmd, (title, kind)).fetchone()
+        return result[0] if result else None
+
+    def blobs_stored_before(self, stamp, kind="pdf"):
+        """Return digests of uncompressed blobs first stored before stamp."""
+        select_cmd = """SELECT digest FROM Manifest
+                        WHERE compressed = 0 AND kind = ?
+                        GROUP BY digest HAVING MIN(stored) < ?"""
+        return [row[0] for row in
+                self.cursor.execute(select_cmd, (kind, stamp)).fetchall()]
+
+    def blob_titles(self, kind="pdf"):
+        """Return {digest: titles of the articles archived as it}."""
+        select_cmd = """SELECT m.digest, a.title FROM Manifest AS m
+                        JOIN %s AS a ON a.id = m.article_id
+                        WHERE m.kind = ?""" % self.TABLE_NAME
+        titles = {}
+        for digest, title in self.connection.execute(select_cmd, (kind, )):
+            titles.setdefault(digest, []).append(title)
+        return titles
+
+    def drop_blob(self, digest, kind="pdf"):
+        """Forget a blob, its articles no longer count as archived."""
+        with self.pool.writer() as cursor:
+            for table in ["Manifest", "BlobChecks"]:
+                cursor.execute("""DELETE FROM %s WHERE digest = ?
+                                  AND kind = ?""" % table, (digest, kind))
+
+    def blob_checks(self, kind="pdf"):
+        """Return {digest: (path, mtime, size)} of blobs that passed their
+        last verification.
+        """
+        select_cmd = """SELECT digest, path, mtime, size FROM BlobChecks
+                        WHERE kind = ? AND status = 'ok'"""
+        return dict((row[0], row[1:]) for row in
+                    self.connection.execute(select_cmd, (kind, )))
+
+    @METRICS.timed("oski_db_seconds", op="set_blob_checks")
+    def set_blob_checks(self, checks, kind="pdf"):
+        """Record verifications, from (digest, path, mtime, size, sha256,
+        status, error) tuples.
+        """
+        insert_cmd = """INSERT OR REPLACE INTO BlobChecks
+                            (digest, path, mtime, size, sha256, status, error,
+                             kind, checked)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+        now = time.time()
+        with self.pool.writer() as cursor:
+            cursor.executemany(insert_cmd, [tuple(check) + (kind, now)
+                                            for check in checks])
+
+    def set_compressed(self, digest):
+        update_cmd = """UPDATE Manifest SET compressed = 1 WHERE digest = ?"""
+        with self.pool.writer() as cursor:
+            cursor.execute(update_cmd, (digest, ))
+
+    @METRICS.timed("oski_db_seconds", op="enqueue_jobs")
+    def enqueue_jobs(self, titles, kind, state="pending", next_try=0):
+        """Queue an archiving job of kind for each title, unless queued."""
+        step = self.MAX_VARIABLES
+        now = time.time()
+        with self.pool.writer() as cursor:
+            for idx in range(0, len(titles), step):
+                chunk = titles[idx:idx + step]
+                insert_cmd = """INSERT OR IGNORE INTO ArchiveJobs
+                                    (article_id, kind, state, next_try,
+                                     updated)
+                                SELECT id, ?, ?, ?, ? FROM %s
+                                WHERE title IN (%s)""" % \
+                             (self.TABLE_NAME, ", ".join("?" * len(chunk)))
+                cursor.execute(insert_cmd, [kind, state, next_try, now] +
+                               chunk)
+
+    def reset_jobs(self, titles, kind, state):
+        """Queue a fresh job of kind for each title, replacing finished or
+        dead-lettered ones.
+        """
+        step = self.MAX_VARIABLES
+        now = time.time()
+        with self.pool.writer() as cursor:
+            for idx in range(0, len(titles), step):
+                chunk = titles[idx:idx + step]
+                insert_cmd = """INSERT OR REPLACE INTO ArchiveJobs
+                                    (article_id, kind, state, next_try,
+                                     updated)
+                                SELECT id, ?, ?, 0, ? FROM %s
+                                WHERE title IN (%s)""" % \
+                             (self.TABLE_NAME, ", ".join("?" * len(chunk)))
+                cursor.execute(insert_cmd, [kind, state, now] + chunk)
+
+    @METRICS.timed("oski_db_seconds", op="outbox_add")
+    def outbox_add(self, titles):
+        """Queue articles for subscribers' digests, in the given order."""
+        insert_cmd = """INSERT INTO Outbox (article_id, queued)
+                        SELECT id, ? FROM %s WHERE title = ?""" % \
+                     self.TABLE_NAME
+        now = time.time()
+        with self.pool.writer() as cursor:
+            cursor.executemany(insert_cmd, [(now, title) for title in titles])
+
+    def outbox_since(self, after):
+        """Return [(outbox id, Article)] queued after outbox id after."""
+        select_cmd = """SELECT o.id, %s FROM Outbox AS o
+                        JOIN %s AS a ON a.id = o.article_id
+                        WHERE o.id > ? ORDER BY o.id""" % \
+                     (article_columns("a"), self.TABLE_NAME)
+        return [(row[0], Article(*row[1:])) for row in
+                self.cursor.execute(select_cmd, (after, )).fetchall()]
+
+    def digest_cursors(self):
+        """Return {digest: (last outbox id sent, time sent)}."""
+        select_cmd = """SELECT digest, last_id, sent FROM DigestCursors"""
+        return dict((row[0], row[1:]) for row in
+                    self.connection.execute(select_cmd))
+
+    def set_digest_cursors(self, digests, last_id, sent=None):
+        """Move digests past outbox id last_id, and mark them sent now if
+        sent is given.
+        """
+        update_cmd = """INSERT OR REPLACE INTO DigestCursors
+                            (digest, last_id, sent)
+                        VALUES (?, ?, COALESCE(?, (SELECT sent FROM
+                                DigestCursors WHERE digest = ?), 0))"""
+        with self.pool.writer() as cursor:
+            cursor.executemany(update_cmd, [(digest, last_id, sent, digest)
+                                            for digest in digests])
+
+    def prune_outbox(self, upto, before):
+        """Drop outbox entries up to id upto, and any queued before time
+        before. Return the number dropped.
+        """
+        delete_cmd = """DELETE FROM Outbox WHERE id <= ? OR queued < ?"""
+        with self.pool.writer() as cursor:
+            cursor.execute(delete_cmd, (upto, before))
+            return cursor.rowcount
+
+    def enqueue_missing(self, kind):
+        """Queue jobs for articles with neither a blob of kind nor a job.
+        Return the number of jobs queued.
+        """
+        insert_cmd = """INSERT OR IGNORE INTO ArchiveJobs
+                            (article_id, kind, state, next_try, updated)
+                        SELECT a.id, ?, 'pending', 0, ? FROM %s AS a
+                        WHERE NOT EXISTS (SELECT 1 FROM Manifest
+                                          WHERE article_id = a.id
+                                          AND kind = ?)""" % self.TABLE_NAME
+        with self.pool.writer() as cursor:
+            cursor.execute(insert_cmd, (kind, time.time(), kind))
+            return cursor.rowcount
+
+    @METRICS.timed("oski_db_seconds", op="claim_jobs")
+    def claim_jobs(self, kind, states, limit, now):
+        """Mark up to limit due jobs of kind as running, oldest due first.
+        Return [(Article, attempts)].
+        """
+        with self.pool.writer() as cursor:
+            select_cmd = """SELECT %s, j.attempts
+                            FROM ArchiveJobs AS j
+                            JOIN %s AS a ON a.id = j.article_id
+                            WHERE j.kind = ? AND j.state IN (%s)
+                            AND j.next_try <= ?
+                            ORDER BY j.next_try LIMIT ?""" % \
+                         (article_columns("a"), self.TABLE_NAME,
+                          ", ".join("?" * len(states)))
+            jobs = [(Article(*row[:-1]), row[-1]) for row in
+                    cursor.execute(select_cmd, [kind] + list(states) +
+                                   [now, limit]).fetchall()]
+            update_cmd = """UPDATE ArchiveJobs SET state = 'running',
+                            updated = ? WHERE article_id = ? AND kind = ?"""
+            cursor.executemany(update_cmd, [(now, article.id, kind)
+                                            for article, _ in jobs])
+        return jobs
+
+    @METRICS.timed("oski_db_seconds", op="set_job_state")
+    def set_job_state(self, title, kind, state, next_try=0, error=None,
+                      attempted=True):
+        """Record the outcome of a job's attempt."""
+        update_cmd = """UPDATE ArchiveJobs SET state = ?, next_try = ?,
+                            error = ?, updated = ?,
+                            attempts = attempts + ?
+                        WHERE kind = ? AND article_id =
+                            (SELECT id FROM %s WHERE title = ?)""" % \
+                     self.TABLE_NAME
+        with self.pool.writer() as cursor:
+            cursor.execute(update_cmd, (state, next_try, error, time.time(),
+                                        int(attempted), kind, title))
+
+    def get_job(self, title, kind):
+        """Return (state, attempts) of a job, None if not queued."""
+        select_cmd = """SELECT j.state, j.attempts FROM ArchiveJobs AS j
+                        JOIN %s AS a ON a.id = j.article_id
+                        WHERE a.title = ? AND j.kind = ?""" % self.TABLE_NAME
+        return self.cursor.execute(select_cmd, (title, kind)).fetchone()
+
+    def release_jobs(self, stamp, state):
+        """Move jobs left running since before stamp, by a crashed or
+        killed worker, back to state. Return the number released.
+        """
+        update_cmd = """UPDATE ArchiveJobs SET state = ?
+                        WHERE state = 'running' AND updated < ?"""
+        with self.pool.writer() as cursor:
+            cursor.execute(update_cmd, (state, stamp))
+            return cursor.rowcount
+
+    def revive_jobs(self, kind, from_state, to_state):
+        """Move every job of kind in from_state to to_state, with a fresh
+        attempt count. Return the number moved.
+        """
+        update_cmd = """UPDATE ArchiveJobs SET state = ?, attempts = 0,
+                            next_try = 0, updated = ?
+                        WHERE kind = ? AND state = ?"""
+        with self.pool.writer() as cursor:
+            cursor.execute(update_cmd, (to_state, time.time(), kind,
+                                        from_state))
+            return cursor.rowcount
+
+    def job_counts(self):
+        """Return {(kind, state): number of jobs}."""
+        select_cmd = """SELECT kind, state, COUNT(*) FROM ArchiveJobs
+                        GROUP BY kind, state"""
+        return dict(((kind, state), count) for kind, state, count in
+                    self.connection.execute(select_cmd))
+
+    def count_articles(self):
+        select_cmd = """SELECT COUNT(*) FROM %s""" % self.TABLE_NAME
+        return self.connection.execute(select_cmd).fetchone()[0]
+
+    def is_empty(self):
+        select_cmd = """SELECT 1 FROM %s LIMIT 1""" % self.TABLE_NAME
+        return self.connection.execute(select_cmd).fetchone() is None
+
+    @METRICS.timed("oski_db_seconds", op="in_database")
     def in_database(self, title):
         """Check if a given article is already in the database."""
-        search_cmd = """SELECT * FROM %s WHERE title = ?""" % self.TABLE_NAME
+        search_cmd = """SELECT 1 FROM %s
+                        WHERE title = ? LIMIT 1""" % self.TABLE_NAME
         self.cursor.execute(search_cmd, (title, ))
-        results = self.cursor.fetchall()
-        return len(results) > 0
+        return self.cursor.fetchone() is not None
 
 
-def create_article(search_res):
-    """Create Article object from SearchResult instance."""
-    return Article(search_res.title, search_res.url, search_res.snippet)
+def article_columns(alias):
+    """ARTICLE_COLUMNS of the Articles table aliased as alias."""
+    return ", ".join("%s.%s" % (alias, column.strip())
+                     for column in ARTICLE_COLUMNS.split(","))
 
-def create_articles(results):
-    """Convert list of SearchResults to Articles."""
-    return [create_article(res) for res in results]
+def dedup_fields(url, snippet):
+    """Canonical url, SimHash and SimHash bands stored with an article."""
+    fingerprint = simhash(snippet or "")
+    return (canonicalize_url(url), fingerprint) + \
+           tuple(simhash_bands(fingerprint))
 
+def fts_query(text):
+    """Quote each word of free text as an FTS5 string, so punctuation in
+    user input cannot break the query syntax.
+    """
+    return " ".join('"%s"' % word.replace('"', '""') for word in text.split())
 
-def main():
-    db = ArticleDB()
+def sql_statements(script):
+    """Split an SQL script into its statements, trigger bodies included."""
+    statements, statement = [], ""
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ""
+    if statement.strip():
+        statements.append(statement.strip())
+    return statements
+
+
+def main(args):
+    db = ArticleDB(args.dbfile)
+    if args.command == "search":
+        for article, score in db.search(args.text, args.limit, args.raw):
+            print "%7.2f  %s\n         %s" % (score, article.title, article.url)
     return
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-db", "--dbfile", type=str, default=ArticleDB.DB_NAME,
+        help="specify database file")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("migrate", help="upgrade database schema")
+    search = commands.add_parser("search", help="full-text search archive")
+    search.add_argument("text", type=str,
+        help="specify words to search for")
+    search.add_argument("-n", "--limit", type=int, default=20,
+        help="specify max number of results")
+    search.add_argument("--raw", action="store_true",
+        help="flag to pass text as FTS5 query syntax")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,868 @@
+#!/usr/bin/env python
+"""Offline benchmarks for Oski pipeline stages.
+
+Search runs against recorded Custom Search responses in Fixtures/CSE served
+by a FakeService, email goes to a local SMTP sink and archiving to a stub
+backend, so no benchmark touches the network. Synthetic data is seeded, and
+each benchmark runs in its own process so peak memory is its own.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import asyncore
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import smtpd
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from Archiver import ArchivePool, ArchiveResult, SnapshotBackend
+from ArticleDB import Article, ArticleDB
+from Metrics import METRICS
+from Oski import Oski, create_email_html
+from SearchEngine import (DomainFilter, FakeService, SearchEngine,
+                          create_result, rem_banned_domains)
+
+FIXTURE_DIR = "Fixtures/CSE"
+PAGE_DIR = "Fixtures/Pages"
+SIZES = {"1k": 1000, "100k": 100000, "1M": 1000000}
+
+
+class DictRecord:
+    """Dict-backed record, as search results and articles used to be."""
+    def __init__(self, title, url, snippet):
+        self.title = title
+        self.url = url
+        self.snippet = snippet
+
+
+class StubBackend:
+    """Archiver backend that writes a small page per url, no network.
+    Each save can take delay seconds, like a page load would.
+    """
+    KIND = "pdf"
+    ISOLATED = False
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        # When the first page was saved
+        self.first_saved = None
+
+    def save(self, url, output_path, secs, extract_text):
+        time.sleep(self.delay)
+        if self.first_saved is None:
+            self.first_saved = time.time()
+        with open(output_path, 'wb') as f:
+            f.write("%%PDF-1.4\n%% Oski benchmark stub of %s\n" % url)
+        return ""
+
+
+class SmtpSink(smtpd.SMTPServer):
+    """Local SMTP server on a free port that counts and drops messages."""
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={"timeout": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages += 1
+        self.recipients += len(rcpttos)
+        self.bytes += len(data)
+
+    def stop(self):
+        asyncore.close_all()
+        self.thread.join()
+
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the fixture pages as text/html without a charset, leaving
+    it to their meta tags. Pages under /slow/ wait the server's delay.
+    """
+    # Keep-alive, and headers sent along with the body
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.startswith("/slow/"):
+            time.sleep(self.server.delay)
+        page = os.path.join(PAGE_DIR, os.path.basename(path))
+        if not page.endswith(".html") or not os.path.isfile(page):
+            self.send_error(404)
+            return
+        with open(page, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server on a free port serving the pages in PAGE_DIR."""
+    daemon_threads = True
+
+    def __init__(self, delay=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           FixtureHandler)
+        self.port = self.server_address[1]
+        self.delay = delay
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d/%s" % (self.port, path)
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out hang up on slow pages
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+## Synthetic data
+def synthetic_urls(num, num_hosts=2000, seed=0):
+    """Generate num urls spread over num_hosts synthetic sites."""
+    rand = random.Random(seed)
+    subdomains = ["", "www.", "m.", "news.", "sports.blog."]
+    suffixes = ["com", "net", "org", "co.uk"]
+    hosts = ["%ssite%d.%s" % (rand.choice(subdomains), idx,
+                              rand.choice(suffixes))
+             for idx in range(num_hosts)]
+    return ["https://%s/article/%d?utm_source=feed" % (rand.choice(hosts), idx)
+            for idx in range(num)]
+
+def synthetic_rows(num, seed=0):
+    """Yield (title, url, snippet) rows drawn from a synthetic vocabulary."""
+    rand = random.Random(seed)
+    vocab = ["word%d" % idx for idx in range(20000)]
+    names = ["kicker%d" % idx for idx in range(500)]
+    teams = ["team%d" % idx for idx in range(130)]
+    for idx in range(num):
+        title = "%s beats %s %s" % (rand.choice(names), rand.choice(teams),
+                                    " ".join(rand.sample(vocab, 4)))
+        snippet = " ".join(rand.sample(vocab, 20))
+        yield (title + " %d" % idx, "http://site%d.com/%d" % (idx % 997, idx),
+               snippet)
+
+def load_fixture_items(fixture_dir=FIXTURE_DIR):
+    """Return the result items of every recorded response, in file order."""
+    items = []
+    for path in sorted(glob.glob(os.path.join(fixture_dir, "*.json"))):
+        with open(path, 'r') as f:
+            items += json.load(f).get("items", [])
+    return items
+
+def fixture_items(num, seed=0, fixture_dir=FIXTURE_DIR):
+    """Generate num API items shaped like the recorded fixtures, each with
+    a unique title, url and snippet.
+    """
+    templates = load_fixture_items(fixture_dir)
+    items = []
+    for idx, row in enumerate(synthetic_rows(num, seed)):
+        item = dict(templates[idx % len(templates)])
+        item["title"] = "%s %s" % (item["title"], row[0])
+        item["link"] = row[1]
+        item["snippet"] = row[2]
+        items.append(item)
+    return items
+
+def synthetic_articles(num, seed=0):
+    return [Article(*row) for row in synthetic_rows(num, seed)]
+
+
+## Harness
+def timed(func, *args):
+    """Return (result, seconds) of a single call."""
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def stage_secs(stage):
+    """Seconds spent so far in an Oski stage, as timed into METRICS."""
+    histogram = METRICS.histograms.get(("oski_stage_seconds",
+                                        (("stage", stage), )))
+    return histogram.sum if histogram else 0.0
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(pct * len(values)))]
+
+def batches(items, size):
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+def peak_rss_mb():
+    """Peak resident memory of this process (Linux reports KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short",
+                                        "HEAD"]).strip()
+    except (OSError, subprocess.CalledProcessError):  return ""
+
+class Workspace:
+    """Temporary directory holding a benchmark Oski's database, archive and
+    parameter files.
+    """
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="oski-bench-")
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def make_oski(self, num_queries, results_per_query=100, ban_rules=(),
+                  sink=None, subscribers=50, backend=None,
+                  search="bench query", ranking=None):
+        """Build an Oski with num_queries fixture-backed queries, archiving
+        to a stub backend and mailing the sink, if given. Results are
+        ranked with the ranking parameters, if given.
+        """
+        with open(self.file("BannedDomains.txt"), 'w') as f:
+            f.write("\n".join(ban_rules))
+        params = {
+            "db_file": self.file("Bench.db"),
+            "searcher": {
+                "queries": [{"search": "%s %d" % (search, idx),
+                             "num_results": {"init": results_per_query,
+                                             "update": results_per_query}}
+                            for idx in range(num_queries)],
+                "ban_file": self.file("BannedDomains.txt"),
+                "max_in_flight": 4},
+            "archiver": {"save_pdfs": True, "save_path": self.file("arch"),
+                         "workers": 4}}
+        if ranking is not None:
+            params["ranking"] = ranking
+        with open(self.file("OskiParams.json"), 'w') as f:
+            json.dump(params, f)
+
+        notif_json = ""
+        if sink:
+            with open(self.file("Subscribers.txt"), 'w') as f:
+                f.write("\n".join("fan%d@localhost" % idx
+                                  for idx in range(subscribers)))
+            notif_json = {"subscr_file": self.file("Subscribers.txt"),
+                          "user": "oski@localhost", "pwd": "",
+                          "smtp_host": "127.0.0.1", "smtp_port": sink.port,
+                          "use_tls": False}
+        oski = Oski(self.file("OskiParams.json"),
+                    {"dev_key": "bench", "engine_id": "bench"}, notif_json)
+        oski.archiver = ArchivePool(self.file("arch"), 4,
+                                    backend=backend or StubBackend())
+        return oski
+
+    def serve_fixtures(self, oski, num, seed=0, latency=0.0):
+        """Point oski's searcher at num fixture items split over its
+        queries, each page taking latency seconds.
+        """
+        items = fixture_items(num, seed)
+        per_query = -(-num // len(oski.queries))
+        service = FakeService(dict(
+            (query["search"], items[idx * per_query:(idx + 1) * per_query])
+            for idx, query in enumerate(oski.queries)), latency)
+        oski.searcher = SearchEngine("bench", "bench", service=service)
+        return service
+
+    def close(self):
+        shutil.rmtree(self.path)
+
+
+## Benchmarks
+def bench_domain_filter(num=100000):
+    """Filter num synthetic results against a mix of ban rules."""
+    results = [Article(str(idx), url, "")
+               for idx, url in enumerate(synthetic_urls(num))]
+    rules = ["site%d" % idx for idx in range(0, 2000, 7)] + \
+            ["site%d.net" % idx for idx in range(1, 2000, 11)] + \
+            ["*.site%d.com" % idx for idx in range(2, 2000, 13)]
+    domain_filter = DomainFilter(rules)
+
+    kept, secs = timed(rem_banned_domains, results, domain_filter)
+    print "domain_filter: %d urls, %d rules, %d kept, %.3fs, %.0f urls/s" % \
+          (num, len(rules), len(kept), secs, num / secs)
+    return {"items": num, "secs": secs}
+
+def bench_email_html(num=100000):
+    """Render digests of growing size, seconds per article should hold."""
+    for size in [num // 100, num // 10, num]:
+        articles = [Article("Cal <kicker> %d" % idx, "http://x.com/?a=%d" %
+                               idx, "Snippet & more") for idx in range(size)]
+        html, secs = timed(create_email_html, articles)
+        print "email_html: %d articles, %d bytes, %.3fs, %.2fus/article" % \
+              (size, len(html), secs, 1e6 * secs / max(1, size))
+    return {"items": num, "secs": secs}
+
+def bench_db(num=100000):
+    """ArticleDB bulk insert, lookups, paging and full scans."""
+    workspace = Workspace()
+    try:
+        db = ArticleDB(workspace.file("Bench.db"))
+        articles = synthetic_articles(num)
+        stats = {"items": num}
+
+        start = time.time()
+        for batch in batches(articles, 1000):
+            db.add_articles(batch)
+        stats["insert_secs"] = time.time() - start
+        print "db: inserted %d articles in %.2fs, %.0f/s" % \
+              (num, stats["insert_secs"], num / stats["insert_secs"])
+
+        rand = random.Random(1)
+        titles = [article.title for article in rand.sample(articles,
+                                                           min(num, 10000))]
+        titles += ["missing %d" % idx for idx in range(len(titles))]
+        _, secs = timed(db.known_titles, titles)
+        stats["lookup_secs"] = secs
+        print "db: %d title lookups in %.3fs" % (len(titles), secs)
+
+        _, secs = timed(lambda: sum(len(page) for page in db.iter_pages()))
+        stats["page_secs"] = secs
+        _, secs = timed(lambda: sum(1 for _ in db.iter_articles()))
+        stats["scan_secs"] = secs
+        print "db: paged in %.2fs, scanned in %.2fs" % (stats["page_secs"],
+                                                       secs)
+        stats["secs"] = sum(value for key, value in stats.items()
+                            if key.endswith("_secs"))
+        db.close()
+    finally:
+        workspace.close()
+    return stats
+
+def bench_fts(num=1000000):
+    """Full-text query latency on a synthetic archive of num articles."""
+    workspace = Workspace()
+    try:
+        db = ArticleDB(workspace.file("Bench.db"))
+        insert_cmd = """INSERT INTO %s (title, url, snippet)
+                        VALUES (?, ?, ?)""" % ArticleDB.TABLE_NAME
+        rows = synthetic_rows(num)
+        start = time.time()
+        while True:
+            batch = [row for _, row in zip(range(10000), rows)]
+            if not batch:  break
+            db.cursor.executemany(insert_cmd, batch)
+            db.connection.commit()
+        print "fts: indexed %d articles in %.1fs" % (num, time.time() - start)
+
+        rand = random.Random(1)
+        queries = ["kicker%d" % rand.randrange(500) for _ in range(50)] + \
+                  ["kicker%d team%d" % (rand.randrange(500), rand.randrange(130))
+                   for _ in range(50)] + \
+                  ["word%d" % rand.randrange(20000) for _ in range(50)]
+        latencies = []
+        for query in queries:
+            _, secs = timed(db.search, query, 20)
+            latencies.append(1e3 * secs)
+        print "fts: %d queries, p50 %.2fms, p95 %.2fms, max %.2fms" % \
+              (len(queries), percentile(latencies, 0.5),
+               percentile(latencies, 0.95), max(latencies))
+        del db
+    finally:
+        workspace.close()
+    return {"items": len(queries), "secs": sum(latencies) / 1e3,
+            "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95)}
+
+def bench_search(num=100000):
+    """perform_search over recorded fixtures: paging, ban filtering,
+    deduplication and crawl state, 100 results per query.
+    """
+    workspace = Workspace()
+    try:
+        oski = workspace.make_oski(-(-num // 100), ban_rules=["site13.com"])
+        service = workspace.serve_fixtures(oski, num)
+        articles, secs = timed(oski.perform_search)
+        print "search: %d results, %d api calls, %d kept, %.2fs, " \
+              "%.0f results/s" % (num, len(service.calls), len(articles),
+                                  secs, num / secs)
+        del oski
+    finally:
+        workspace.close()
+    return {"items": num, "secs": secs, "api_calls": len(service.calls)}
+
+def bench_pipeline(num=100000, run_size=1000):
+    """Search, then oski_update in runs of run_size articles: store,
+    notify through the SMTP sink and archive to the stub backend.
+    """
+    workspace = Workspace()
+    sink = SmtpSink()
+    try:
+        oski = workspace.make_oski(-(-num // 100), sink=sink)
+        workspace.serve_fixtures(oski, num)
+        start = time.time()
+        articles = oski.perform_search()
+        stages = {"search_secs": time.time() - start}
+        for stage in ["store", "notify", "archive"]:
+            stages[stage + "_secs"] = 0.0
+
+        for run in batches(articles, run_size):
+            added, secs = timed(oski.store, run)
+            stages["store_secs"] += secs
+            _, secs = timed(oski.notify, added)
+            stages["notify_secs"] += secs
+            _, secs = timed(oski.archive, added)
+            stages["archive_secs"] += secs
+        secs = time.time() - start
+        print "pipeline: %d articles in %.2fs, %.0f articles/s" % \
+              (len(articles), secs, len(articles) / secs)
+        print "pipeline: %s" % ", ".join(
+            "%s %.2fs" % (name[:-5], stages[name]) for name in
+            ["search_secs", "store_secs", "notify_secs", "archive_secs"])
+        print "pipeline: sink got %d messages, %d recipients, %d bytes" % \
+              (sink.messages, sink.recipients, sink.bytes)
+        if oski.notifier:
+            oski.notifier.sender.close()
+        del oski
+    finally:
+        sink.stop()
+        workspace.close()
+    return dict(stages, items=len(articles), secs=secs,
+                messages=sink.messages)
+
+
+def bench_stream(num=100000, latency=0.02, delay=0.002):
+    """Sequential against streaming run of a large initial search, with
+    latency seconds per API page and delay seconds per archived page.
+    """
+    stats = {"items": num, "secs": 0.0}
+    for streaming in [False, True]:
+        name = "stream" if streaming else "sequential"
+        workspace = Workspace()
+        try:
+            backend = StubBackend(delay)
+            oski = workspace.make_oski(-(-num // 100), backend=backend)
+            workspace.serve_fixtures(oski, num, latency=latency)
+            oski.streaming = streaming
+            start = time.time()
+            oski.run()
+            secs = time.time() - start
+            first = backend.first_saved - start
+            print "stream: %s, %d results in %.2fs, first archived after " \
+                  "%.2fs" % (name, num, secs, first)
+            stats[name + "_secs"] = secs
+            stats[name + "_first_secs"] = first
+            stats["secs"] += secs
+            del oski
+        finally:
+            workspace.close()
+    return stats
+
+def bench_stream_update(num=1000, track_delay=0.05):
+    """Sequential against streaming update run, with the page tracker
+    taking track_delay seconds per page while pages are stored at once.
+    Both runs must page and store alike, else raise AssertionError.
+    """
+    stats = {"items": num, "secs": 0.0}
+    for streaming in [False, True]:
+        name = "stream" if streaming else "sequential"
+        workspace = Workspace()
+        try:
+            oski = workspace.make_oski(-(-num // 50), results_per_query=50)
+            service = workspace.serve_fixtures(oski, num)
+            # A stored article makes every query an update, paged until
+            # the tracker finds a page of known results
+            oski.db.add_articles(synthetic_articles(1, seed=1))
+            oski.populate = False
+            all_known = oski.db.all_known
+            def slow_known(results):
+                time.sleep(track_delay)
+                return all_known(results)
+            oski.db.all_known = slow_known
+            oski.save_pdfs = False
+            oski.streaming = streaming
+            start = time.time()
+            oski.run()
+            secs = time.time() - start
+            stored = len(oski.db.get_articles()) - 1
+            print "stream_update: %s, %d api calls, %d stored in %.2fs" % \
+                  (name, len(service.calls), stored, secs)
+            stats[name + "_api_calls"] = len(service.calls)
+            stats[name + "_stored"] = stored
+            stats["secs"] += secs
+            oski.db.close()
+        finally:
+            workspace.close()
+    for field in ["api_calls", "stored"]:
+        if stats["sequential_" + field] != stats["stream_" + field]:
+            raise AssertionError("stream_update: streaming %s %d, "
+                                 "sequential %d" % (field,
+                                 stats["stream_" + field],
+                                 stats["sequential_" + field]))
+    return stats
+
+def bench_rank(num=100000, delay=0.002, run_size=1000):
+    """Store and archive num results of "Cal Kicker" queries in runs of
+    run_size, without and with ranking, delay seconds per archived page.
+    """
+    stats = {"items": num, "secs": 0.0}
+    for ranked in [False, True]:
+        name = "ranked" if ranked else "unranked"
+        workspace = Workspace()
+        try:
+            backend = StubBackend(delay)
+            oski = workspace.make_oski(-(-num // 100), backend=backend,
+                                       search="Cal Kicker",
+                                       ranking={} if ranked else None)
+            workspace.serve_fixtures(oski, num)
+            articles = oski.perform_search()
+            stages = {"rank": 0.0, "store": 0.0, "archive": 0.0}
+            archived = 0
+            for run in batches(articles, run_size):
+                # Ranking runs inside store, split it out of the store time
+                ranking = stage_secs("rank")
+                added, secs = timed(oski.store, run)
+                ranking = stage_secs("rank") - ranking
+                stages["rank"] += ranking
+                stages["store"] += secs - ranking
+                outcomes, secs = timed(oski.archive, added)
+                stages["archive"] += secs
+                archived += len(outcomes)
+            secs = sum(stages.values())
+            jobs = oski.db.job_counts()
+            print "rank: %s, %d results, %d archived now, %d deferred, " \
+                  "%d skipped in %.2fs (rank %.2fs, store %.2fs, " \
+                  "archive %.2fs)" % \
+                  (name, len(articles), archived,
+                   jobs.get(("pdf", "pending"), 0),
+                   jobs.get(("pdf", "skipped"), 0), secs, stages["rank"],
+                   stages["store"], stages["archive"])
+            if ranked:
+                print "rank: scored %d results in %.2fs, %.0f results/s" % \
+                      (len(articles), stages["rank"],
+                       len(articles) / stages["rank"])
+                stats["rank_secs"] = stages["rank"]
+            stats[name + "_secs"] = secs
+            stats[name + "_archived"] = archived
+            stats["secs"] += secs
+            oski.db.close()
+        finally:
+            workspace.close()
+    return stats
+
+def check_snapshots(pool, server):
+    """Archive the fixture pages, a missing page and a slow one through
+    pool. Raise AssertionError unless each has the expected outcome.
+    """
+    articles = [Article("profile", server.url("kicker_profile.html"), ""),
+                Article("profile again", server.url("kicker_profile.html"),
+                        ""),
+                Article("recap", server.url("game_recap.html"), ""),
+                Article("missing", server.url("missing.html"), ""),
+                Article("slow", server.url("slow/game_recap.html"), "")]
+    profile, again, recap, missing, slow = pool.save_articles(articles)
+    for outcome in [profile, again, recap]:
+        if not outcome.success:
+            raise AssertionError("snapshot: %r, %s" % (outcome,
+                                                       outcome.error))
+    # Charsets declared only in meta tags, utf-8 and iso-8859-1
+    if u"caf\xe9 au lait" not in profile.text or \
+       u"\u201cIt\u2019s all about tempo" not in profile.text:
+        raise AssertionError("snapshot: profile text %r" % profile.text)
+    if u"campus caf\xe9" not in recap.text or \
+       u"\xabI just wanted" not in recap.text:
+        raise AssertionError("snapshot: recap text %r" % recap.text)
+    if "Subscribe" in profile.text or "Privacy" in profile.text:
+        raise AssertionError("snapshot: boilerplate kept %r" % profile.text)
+    # The same page always makes the same blob
+    if again.digest != profile.digest or recap.digest == profile.digest:
+        raise AssertionError("snapshot: digests %s, %s, %s" %
+                             (profile.digest, again.digest, recap.digest))
+    if missing.status != ArchiveResult.FAILED or "404" not in missing.error:
+        raise AssertionError("snapshot: missing page %r, %s" %
+                             (missing, missing.error))
+    if slow.status != ArchiveResult.TIMEOUT:
+        raise AssertionError("snapshot: slow page %r, %s" %
+                             (slow, slow.error))
+
+def bench_snapshot(num=100000, secs=0.5):
+    """Check, then time, SnapshotBackend archiving num fixture pages from
+    a local HTTP server through an ArchivePool.
+    """
+    workspace = Workspace()
+    server = FixtureServer(delay=secs * 4)
+    try:
+        pool = ArchivePool(workspace.file("arch"), workers=8, secs=secs,
+                           extract_text=True, backend=SnapshotBackend())
+        check_snapshots(pool, server)
+        pages = ["kicker_profile.html", "game_recap.html"]
+        # Each url is its own document, so its own blob
+        articles = [Article("page %d" % idx, server.url(
+                        "%s?id=%d" % (pages[idx % len(pages)], idx)), "")
+                    for idx in range(num)]
+        outcomes, secs = timed(pool.save_articles, articles)
+        saved = len([outcome for outcome in outcomes if outcome.success])
+        print "snapshot: saved %d of %d pages in %.2fs, %.0f pages/s" % \
+              (saved, num, secs, num / secs)
+    finally:
+        server.stop()
+        workspace.close()
+    return {"items": num, "secs": secs, "saved": saved}
+
+def _build_records(conn, kind, num):
+    items = load_fixture_items()
+    full = [create_result(item, "bench query") for item in items]
+    rows = [(article.title, article.url, article.snippet, article.published,
+             article.source, article.query_id, idx)
+            for idx, article in enumerate(full)]
+    before = peak_rss_mb()
+    start = time.time()
+    if kind == "dict":
+        records = [DictRecord(*rows[idx % len(rows)][:3])
+                   for idx in xrange(num)]
+    elif kind == "slots":
+        records = [Article(*rows[idx % len(rows)]) for idx in xrange(num)]
+    else:
+        records = [create_result(items[idx % len(items)], "bench query")
+                   for idx in xrange(num)]
+    secs = time.time() - start
+    conn.send((peak_rss_mb() - before, secs))
+    conn.close()
+
+def bench_records(num=1000000):
+    """Memory of num records: dict-backed with three fields against the
+    slotted Article with all seven set. Both share their strings, so
+    memory is per-record overhead. Articles built from API items (api)
+    also own their strings.
+    """
+    stats = {"items": num, "secs": 0.0}
+    sample = create_result(load_fixture_items()[0], "bench query")
+    legacy = DictRecord(sample.title, sample.url, sample.snippet)
+    sizes = {"dict": sys.getsizeof(legacy) + sys.getsizeof(legacy.__dict__),
+             "slots": sys.getsizeof(sample), "api": sys.getsizeof(sample)}
+    for kind in ["dict", "slots", "api"]:
+        # Fresh process each, so freed memory is not reused
+        recv_conn, send_conn = multiprocessing.Pipe(False)
+        proc = multiprocessing.Process(target=_build_records,
+                                       args=(send_conn, kind, num))
+        proc.start()
+        send_conn.close()
+        rss_mb, secs = recv_conn.recv()
+        proc.join()
+        stats[kind + "_mb"] = rss_mb
+        stats[kind + "_bytes"] = sizes[kind]
+        stats["secs"] += secs
+        print "records: %s, %d records in %.2fs, %.1f MB, %d bytes/record " \
+              "(%d object)" % (kind, num, secs, rss_mb,
+                               1024 * 1024 * rss_mb / num, sizes[kind])
+    return stats
+
+
+def _stress_read(db, rand, titles):
+    op = rand.randrange(4)
+    if op == 0:
+        db.get_article(rand.choice(titles))
+    elif op == 1:
+        db.known_titles(rand.sample(titles, 20))
+    elif op == 2:
+        db.search("kicker%d" % rand.randrange(500), 10)
+    else:
+        db.get_page(rand.randrange(len(titles)), 50)
+
+def _stress_write(db, rand, name, idx):
+    articles = [Article("stress %s %d %d" % (name, idx, k),
+                        "http://stress%d.example.com/%s/%d" %
+                        (rand.randrange(100), name, idx * 10 + k),
+                        "kicker%d stress snippet" % rand.randrange(500))
+                for k in range(10)]
+    titles = [article.title for article in db.add_articles(articles)]
+    db.enqueue_jobs(titles, "pdf")
+    db.set_text(titles[0], "stress text")
+
+def _stress_worker(db, role, name, ops, titles):
+    """Run ops reads or writes against db. Return (role, completed,
+    "database is locked" errors, other errors, latencies).
+    """
+    rand = random.Random(name)
+    done, locked, errors, latencies = 0, 0, [], []
+    for idx in xrange(ops):
+        start = time.time()
+        try:
+            if role == "write":
+                _stress_write(db, rand, name, idx)
+            else:
+                _stress_read(db, rand, titles)
+            done += 1
+        except sqlite3.Error as e:
+            if "locked" in str(e):
+                locked += 1
+            else:
+                errors.append(str(e))
+        latencies.append(time.time() - start)
+    return (role, done, locked, errors, latencies)
+
+def _stress_process(conn, db_file, name, ops, titles):
+    """Writer in another process, with its own ArticleDB."""
+    try:
+        with ArticleDB(db_file) as db:
+            conn.send(_stress_worker(db, "write", name, ops, titles))
+    finally:
+        conn.close()
+
+def bench_db_stress(num=100000, readers=8, writers=4, processes=2):
+    """num reads and writes against one database: readers and writers
+    threads sharing an ArticleDB, plus writer processes with their own.
+    Every sqlite error is counted, "database is locked" ones separately.
+    """
+    workspace = Workspace()
+    try:
+        db_file = workspace.file("Bench.db")
+        db = ArticleDB(db_file)
+        articles = synthetic_articles(min(num, 10000))
+        for batch in batches(articles, 1000):
+            db.add_articles(batch)
+        titles = [article.title for article in articles]
+        # Writes touch ten articles each, so count them ten times
+        per_read = max(1, num // 2 // readers)
+        per_write = max(1, num // 20 // (writers + processes))
+
+        results, threads = [], []
+        for idx in range(readers + writers):
+            role = "read" if idx < readers else "write"
+            ops = per_read if role == "read" else per_write
+            threads.append(threading.Thread(target=lambda *args:
+                results.append(_stress_worker(*args)),
+                args=(db, role, "thread%d" % idx, ops, titles)))
+        procs = []
+        for idx in range(processes):
+            recv_conn, send_conn = multiprocessing.Pipe(False)
+            procs.append((recv_conn, multiprocessing.Process(
+                target=_stress_process, args=(send_conn, db_file,
+                    "process%d" % idx, per_write, titles))))
+        start = time.time()
+        for _, proc in procs:
+            proc.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for recv_conn, proc in procs:
+            try:
+                results.append(recv_conn.recv())
+            except EOFError:
+                results.append(("write", 0, 0, ["process exit code %s" %
+                                                proc.exitcode], []))
+            proc.join()
+        secs = time.time() - start
+
+        stats = {"secs": secs, "items": 0, "locked": 0, "errors": 0}
+        for role in ["read", "write"]:
+            done = sum(result[1] for result in results if result[0] == role)
+            latencies = [1e3 * latency for result in results
+                         if result[0] == role for latency in result[4]]
+            stats["items"] += done
+            stats[role + "s"] = done
+            stats[role + "_p95_ms"] = percentile(latencies, 0.95)
+            print "db_stress: %d %ss in %.2fs, %.0f/s, p50 %.2fms, " \
+                  "p95 %.2fms" % (done, role, secs, done / secs,
+                                  percentile(latencies, 0.5),
+                                  percentile(latencies, 0.95))
+        errors = [error for result in results for error in result[3]]
+        stats["locked"] = sum(result[2] for result in results)
+        stats["errors"] = len(errors)
+        print "db_stress: %d readers, %d writers, %d writer processes, " \
+              "%d locked errors, %d other errors%s" % \
+              (readers, writers, processes, stats["locked"], len(errors),
+               " (%s)" % errors[0] if errors else "")
+        db.close()
+    finally:
+        workspace.close()
+    return stats
+
+
+BENCHMARKS = {
+    "db": bench_db,
+    "db_stress": bench_db_stress,
+    "domain_filter": bench_domain_filter,
+    "email_html": bench_email_html,
+    "fts": bench_fts,
+    "pipeline": bench_pipeline,
+    "rank": bench_rank,
+    "records": bench_records,
+    "search": bench_search,
+    "snapshot": bench_snapshot,
+    "stream": bench_stream,
+    "stream_update": bench_stream_update,
+}
+
+def _run_child(conn, name, num):
+    try:
+        record = BENCHMARKS[name](num)
+        record["peak_rss_mb"] = peak_rss_mb()
+        conn.send(record)
+    finally:
+        conn.close()
+
+def run_isolated(name, num):
+    """Run a benchmark in a child process. Return its record."""
+    recv_conn, send_conn = multiprocessing.Pipe(False)
+    proc = multiprocessing.Process(target=_run_child,
+                                   args=(send_conn, name, num))
+    proc.start()
+    send_conn.close()
+    try:
+        record = recv_conn.recv()
+    except EOFError:
+        record = {"error": "exit code %s" % proc.exitcode}
+    proc.join()
+    return record
+
+def parse_size(text):
+    return SIZES[text] if text in SIZES else int(text)
+
+def main(args):
+    names = args.bench or sorted(BENCHMARKS.keys())
+    commit = git_commit()
+    for name in names:
+        record = run_isolated(name, args.num)
+        record.update(bench=name, num=args.num, commit=commit,
+                      python=platform.python_version(), ts=time.time())
+        if record.get("secs"):
+            record["items_per_sec"] = record["items"] / record["secs"]
+        print "%s: peak rss %.1f MB" % (name, record.get("peak_rss_mb", 0))
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--bench", type=str, action="append",
+        choices=sorted(BENCHMARKS.keys()), help="specify benchmark to run")
+    parser.add_argument("-n", "--num", type=parse_size, default=100000,
+        help="specify number of synthetic items, or one of %s" %
+             ", ".join(sorted(SIZES.keys())))
+    parser.add_argument("-o", "--output", type=str,
+        help="specify file to append JSON result records to")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""Per-thread sqlite connections with a single writer."""
+
+import argparse
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from Metrics import METRICS
+
+
+class ConnectionPool:
+    """Hands each thread its own connection to one sqlite database.
+
+    Connections run in WAL mode, so readers never block each other or the
+    writer. Writes go through writer(), which lets a single thread at a
+    time write inside one immediate transaction. Waits on locks held by
+    other processes are bounded by busy_timeout seconds rather than
+    failing with "database is locked" right away. Connections of threads
+    that have exited are closed as new ones open, and close() closes the
+    rest.
+    """
+    BUSY_TIMEOUT = 30.0
+    PRAGMAS = ["PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL",
+               "PRAGMA foreign_keys=ON"]
+
+    def __init__(self, db_name, busy_timeout=BUSY_TIMEOUT):
+        self.db_name = db_name
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        # {thread: connection} of every open connection
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def connect(self):
+        connection = sqlite3.connect(self.db_name, timeout=self.busy_timeout,
+                                     check_same_thread=False)
+        connection.execute("PRAGMA busy_timeout=%d" %
+                           (1000 * self.busy_timeout))
+        for pragma in self.PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    def connection(self):
+        """Return this thread's connection, opened on first use."""
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            return connection
+        if self.closed:
+            raise sqlite3.ProgrammingError("Cannot use a closed pool.")
+        connection = self.connect()
+        self.local.connection = connection
+        self.local.cursors = {}
+        with self.lock:
+            for thread in list(self.connections.keys()):
+                if not thread.is_alive():
+                    self.connections.pop(thread).close()
+            self.connections[threading.current_thread()] = connection
+        return connection
+
+    def cursor(self, row_factory=None):
+        """Return this thread's cursor, one per row_factory."""
+        connection = self.connection()
+        cursor = self.local.cursors.get(row_factory)
+        if cursor is None:
+            cursor = connection.cursor()
+            cursor.row_factory = row_factory
+            self.local.cursors[row_factory] = cursor
+        return cursor
+
+    @contextmanager
+    def writer(self):
+        """Yield this thread's cursor inside an immediate transaction,
+        committed on exit and rolled back on error. A session opened
+        inside another joins it.
+        """
+        cursor = self.cursor()
+        if getattr(self.local, "writing", False):
+            yield cursor
+            return
+        start = time.time()
+        with self.write_lock:
+            cursor.execute("BEGIN IMMEDIATE")
+            METRICS.observe("oski_db_write_wait_seconds", time.time() - start)
+            self.local.writing = True
+            try:
+                yield cursor
+                cursor.connection.commit()
+            except:
+                cursor.connection.rollback()
+                raise
+            finally:
+                self.local.writing = False
+
+    def release(self):
+        """Close this thread's connection, ex: before a worker exits."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:  return
+        with self.lock:
+            self.connections.pop(threading.current_thread(), None)
+        self.local.connection = None
+        connection.close()
+
+    def close(self):
+        """Close every thread's connection."""
+        with self.lock:
+            self.closed = True
+            connections, self.connections = self.connections.values(), {}
+        for connection in connections:
+            connection.close()
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(args):
+    with ConnectionPool(args.dbfile) as pool:
+        connection = pool.connection()
+        if args.checkpoint:
+            busy, log, done = connection.execute(
+                "PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            print "Checkpointed %d of %d WAL pages%s" % \
+                  (done, log, ", database busy" if busy else "")
+        for pragma in ["journal_mode", "busy_timeout", "page_count",
+                       "freelist_count", "user_version"]:
+            print "%-15s %s" % (pragma, connection.execute(
+                "PRAGMA %s" % pragma).fetchone()[0])
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-db", "--dbfile", type=str, default="Oski.db",
+        help="specify database file")
+    parser.add_argument("--checkpoint", action="store_true",
+        help="flag to copy the WAL into the database and truncate it")
+    args = parser.parse_args()
+
+    main(args)
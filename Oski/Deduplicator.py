@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""Removes search results that duplicate archived or batched articles."""
+
+import argparse
+import hashlib
+import re
+from urllib import urlencode
+from urlparse import urlsplit, parse_qsl
+
+
+# Query parameters that track visitors but do not select content
+TRACKING_PARAMS = set(["fbclid", "gclid", "dclid", "msclkid", "mc_cid",
+                       "mc_eid", "_ga", "cmpid", "icid", "ref", "ref_src",
+                       "src", "smid", "amp", "outputtype", "ncid", "sr_share"])
+TRACKING_PREFIXES = ("utm_", "_hs")
+# Host prefixes serving the same story as the main site
+MIRROR_SUBDOMAINS = ("www.", "m.", "mobile.", "amp.")
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+SIMHASH_BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+WORD_RE = re.compile(r"[a-z0-9']+")
+
+
+def canonicalize_url(url):
+    """Reduce url to a canonical form shared by its mirrors and variants.
+
+    Drops the scheme, fragment, tracking query parameters, mirror
+    subdomains (www, m, mobile, amp) and AMP path segments.
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower().split("@")[-1]
+    if host.endswith(":80") or host.endswith(":443"):
+        host = host.rsplit(":", 1)[0]
+    stripped = True
+    while stripped:
+        stripped = False
+        for prefix in MIRROR_SUBDOMAINS:
+            if host.startswith(prefix) and host.count(".") > 1:
+                host = host[len(prefix):]
+                stripped = True
+
+    segments = [seg for seg in parts.path.split("/") if seg]
+    segments = [seg for seg in segments if seg.lower() != "amp"]
+    if segments:
+        segments[-1] = re.sub(r"\.amp(?=\.html?$)|\.amp$", "", segments[-1])
+    path = "/" + "/".join(segments)
+
+    query = [(key, value) for key, value in parse_qsl(parts.query)
+             if key.lower() not in TRACKING_PARAMS and
+             not key.lower().startswith(TRACKING_PREFIXES)]
+    canon = host + path
+    if query:
+        canon += "?" + urlencode(sorted(query))
+    return canon
+
+def simhash(text):
+    """Compute a 64-bit SimHash fingerprint of text, None if no words."""
+    words = WORD_RE.findall(text.lower())
+    if not words:  return None
+    weights = [0] * SIMHASH_BITS
+    for word in words:
+        value = int(hashlib.md5(word).hexdigest()[:16], 16)
+        for bit in range(SIMHASH_BITS):
+            if value & (1 << bit):
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+    fingerprint = 0
+    for bit in range(SIMHASH_BITS):
+        if weights[bit] > 0:
+            fingerprint |= 1 << bit
+    return to_signed(fingerprint)
+
+def to_signed(value):
+    """Map an unsigned 64-bit value into sqlite's signed INTEGER range."""
+    if value >= 1 << (SIMHASH_BITS - 1):
+        value -= 1 << SIMHASH_BITS
+    return value
+
+def simhash_bands(fingerprint):
+    """Split fingerprint into bands. Fingerprints within SIMHASH_BANDS - 1
+    bits of each other share at least one band.
+    """
+    if fingerprint is None:
+        return [None] * SIMHASH_BANDS
+    mask = (1 << SIMHASH_BAND_BITS) - 1
+    unsigned = fingerprint % (1 << SIMHASH_BITS)
+    return [(unsigned >> (band * SIMHASH_BAND_BITS)) & mask
+            for band in range(SIMHASH_BANDS)]
+
+def hamming(lhs, rhs):
+    """Number of differing bits between two fingerprints."""
+    return bin((lhs ^ rhs) % (1 << SIMHASH_BITS)).count("1")
+
+
+class Deduplicator:
+    """Filters results whose canonical url or snippet is already known.
+
+    Lookups go through indexed columns in ArticleDB, so the cost per result
+    does not grow with the size of the archive.
+    """
+    def __init__(self, db, max_distance=SIMHASH_BANDS - 1):
+        self.db = db
+        self.max_distance = min(max_distance, SIMHASH_BANDS - 1)
+
+    def is_near(self, fingerprint, candidates):
+        return any(hamming(fingerprint, other) <= self.max_distance
+                   for other in candidates)
+
+    def filter(self, results):
+        """Return results that are new to both the database and the batch."""
+        unique = []
+        seen_urls = set()
+        seen_bands = [dict() for _ in range(SIMHASH_BANDS)]
+        for result in results:
+            canon = canonicalize_url(result.url)
+            if canon in seen_urls or self.db.has_canon_url(canon):
+                continue
+
+            fingerprint = simhash(result.snippet)
+            if fingerprint is not None:
+                bands = simhash_bands(fingerprint)
+                batch = [other for idx, band in enumerate(bands)
+                         for other in seen_bands[idx].get(band, [])]
+                if self.is_near(fingerprint, batch) or \
+                   self.is_near(fingerprint, self.db.similar_simhashes(bands)):
+                    continue
+                for idx, band in enumerate(bands):
+                    seen_bands[idx].setdefault(band, []).append(fingerprint)
+
+            seen_urls.add(canon)
+            unique.append(result)
+        return unique
+
+
+def main(args):
+    for url in args.urls:
+        print "%s -> %s" % (url, canonicalize_url(url))
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("urls", type=str, nargs="+",
+        help="specify urls to canonicalize")
+    args = parser.parse_args()
+
+    main(args)
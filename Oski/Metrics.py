@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""Collects pipeline metrics, exported as JSON logs and Prometheus text."""
+
+import argparse
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+from functools import wraps
+
+
+# Upper bounds in seconds, from single SQL statements to slow page loads
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0,
+           120.0, float("inf"))
+
+
+class Histogram:
+    """Latency histogram with fixed buckets."""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+
+    def cumulative(self):
+        """Return [(bound, observations <= bound)]."""
+        total, result = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Timer:
+    """Context manager observing its duration into a histogram."""
+    def __init__(self, metrics, name, labels, log=False):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.log = log
+        self.secs = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.secs = time.time() - self.start
+        self.metrics.observe(self.name, self.secs, **self.labels)
+        if self.log:
+            self.metrics.log(self.name, secs=round(self.secs, 6),
+                             ok=exc_type is None, **self.labels)
+        return False
+
+
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+                         .replace("\n", "\\n")
+    if not labels:  return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, escape(value))
+                             for key, value in labels)
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+class Metrics:
+    """Thread-safe registry of counters and latency histograms.
+
+    Series are keyed by name and labels. Events written with log() go to
+    log_file as one JSON object per line. write_prometheus() replaces
+    prom_file atomically, for a node_exporter textfile collector.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.log_file = None
+        self.prom_file = None
+
+    def configure(self, log_file=None, prom_file=None):
+        self.log_file = log_file
+        self.prom_file = prom_file
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, log=False, **labels):
+        """Time a with block. With log=True, also log it as an event."""
+        return Timer(self, name, labels, log)
+
+    def timed(self, name, log=False, **labels):
+        """Decorator timing every call of a function."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with Timer(self, name, labels, log):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def log(self, event, **fields):
+        """Append a JSON event to log_file, if configured."""
+        if not self.log_file:  return
+        fields["event"] = event
+        fields["ts"] = round(time.time(), 3)
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            with open(self.log_file, 'a') as f:
+                f.write(line + "\n")
+
+    def snapshot(self):
+        """Return counters and histogram summaries as a JSON-ready dict."""
+        with self.lock:
+            counters = [dict(labels, name=name, value=value)
+                        for (name, labels), value
+                        in sorted(self.counters.items())]
+            histograms = [dict(labels, name=name, count=hist.count,
+                               sum=round(hist.sum, 6))
+                          for (name, labels), hist
+                          in sorted(self.histograms.items())]
+        return {"counters": counters, "histograms": histograms}
+
+    def prometheus(self):
+        """Render every series in the Prometheus text exposition format."""
+        lines, typed = [], set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append("# TYPE %s counter" % name)
+                    typed.add(name)
+                lines.append("%s%s %s" % (name, format_labels(labels),
+                                          value))
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append("# TYPE %s histogram" % name)
+                    typed.add(name)
+                for bound, count in hist.cumulative():
+                    bucket = labels + (("le", format_bound(bound)), )
+                    lines.append("%s_bucket%s %d" %
+                                 (name, format_labels(bucket), count))
+                lines.append("%s_sum%s %r" % (name, format_labels(labels),
+                                              hist.sum))
+                lines.append("%s_count%s %d" % (name, format_labels(labels),
+                                                hist.count))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=None):
+        path = path or self.prom_file
+        if not path:  return
+        handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or os.curdir)
+        with os.fdopen(handle, 'w') as f:
+            f.write(self.prometheus())
+        # mkstemp files are private, a collector may run as another user
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+
+    def export(self):
+        """Log a snapshot and write the Prometheus file, as configured."""
+        if self.log_file:
+            self.log("metrics", **self.snapshot())
+        self.write_prometheus()
+
+
+# Shared by every module in this process
+METRICS = Metrics()
+
+
+def main(args):
+    stats = pstats.Stats(args.profile)
+    stats.sort_stats(args.sort).print_stats(args.num)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("profile", type=str,
+        help="specify profile written by Oski.py --profile")
+    parser.add_argument("-s", "--sort", type=str, default="cumulative",
+        help="specify pstats sort key")
+    parser.add_argument("-n", "--num", type=int, default=30,
+        help="specify number of functions to print")
+    args = parser.parse_args()
+
+    main(args)
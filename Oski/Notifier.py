@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 """Notifies subscribers of new articles."""
 
+import argparse
 import smtplib
+import socket
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from Queue import Queue, Empty
+from Metrics import METRICS
 
 
 class Email:
@@ -34,50 +40,281 @@ class Email:
     def change_receiver(self, receiver):
         """Modify email recipient so we can resend to additional users."""
         self.receiver = receiver
+        # Assigning a header appends another one, so drop the old first
+        del self.email["To"]
         self.email["To"] = self.receiver
         return
 
 
-class GmailSender:
-    """Sends email through Gmail account."""
-    def __init__(self, user, pwd):
+class Subscriber:
+    """Subscriber address with delivery preferences.
+
+    schedule is how often digests go out, one of SCHEDULES. topics limits
+    digests to articles of those topics or search queries, all if empty.
+    """
+    # Seconds between digests
+    SCHEDULES = {"immediate": 0, "hourly": 3600, "daily": 86400}
+
+    def __init__(self, address, schedule="immediate", topics=()):
+        self.address = address
+        self.schedule = schedule
+        self.topics = tuple(sorted(topics))
+
+    @property
+    def key(self):
+        """Subscribers with the same key get the same digest."""
+        if not self.topics:
+            return self.schedule
+        return "%s:%s" % (self.schedule, ",".join(self.topics))
+
+    def __repr__(self):
+        return "%s (%s)" % (self.address, self.key)
+
+
+def read_subscribers(lines):
+    """Parse subscriber lines, ex:
+    fan@example.com schedule=daily topics=Cal Football,Kickers
+    Blank lines and lines starting with # are skipped.
+    """
+    subscribers = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):  continue
+        fields = line.split(None, 1)
+        options = {}
+        if len(fields) > 1:
+            # Topic names may hold spaces, so split on the option names
+            rest = " " + fields[1]
+            for name in ["topics", "schedule"]:
+                head, sep, value = rest.partition(" %s=" % name)
+                if sep:
+                    options[name], rest = value.strip(), head
+        schedule = options.get("schedule", "immediate")
+        if schedule not in Subscriber.SCHEDULES:
+            print 'Notifier: Unknown schedule "%s" for %s, sending ' \
+                  'immediately' % (schedule, fields[0])
+            schedule = "immediate"
+        topics = [topic.strip() for topic in
+                  options.get("topics", "").split(",") if topic.strip()]
+        subscribers.append(Subscriber(fields[0], schedule, topics))
+    return subscribers
+
+
+class DeliveryStats:
+    """Counts delivery outcomes of a mailing."""
+    def __init__(self):
+        self.sent = 0
+        self.failed = []
+        self.batches = 0
+        self.retries = 0
+        self.reconnects = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def __repr__(self):
+        return "%d sent, %d failed in %d batches (%d retries, " \
+               "%d reconnects) in %.2fs" % \
+               (self.sent, len(self.failed), self.batches, self.retries,
+                self.reconnects, self.seconds)
+
+
+class SmtpSender:
+    """Sends email over a single persistent SMTP session.
+
+    Transient failures (dropped connection, 4xx replies, socket errors)
+    reconnect and retry with backoff, up to attempts tries per message.
+    """
+    TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected,
+                        smtplib.SMTPConnectError, socket.error)
+
+    def __init__(self, host, port, user="", pwd="", use_tls=True,
+                 attempts=3, backoff=1.0):
+        self.host = host
+        self.port = port
         self.user = user
-        self.server = smtplib.SMTP("smtp.gmail.com:587")
-        self.server.starttls()
-        self.server.login(self.user, pwd)
+        self.pwd = pwd
+        self.use_tls = use_tls
+        self.attempts = attempts
+        self.backoff = backoff
+        self.server = None
+
+    def connect(self):
+        self.close()
+        self.server = smtplib.SMTP(self.host, self.port)
+        if self.use_tls:
+            self.server.starttls()
+        if self.pwd:
+            self.server.login(self.user, self.pwd)
+
+    def close(self):
+        if self.server is None:  return
+        try:
+            self.server.quit()
+        except self.TRANSIENT_ERRORS + (smtplib.SMTPException, ):
+            pass
+        self.server = None
+
+    def is_transient(self, error):
+        if isinstance(error, self.TRANSIENT_ERRORS):
+            return True
+        return isinstance(error, smtplib.SMTPResponseException) and \
+               400 <= error.smtp_code < 500
+
+    def send(self, sender, recipients, message, stats=None):
+        """Send serialized message to recipients in one envelope.
+        Return the recipients the server refused.
+        """
+        stats = stats or DeliveryStats()
+        for attempt in range(self.attempts):
+            try:
+                if self.server is None:
+                    if attempt > 0:
+                        stats.add(reconnects=1)
+                    self.connect()
+                with METRICS.timer("oski_smtp_send_seconds"):
+                    refused = self.server.sendmail(sender, recipients,
+                                                   message)
+                return list(refused.keys())
+            except smtplib.SMTPRecipientsRefused as e:
+                return list(e.recipients.keys())
+            except Exception as e:
+                if not self.is_transient(e) or attempt == self.attempts - 1:
+                    raise
+                stats.add(retries=1)
+                self.close()
+                time.sleep(self.backoff * 2**attempt)
 
     def send_email(self, email):
-        self.server.sendmail(str(email.sender), 
-                             str(email.receiver),
-                             str(email))
+        self.send(str(email.sender), [str(email.receiver)], str(email))
         return
 
     def __repr__(self):
         return self.user
 
     def __del__(self):
-        return self.server.quit()
+        self.close()
+
+
+class GmailSender(SmtpSender):
+    """Sends email through Gmail account."""
+    def __init__(self, user, pwd):
+        SmtpSender.__init__(self, "smtp.gmail.com", 587, user, pwd)
+        self.connect()
 
 
 class Notifier:
-    """Notifies subscribers of content through GmailSender."""
-    def __init__(self, subscribers, user, pwd):
+    """Notifies subscribers of content over SMTP.
+
+    The message is serialized once and delivered to subscribers as BCC
+    envelopes of batch_size recipients. Large lists are split across
+    workers threads, each with its own SMTP session.
+    """
+    def __init__(self, subscribers, user, pwd, host="smtp.gmail.com",
+                 port=587, use_tls=True, batch_size=50, workers=1):
         self.user = user
-        self.sender = GmailSender(user, pwd)
-        self.subscribers = subscribers
+        self.subscribers = [subscriber.strip() for subscriber in subscribers
+                            if subscriber.strip()]
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self.make_sender = lambda: SmtpSender(host, port, user, pwd, use_tls)
+        self.sender = self.make_sender()
+        self.stats = None
 
-    def mail_subscribers(self, email):
-        for subscriber in self.subscribers:
-            email.change_receiver(subscriber)
-            self.sender.send_email(email)
-        return
+    def batches(self, recipients=None):
+        recipients = self.subscribers if recipients is None else recipients
+        step = self.batch_size
+        return [recipients[idx:idx + step]
+                for idx in range(0, len(recipients), step)]
+
+    def deliver(self, sender, jobs, message, stats):
+        """Send batches from the jobs queue over a single session."""
+        while True:
+            try:
+                batch = jobs.get_nowait()
+            except Empty:  break
+            try:
+                refused = sender.send(self.user, batch, message, stats)
+                stats.add(sent=len(batch) - len(refused), failed=refused,
+                          batches=1)
+            except Exception as e:
+                print "Notifier: Delivery FAILED to %d subscribers: %s" % \
+                      (len(batch), e)
+                stats.add(failed=batch, batches=1)
+
+    def mail_subscribers(self, email, recipients=None):
+        """Send email to recipients, every subscriber by default.
+        Return DeliveryStats.
+        """
+        stats = DeliveryStats()
+        start = time.time()
+        # Recipients only appear on the envelope, so serialize once
+        email.change_receiver(email.sender)
+        message = str(email)
+
+        jobs = Queue()
+        for batch in self.batches(recipients):
+            jobs.put(batch)
+        num_threads = min(self.workers, jobs.qsize())
+        if num_threads <= 1:
+            self.deliver(self.sender, jobs, message, stats)
+        else:
+            senders = [self.sender] + [self.make_sender()
+                                       for _ in range(num_threads - 1)]
+            threads = [threading.Thread(target=self.deliver,
+                                        args=(sender, jobs, message, stats))
+                       for sender in senders]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for sender in senders[1:]:
+                sender.close()
+
+        stats.seconds = time.time() - start
+        self.stats = stats
+        METRICS.inc("oski_smtp_recipients_total", stats.sent, status="sent")
+        METRICS.inc("oski_smtp_recipients_total", len(stats.failed),
+                    status="failed")
+        METRICS.inc("oski_smtp_retries_total", stats.retries)
+        return stats
 
     def __repr__(self):
         return repr(self.sender)
 
 
-def main():
+def main(args):
+    """Send a test message, ex: to a local debugging server started with
+    python -m smtpd -n -c DebuggingServer localhost:1025
+    """
+    with open(args.subscrfile, 'r') as f:
+        subscribers = read_subscribers(f)
+    notifier = Notifier([subscriber.address for subscriber in subscribers],
+                        args.user, "", args.host, args.port,
+                        use_tls=False, batch_size=args.batchsize,
+                        workers=args.workers)
+    email = Email(args.user, "", "Oski test", "Go Bears!")
+    print notifier.mail_subscribers(email)
     return
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-sf", "--subscrfile", type=str, required=True,
+        help="specify file listing subscribers")
+    parser.add_argument("-u", "--user", type=str, default="oski@localhost",
+        help="specify sender address")
+    parser.add_argument("--host", type=str, default="localhost",
+        help="specify SMTP host")
+    parser.add_argument("--port", type=int, default=1025,
+        help="specify SMTP port")
+    parser.add_argument("-bs", "--batchsize", type=int, default=50,
+        help="specify recipients per message")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+        help="specify number of SMTP sessions")
+    args = parser.parse_args()
+
+    main(args)
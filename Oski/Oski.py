@@ -2,118 +2,374 @@
 """Oski is the figurehead (read: mascot) of the full archiver pipeline."""
 
 import argparse
+import cPickle
+import cProfile
+import hashlib
 import json
-import jsonschema
 import sys
 import os
-from SearchEngine import (SearchEngine, read_engine_json, 
+import tempfile
+import threading
+import time
+from SearchEngine import (SearchEngine, PageTracker, read_engine_json, 
                           read_banned_domains, rem_banned_domains, to_ascii)
-from ArticleDB import Article, ArticleDB, create_articles
-from Archiver import save_article
-from Notifier import Notifier, Email
+from SearchCache import SearchCache
+from ArticleDB import Article, ArticleDB
+from Deduplicator import Deduplicator
+from Archiver import ArchivePool, ArchiveResult, BACKENDS, PdfBackend
+from ArchiveQueue import ArchiveQueue
+from Notifier import Notifier, read_subscribers
+from Outbox import Outbox
+from Ranker import Ranker
+from Templates import render_digest
+from Metrics import METRICS
 from datetime import datetime
 from getpass import getpass
 
 
 class Oski:
-    """Manages searching, archiving, storing in database, and notifying."""
-    def __init__(self, oski_json, keys, notif_json=""):
+    """Manages searching, archiving, storing in database, and notifying.
+
+    Given a topic, runs that topic's queries against its own database
+    shard, archive path and subscribers. Pass another Oski's searcher to
+    share its API quota and cache.
+    """
+    def __init__(self, oski_json, keys, notif_json="", topic=None,
+                 searcher=None):
         # Validate json
         [success, params] = load_json(oski_json)
         if not success:
             sys.exit(1)
 
         # Load parameters
-        self.queries = params["searcher"]["queries"]
+        self.params = params
+        self.topic = topic
+        settings = topic_params(params, topic, notif_json) if topic else {}
+        self.watch_files = [oski_json]
+        self.queries = get_value(settings, "queries", None) or \
+                       get_value(params["searcher"], "queries", [])
+        self.max_in_flight = get_value(params["searcher"], "max_in_flight", 1)
+        # Optionally stream each page of results through the later stages
+        pipeline = get_value(params, "pipeline", {})
+        self.streaming = get_value(pipeline, "streaming", False)
+        self.queue_size = get_value(pipeline, "queue_size", 16)
+        if "metrics" in params.keys():
+            METRICS.configure(get_value(params["metrics"], "log_file", None),
+                              get_value(params["metrics"], "prometheus_file",
+                                        None))
 
         # Read banned domains parameter
         self.banned_domains = None
-        if "ban_file" in params["searcher"].keys():
-            ban_file = params["searcher"]["ban_file"]
+        ban_file = get_value(settings, "ban_file", None) or \
+                   get_value(params["searcher"], "ban_file", None)
+        if ban_file:
             if os.path.exists(ban_file):
                 self.banned_domains = read_banned_domains(ban_file)
+                self.watch_files.append(ban_file)
             else:
                 print "Oski: Unable to LOCATE %s" % ban_file
 
         # Initialize search engine and database
-        self.searcher = SearchEngine(keys["dev_key"], keys["engine_id"])
-        self.db = ArticleDB()
+        qps = get_value(params["searcher"], "qps", 0)
+        self.cache = None
+        if searcher is not None:
+            self.searcher, self.cache = searcher, searcher.cache
+        elif "cache" in params["searcher"].keys():
+            cache_params = params["searcher"]["cache"]
+            max_mb = get_value(cache_params, "max_mb", 50)
+            self.cache = SearchCache(
+                get_value(cache_params, "path", SearchCache.DB_NAME),
+                get_value(cache_params, "ttl", 3600),
+                max_mb * 2**20,
+                get_value(cache_params, "replay_only", False))
+        if searcher is None:
+            self.searcher = SearchEngine(keys["dev_key"], keys["engine_id"],
+                                         qps=qps, cache=self.cache)
+        self.db = ArticleDB(get_value(settings, "db_file", None) or
+                            get_value(params, "db_file", ArticleDB.DB_NAME))
+        # Queries without crawl state only populate a new database
+        self.populate = self.db.is_empty()
+        self.deduplicator = Deduplicator(self.db)
 
         # Optionally, initialize archiving system
         self.save_pdfs, self.save_path = None, None
+        self.archiver = None
+        self.pdf_archiver, self.defer_batch = None, None
+        self.compress_days = None
+        self.queue = None
         if "archiver" in params.keys():
             self.save_pdfs = params["archiver"]["save_pdfs"]
-            self.save_path = params["archiver"]["save_path"]
+            self.save_path = get_value(settings, "save_path", None) or \
+                             params["archiver"]["save_path"]
+            workers = get_value(params["archiver"], "workers", 4)
+            secs = get_value(params["archiver"], "timeout", 60)
+            extract_text = get_value(params["archiver"], "extract_text", False)
+            backend = BACKENDS[get_value(params["archiver"], "backend",
+                                         "pdf")]()
+            self.archiver = ArchivePool(self.save_path, workers, secs,
+                                        extract_text, backend)
+            # Snapshots now, pdfs later in batches
+            if backend.KIND != PdfBackend.KIND and \
+               get_value(params["archiver"], "defer_pdf", False):
+                self.pdf_archiver = ArchivePool(self.save_path, workers, secs)
+                self.defer_batch = get_value(params["archiver"],
+                                             "defer_batch", 20)
+            self.compress_days = get_value(params["archiver"],
+                                           "compress_after_days", None)
+            self.queue = ArchiveQueue(
+                self.db, get_value(params["archiver"], "max_attempts", 5),
+                get_value(params["archiver"], "backoff_secs", 60),
+                get_value(params["archiver"], "max_backoff_secs", 86400))
+
+        # Optionally, rank results so only relevant ones are archived now
+        self.ranker = None
+        if "ranking" in params.keys():
+            ranking = params["ranking"]
+            self.ranker = Ranker(
+                self.db, self.queries, get_value(ranking, "archive_at", 0.4),
+                get_value(ranking, "defer_at", 0.25),
+                get_value(ranking, "weights", None),
+                get_value(ranking, "half_life_days", 30),
+                get_value(ranking, "defer_secs", 0),
+                self.archiver.kind if self.archiver else PdfBackend.KIND)
 
         # Optionally, notify subscribers of new articles
         self.notifier = None
+        self.outbox = None
         if notif_json:
-            subscr_file = notif_json["subscr_file"]
+            subscr_file = get_value(settings, "subscr_file", None) or \
+                          notif_json["subscr_file"]
             if os.path.exists(subscr_file):
                 with open(subscr_file, 'r') as f:
-                    subscribers = f.readlines()
-                self.notifier = Notifier(subscribers, 
-                                         notif_json["user"], notif_json["pwd"])
+                    subscribers = read_subscribers(f)
+                self.watch_files.append(subscr_file)
+                self.notifier = Notifier(
+                    [subscriber.address for subscriber in subscribers],
+                    notif_json["user"], notif_json["pwd"],
+                    get_value(notif_json, "smtp_host", "smtp.gmail.com"),
+                    get_value(notif_json, "smtp_port", 587),
+                    get_value(notif_json, "use_tls", True),
+                    get_value(notif_json, "batch_size", 50),
+                    get_value(notif_json, "workers", 1))
+                subject = "New %s Articles!" % self.topic if self.topic \
+                          else "New Articles!"
+                self.outbox = Outbox(self.db, self.notifier, subscribers,
+                                     self.topic, create_email_html, subject)
             else:
                 print "Oski: Unable to LOCATE %s" % subscr_file
 
 
+    def run(self):
+        """Search once, then store, notify and archive what was found.
+        When streaming, stages overlap and work on each page as it arrives.
+        """
+        if self.streaming:
+            from Pipeline import StreamingPipeline
+            StreamingPipeline(self, self.queue_size).run()
+        else:
+            self.oski_update(self.perform_search())
+        # Catch up on a batch of pdfs deferred by the snapshot backend
+        if self.pdf_archiver:
+            self.drain([PdfBackend.KIND], self.defer_batch)
+
     def oski_update(self, articles):
         """Add to database, make pdfs, update subscribers."""
-        # Try to add to db
-        added = self.db.add_articles(articles)
-        print "Found %d new articles" % len(added)
-
-        # Email subscribers about new articles
-        if added and self.notifier:
-            subject = "New Articles!"
-            html = create_email_html(added)
-            if html:
-                email = Email(self.notifier.user,
-                            "", subject, html, use_html=True)
-                self.notifier.mail_subscribers(email) 
-                print "Mailed subscribers! %s" % str(datetime.now())
-
-        # Convert added articles to pdfs
-        if added and self.save_pdfs:
-            for search_res in added:
-                try:
-                    success = save_article(search_res.url, 
-                                           search_res.title, self.save_path)
-                    if success:
-                        print 'Oski: Saved article "%s"' % search_res.title
-                    else:  
-                        print 'Oski: Save TIMEOUT on "%s"' % search_res.title
-                except Exception as e:
-                    print 'Oski: Non-timeout EXCEPTION on "%s"' % search_res.title
-                    print e
-
+        added = self.store(articles)
+        self.notify(added)
+        self.archive(added)
         return added
 
-    def perform_search(self, init_search=True):
-        """Search for content with each input query."""
-        results = []
-        for query in self.queries:
-            search = query["search"]
+    @METRICS.timed("oski_stage_seconds", log=True, stage="store")
+    def store(self, articles):
+        """Try to add articles to db, return those newly added.
 
-            if init_search:
-                num_results = query["num_results"]["init"]
-            else:
-                num_results = get_value(query["num_results"], "update", 10)
-
-            exact_terms, or_terms, date_restrict = "", "", ""
-            if "options" in query.keys():
-                exact_terms = get_value(query["options"], "exact_terms")
-                or_terms = get_value(query["options"], "or_terms")
-                if not init_search:
-                    date_restrict = get_value(query["options"], "date_restrict")
-
-            # Hunt for recent articles
-            results += self.searcher.query(search, num_results, 
-                                           exact_terms, or_terms, date_restrict)
-        
+        With a ranker, articles are stored best first. Deferred ones are
+        queued for a later drain, and skipped ones are stored but neither
+        archived nor returned.
+        """
+        if not self.ranker:
+            added = self.db.add_articles(articles)
+            now, later, skipped = added, [], []
+            print "Found %d new articles" % len(added)
+        else:
+            added = self.db.add_articles(self.ranker.score(articles))
+            decisions = self.ranker.split(added)
+            now, later, skipped = [decisions[decision] for decision in
+                                   [Ranker.ARCHIVE, Ranker.DEFER, Ranker.SKIP]]
+            print "Found %d new articles, %d deferred, %d skipped" % \
+                  (len(added), len(later), len(skipped))
+        # Queue archiving first, so a crash mid-archive leaves a job behind
+        if added and self.save_pdfs:
+            kind = self.archiver.kind
+            self.queue.enqueue(now, kind, running=True)
+            if later:
+                self.queue.defer(later, kind, self.ranker.defer_secs)
+            if skipped:
+                self.queue.skip(skipped, kind)
+            if self.pdf_archiver:
+                self.queue.enqueue(now + later, self.pdf_archiver.kind)
+                if skipped:
+                    self.queue.skip(skipped, self.pdf_archiver.kind)
+        return now + later
+
+    @METRICS.timed("oski_stage_seconds", log=True, stage="notify")
+    def notify(self, added, lock=None):
+        """Queue new articles for subscribers, then email every digest that
+        is due. Database access is serialized through lock, if given.
+        """
+        if not self.outbox:  return
+        lock = lock or threading.Lock()
+        self.outbox.add(added, lock)
+        if self.outbox.flush(lock):
+            print "Mailed subscribers! %s" % str(datetime.now())
+
+    @METRICS.timed("oski_stage_seconds", log=True, stage="archive")
+    def archive(self, added, store_archived=True, archiver=None):
+        """Archive added articles, return their ArchiveResults. Articles
+        the ranker deferred are left for a drain.
+        """
+        if self.ranker:
+            added = [article for article in added
+                     if self.ranker.decide(article) == Ranker.ARCHIVE]
+        archiver = archiver or self.archiver
+        outcomes = []
+        if added and self.save_pdfs:
+            outcomes = archiver.save_articles(added)
+            for outcome in outcomes:
+                title = outcome.article.title
+                if outcome.status == ArchiveResult.SAVED:
+                    print 'Oski: Saved article "%s"' % title
+                elif outcome.status == ArchiveResult.TIMEOUT:
+                    print 'Oski: Save TIMEOUT on "%s"' % title
+                else:
+                    print 'Oski: Non-timeout EXCEPTION on "%s"' % title
+                    print outcome.error
+            if store_archived:
+                self.store_archived(outcomes, archiver.kind)
+        return outcomes
+
+    def archivers(self, kinds=None):
+        """Return the ArchivePools of the given kinds of blob."""
+        return [archiver for archiver in [self.archiver, self.pdf_archiver]
+                if archiver and (kinds is None or archiver.kind in kinds)]
+
+    @METRICS.timed("oski_stage_seconds", log=True, stage="drain")
+    def drain(self, kinds=None, limit=None, lock=None):
+        """Work through due archive jobs, a batch at a time, until none are
+        due or limit jobs were tried. Return the number of jobs tried.
+
+        Database access is serialized through lock, if given.
+        """
+        if not self.save_pdfs:  return 0
+        lock = lock or threading.Lock()
+        tried = 0
+        for archiver in self.archivers(kinds):
+            while limit is None or tried < limit:
+                batch = archiver.workers * 2
+                if limit is not None:
+                    batch = min(batch, limit - tried)
+                with lock:
+                    articles = self.queue.claim(archiver.kind, batch)
+                if not articles:  break
+                print "Oski: Archiving %d queued %s jobs" % \
+                      (len(articles), archiver.kind)
+                tried += len(articles)
+                outcomes = self.archive(articles, False, archiver)
+                with lock:
+                    self.store_archived(outcomes, archiver.kind)
+        return tried
+
+    @METRICS.timed("oski_stage_seconds", log=True, stage="verify")
+    def verify(self, workers=None):
+        """Verify archived pdfs, index their text and re-queue broken ones.
+        Return {status: number of pdfs}.
+        """
+        if not self.save_pdfs:  return {}
+        from Verifier import ArchiveVerifier
+        return ArchiveVerifier(self.db, self.archiver.store, self.queue,
+                               workers).run()
+
+    def store_archived(self, outcomes, kind=None):
+        """Record saved blobs in the manifest, and add their extracted text
+        to the full-text index.
+        """
+        kind = kind or self.archiver.kind
+        for outcome in outcomes:
+            if not outcome.success:  continue
+            self.db.set_blob(outcome.article.title, outcome.digest,
+                             outcome.size, kind)
+            if outcome.text:
+                self.db.set_text(outcome.article.title, outcome.text)
+        counts = self.queue.record(outcomes, kind)
+        if counts.get(ArchiveQueue.FAILED) or counts.get(ArchiveQueue.DEAD):
+            print "Oski: %d archive jobs to retry, %d dead-lettered" % \
+                  (counts.get(ArchiveQueue.FAILED, 0),
+                   counts.get(ArchiveQueue.DEAD, 0))
+        if self.compress_days is not None:
+            self.archiver.store.compress_older(self.db, self.compress_days)
+
+    def search_args(self, query, init_search=None):
+        """Build SearchEngine.query arguments for a single query.
+
+        With init_search=None, the query's crawl state decides: a query
+        never run against an empty database populates it, later runs only
+        look back to the last run and stop paging at the first page of
+        known results.
+        """
+        search = query["search"]
+        state = self.db.get_crawl_state(search)
+        if init_search is None:
+            init_search = state is None and self.populate
+
+        if init_search:
+            num_results = query["num_results"]["init"]
+        else:
+            num_results = get_value(query["num_results"], "update", 10)
+
+        exact_terms, or_terms, date_restrict = "", "", ""
+        if "options" in query.keys():
+            exact_terms = get_value(query["options"], "exact_terms")
+            or_terms = get_value(query["options"], "or_terms")
+            if not init_search:
+                date_restrict = get_value(query["options"], "date_restrict")
+
+        tracker = None
+        if not init_search:
+            tracker = PageTracker(self.db.all_known)
+            if state is not None:
+                date_restrict = date_window(state["last_run"], date_restrict)
+
+        ttl = get_value(query, "cache_ttl", None)
+        return (search, num_results,
+                exact_terms, or_terms, date_restrict, ttl, tracker)
+
+    def record_crawl(self, args, started, results):
+        """Store the crawl state of a finished search."""
+        search, tracker = args[0], args[-1]
+        newest = results[0] if results else None
+        known_page = tracker.known_page if tracker else None
+        self.db.set_crawl_state(search, started, newest, known_page)
+
+    def filter_results(self, results):
+        """Drop banned and duplicate results."""
         results = rem_banned_domains(results, self.banned_domains)
-        return create_articles(results)
+        return self.deduplicator.filter(results)
+
+    @METRICS.timed("oski_stage_seconds", log=True, stage="search")
+    def perform_search(self, init_search=None):
+        """Search for content with each input query."""
+        started = time.time()
+        searches = [self.search_args(query, init_search)
+                    for query in self.queries]
+
+        # Hunt for recent articles
+        per_query = self.searcher.query_many(searches, self.max_in_flight,
+                                             merge=False)
+        results = []
+        for args, query_results in zip(searches, per_query):
+            self.record_crawl(args, started, query_results)
+            results += query_results
+        return self.filter_results(results)
 
     def initial_search(self):
         """Searches for content without date restrictions.
@@ -129,22 +385,9 @@ class Oski:
 def create_email_html(articles, 
                       header_html="EmailTemplates/CalBearsHeader.html", 
                       article_html="EmailTemplates/CalBearsArticle.html"):
-    html = ""
     if not check_files_exist([header_html, article_html]) or len(articles) == 0:  
-        return html
-    with open(header_html, 'r') as f:
-        header_template = f.read()
-    with open(article_html, 'r') as f:
-        article_template = f.read()
-
-    html += '<table style="width: 600px">'
-    html += header_template
-    for article in articles:
-        html += article_template.format(article.url, article.title, 
-                                        article.snippet)
-    html += "</table>"
-    html = html.replace("\n", "")
-    return html
+        return ""
+    return render_digest(articles, header_html, article_html)
 
 ## Helpers
 def check_files_exist(files):
@@ -169,6 +412,7 @@ def uni2ascii(input):
 
 def validate(json_file, schema):
     """Validate input json file against schema json file."""
+    import jsonschema
     if not check_files_exist([json_file, schema]):
         return False, None
     with open(json_file, 'r') as f:
@@ -184,12 +428,89 @@ def validate(json_file, schema):
         return False, None
 
 def load_json(json_file, schema="Schema/OskiSchema.json"):
-    """Validate json file and convert unicode values to ascii."""
+    """Validate json file and convert unicode values to ascii.
+
+    Validated parameters are cached next to json_file, keyed on the hash of
+    both files, so unchanged parameters skip validation on the next start.
+    """
+    key = files_digest([json_file, schema])
+    cache_file = os.path.join(os.path.dirname(json_file),
+                              "." + os.path.basename(json_file) + ".validated")
+    params = read_config_cache(cache_file, key)
+    if params is not None:
+        return True, params
     [success, params] = validate(json_file, schema)
     if success:
         params = uni2ascii(params)
+        write_config_cache(cache_file, key, params)
     return success, params
 
+def files_digest(files):
+    """SHA-1 over the contents of files, None if any is missing."""
+    sha = hashlib.sha1()
+    for name in files:
+        try:
+            with open(name, 'rb') as f:
+                sha.update(f.read())
+        except IOError:  return None
+        sha.update("\0")
+    return sha.hexdigest()
+
+def read_config_cache(cache_file, key):
+    """Return cached parameters stored under key, else None."""
+    if key is None:  return None
+    try:
+        with open(cache_file, 'rb') as f:
+            cached_key, params = cPickle.load(f)
+    except Exception:  return None
+    return params if cached_key == key else None
+
+def write_config_cache(cache_file, key, params):
+    """Cache validated parameters, skipped if the directory is read-only."""
+    if key is None:  return
+    try:
+        handle, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_file) or
+                                       os.curdir)
+        with os.fdopen(handle, 'wb') as f:
+            cPickle.dump((key, params), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, cache_file)
+    except (IOError, OSError):  pass
+
+def date_window(last_run, date_restrict=""):
+    """dateRestrict covering the days since last_run, plus a day of margin
+    for late indexing, never wider than the configured date_restrict.
+    """
+    days = int((time.time() - last_run) // 86400) + 2
+    unit_days = {"d": 1, "w": 7, "m": 31, "y": 366}
+    if date_restrict:
+        try:
+            days = min(days, unit_days[date_restrict[0]] *
+                             int(date_restrict[1:]))
+        except (KeyError, ValueError):  return date_restrict
+    return "d%d" % days
+
+def topic_params(params, name, notif_json=""):
+    """Parameters of the named topic. Its database shard, archive path and
+    subscriber list default to per-topic names next to the shared ones.
+    """
+    for topic in get_value(params, "topics", []):
+        if topic["name"] == name:  break
+    else:
+        raise KeyError("Oski: No topic named %s" % name)
+    settings = dict(topic)
+    db_dir = os.path.dirname(get_value(params, "db_file", ArticleDB.DB_NAME))
+    settings.setdefault("db_file", os.path.join(db_dir, "%s.db" % name))
+    if "archiver" in params.keys():
+        settings.setdefault("save_path",
+                            os.path.join(params["archiver"]["save_path"],
+                                         name))
+    if notif_json:
+        subscr_dir, subscr_name = os.path.split(notif_json["subscr_file"])
+        settings.setdefault("subscr_file",
+                            os.path.join(subscr_dir, "%s-%s" %
+                                         (name, subscr_name)))
+    return settings
+
 def get_value(json_dict, key, default=""):
     """Try to fetch optional parameters from input json dict."""
     try:
@@ -198,31 +519,71 @@ def get_value(json_dict, key, default=""):
 
 
 def main(args):
-    # Determine if database previously populated
-    do_init_searches = not os.path.exists(ArticleDB.DB_NAME)
+    [success, params] = load_json(args.oskifile)
+    if not success:
+        sys.exit(1)
+    if "topics" in params.keys():
+        from Topics import TopicRunner
+        runner = TopicRunner(args.oskifile, args.keys, args.notifyparams)
+        for oski in runner.oskis:
+            oski.streaming = oski.streaming or args.stream
+        if args.command == "serve":
+            runner.serve()
+            return
+        if args.command == "drain":
+            print "Oski: Tried %d archive jobs" % runner.drain()
+        elif args.command == "verify":
+            for topic, counts in sorted(runner.verify().items()):
+                print "Oski: Verified %s %s" % (topic, counts)
+        else:
+            runner.run()
+        METRICS.export()
+        return
+    if args.command == "serve":
+        from Scheduler import OskiServer
+        OskiServer(args.oskifile, args.keys, args.notifyparams).serve()
+        return
+    if args.command == "drain":
+        oski = Oski(args.oskifile, args.keys, args.notifyparams)
+        print "Oski: Tried %d archive jobs" % oski.drain()
+        METRICS.export()
+        return
+    if args.command == "verify":
+        oski = Oski(args.oskifile, args.keys, args.notifyparams)
+        print "Oski: Verified %s" % oski.verify()
+        METRICS.export()
+        return
 
     # Hire Oski
     oski = Oski(args.oskifile, args.keys, args.notifyparams)
+    oski.streaming = oski.streaming or args.stream
         
-    # Search for articles
-    if do_init_searches:
-        new_articles = oski.initial_search()
-    else:
-        new_articles = oski.recent_search()
+    # Search for articles, each query picks up where its last run ended,
+    # then add to database, notify and archive
+    oski.run()
 
-    # Add to datebase and notify
-    oski.oski_update(new_articles)
+    if oski.cache:
+        print "Oski: Search cache %s" % oski.cache.stats
+    METRICS.export()
     
     return
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument("command", type=str, nargs="?", default="run",
+        choices=["run", "serve", "drain", "verify"],
+        help="run the pipeline once, serve on each query's schedule, "
+             "retry queued archive jobs, or verify archived pdfs")
     parser.add_argument("-op", "--oskifile", type=str, required=True,
         help="specify parameter file for Oski")
     parser.add_argument("-kf", "--keyfile", type=str, required=True,
         help="specify file containing search engine keys")
     parser.add_argument("-np", "--notifyfile", type=str,
         help="specify file containing email notification parameters")
+    parser.add_argument("--stream", action="store_true",
+        help="flag to stream results through the pipeline stages")
+    parser.add_argument("--profile", type=str,
+        help="specify file to write a cProfile of this run to")
     args = parser.parse_args()
 
     if not check_files_exist([args.oskifile, args.keyfile]):
@@ -233,10 +594,20 @@ if __name__ == "__main__":
 
     with open(args.keyfile, 'r') as f:
         args.keys = json.load(f)
-    with open(args.notifyfile, 'r') as f:
-        args.notifyparams = json.load(f)
-        if "pwd" not in args.notifyparams.keys():
-            prompt = "%s password: " % args.notifyparams["user"]
-            args.notifyparams["pwd"] = getpass(prompt)
-
-    main(args)
\ No newline at end of file
+    args.notifyparams = ""
+    if args.notifyfile and os.path.exists(args.notifyfile):
+        with open(args.notifyfile, 'r') as f:
+            args.notifyparams = json.load(f)
+            if "pwd" not in args.notifyparams.keys():
+                prompt = "%s password: " % args.notifyparams["user"]
+                args.notifyparams["pwd"] = getpass(prompt)
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(main, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            print "Oski: Wrote profile to %s" % args.profile
+    else:
+        main(args)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Batches new articles into digests for subscribers."""
+
+import argparse
+import threading
+import time
+from ArticleDB import ArticleDB
+from Metrics import METRICS
+from Notifier import Email, Subscriber, read_subscribers
+
+
+class Outbox:
+    """Collects new articles in the database's outbox, and mails them as
+    digests on each subscriber's schedule.
+
+    Subscribers with the same schedule and topics form a group, which
+    keeps its place in the outbox. Due groups whose digests hold the same
+    articles share one rendered email, so rendering and sending grow with
+    the number of distinct digests rather than subscribers. Entries every
+    group has seen, or older than MAX_AGE, are pruned.
+    """
+    # Seconds articles wait in the outbox for groups that never come due
+    MAX_AGE = 7 * 86400
+
+    def __init__(self, db, notifier, subscribers, topic=None,
+                 render=None, subject="New Articles!"):
+        self.db = db
+        self.notifier = notifier
+        self.topic = topic
+        self.render = render
+        self.subject = subject
+        self.groups = {}
+        for subscriber in subscribers:
+            self.groups.setdefault(subscriber.key, []).append(subscriber)
+
+    def add(self, articles, lock=None):
+        """Queue newly added articles for every group."""
+        if not articles or not self.groups:  return
+        with lock or threading.Lock():
+            self.db.outbox_add([article.title for article in articles])
+
+    def matches(self, article, topics):
+        return not topics or self.topic in topics or \
+               article.query_id in topics
+
+    def due(self, cursors, now):
+        """Return {group key: outbox id} of groups due a digest, with the
+        last outbox id each has seen.
+        """
+        due = {}
+        for key, subscribers in self.groups.items():
+            last_id, sent = cursors.get(key, (0, 0))
+            if now - sent >= Subscriber.SCHEDULES[subscribers[0].schedule]:
+                due[key] = last_id
+        return due
+
+    def digests(self, due, pending):
+        """Group due subscribers by the articles of their digest. Return
+        {article ids: (articles, group keys, addresses)}, and the due
+        groups with nothing new.
+        """
+        digests, idle = {}, []
+        for key, last_id in due.items():
+            topics = self.groups[key][0].topics
+            articles = [article for outbox_id, article in pending
+                        if outbox_id > last_id and
+                        self.matches(article, topics)]
+            if not articles:
+                idle.append(key)
+                continue
+            ids = tuple(article.id for article in articles)
+            digest = digests.setdefault(ids, (articles, [], []))
+            digest[1].append(key)
+            digest[2].extend(subscriber.address
+                             for subscriber in self.groups[key])
+        return digests, idle
+
+    def flush(self, lock=None, now=None):
+        """Mail every due digest. Return the number of digests sent.
+
+        Database access is serialized through lock, if given. Mail is sent
+        outside of it.
+        """
+        lock = lock or threading.Lock()
+        now = time.time() if now is None else now
+        with lock:
+            cursors = self.db.digest_cursors()
+            due = self.due(cursors, now)
+            pending = self.db.outbox_since(min(due.values())) if due else []
+        if not pending:  return 0
+        last_id = pending[-1][0]
+
+        digests, idle = self.digests(due, pending)
+        sent_keys, num_sent = [], 0
+        for articles, keys, recipients in digests.values():
+            html = self.render(articles) if self.render else ""
+            if not html:  continue
+            email = Email(self.notifier.user, "", self.subject, html,
+                          use_html=True)
+            stats = self.notifier.mail_subscribers(email, recipients)
+            print "Oski: Mailed %d articles to %s %s" % \
+                  (len(articles), "/".join(sorted(keys)), stats)
+            # Keep the articles for the next try if nobody got them
+            if stats.sent or not stats.failed:
+                sent_keys += keys
+                num_sent += 1
+        METRICS.inc("oski_digests_total", len(digests))
+
+        with lock:
+            if sent_keys:
+                self.db.set_digest_cursors(sent_keys, last_id, now)
+            if idle:
+                self.db.set_digest_cursors(idle, last_id)
+            moved = set(sent_keys + idle)
+            seen = [last_id if key in moved else cursors.get(key, (0, 0))[0]
+                    for key in self.groups]
+            self.db.prune_outbox(min(seen), now - self.MAX_AGE)
+        return num_sent
+
+    def status(self, now=None):
+        """Return [(group key, subscribers, pending articles, seconds until
+        due)].
+        """
+        now = time.time() if now is None else now
+        cursors = self.db.digest_cursors()
+        pending = self.db.outbox_since(min(
+            [cursors.get(key, (0, 0))[0] for key in self.groups] or [0]))
+        rows = []
+        for key, subscribers in sorted(self.groups.items()):
+            last_id, sent = cursors.get(key, (0, 0))
+            topics = subscribers[0].topics
+            count = len([article for outbox_id, article in pending
+                         if outbox_id > last_id and
+                         self.matches(article, topics)])
+            wait = sent + Subscriber.SCHEDULES[subscribers[0].schedule] - now
+            rows.append((key, len(subscribers), count, max(0, wait)))
+        return rows
+
+
+def main(args):
+    with open(args.subscrfile, 'r') as f:
+        subscribers = read_subscribers(f)
+    outbox = Outbox(ArticleDB(args.dbfile), None, subscribers, args.topic)
+    print "%-40s %11s %8s %8s" % ("group", "subscribers", "pending", "due in")
+    for key, count, pending, wait in outbox.status():
+        print "%-40s %11d %8d %7ds" % (key, count, pending, wait)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-sf", "--subscrfile", type=str, required=True,
+        help="specify file listing subscribers")
+    parser.add_argument("-db", "--dbfile", type=str, default=ArticleDB.DB_NAME,
+        help="specify database file")
+    parser.add_argument("-t", "--topic", type=str,
+        help="specify topic of the database, if any")
+    args = parser.parse_args()
+
+    main(args)
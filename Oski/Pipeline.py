@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Runs a single Oski pass as a streaming pipeline."""
+
+import threading
+import time
+from Queue import Queue, Empty
+from Metrics import METRICS
+
+
+class StreamingPipeline:
+    """Streams each page of search results through filtering and storing,
+    then archiving, while the searches are still paging.
+
+    Stages run in their own threads, connected by bounded queues. A full
+    queue blocks the stage feeding it, so searching never runs far ahead
+    of archiving. Stages take turns on the database through db_lock.
+    Subscribers get a single email once the pipeline drains.
+    """
+    DEFAULT_QUEUE_SIZE = 16
+
+    def __init__(self, oski, queue_size=DEFAULT_QUEUE_SIZE):
+        self.oski = oski
+        self.db_lock = threading.Lock()
+        self.pages = Queue(queue_size)
+        self.to_archive = Queue(queue_size)
+        self.added = []
+        self.started = None
+        # Seconds from start until the first article was archived
+        self.first_archived = None
+
+    ## Stages
+    def search_stage(self, searches):
+        oski = self.oski
+        while True:
+            args = searches.get()
+            if args is None:  return
+            try:
+                newest = []
+                for page in oski.searcher.query_pages(*args):
+                    newest = newest or page
+                    self.pages.put(page)
+                with self.db_lock:
+                    oski.record_crawl(args, self.started, newest)
+            except Exception as e:
+                print 'Oski: Search FAILED on "%s": %s' % (args[0], e)
+
+    def store_stage(self):
+        oski = self.oski
+        while True:
+            page = self.pages.get()
+            if page is None:  break
+            try:
+                with self.db_lock:
+                    added = oski.store(oski.filter_results(page))
+            except Exception as e:
+                print "Oski: Store FAILED: %s" % e
+                continue
+            self.added += added
+            if added and oski.save_pdfs:
+                self.to_archive.put(added)
+        self.to_archive.put(None)
+
+    def archive_stage(self):
+        oski = self.oski
+        batch_size = oski.archiver.workers * 4
+        done = False
+        while not done:
+            added = self.to_archive.get()
+            if added is None:  return
+            # Fold in what was stored meanwhile, to keep every worker busy
+            while len(added) < batch_size:
+                try:
+                    more = self.to_archive.get_nowait()
+                except Empty:  break
+                if more is None:
+                    done = True
+                    break
+                added = added + more
+            try:
+                outcomes = oski.archive(added, store_archived=False)
+                with self.db_lock:
+                    oski.store_archived(outcomes)
+            except Exception as e:
+                print "Oski: Archive FAILED: %s" % e
+                outcomes = []
+            if self.first_archived is None and \
+               any(outcome.success for outcome in outcomes):
+                self.first_archived = time.time() - self.started
+                METRICS.observe("oski_first_archive_seconds",
+                                self.first_archived)
+
+    def run(self):
+        """Search, store and archive every query concurrently, then notify.
+        Return the articles added.
+        """
+        oski = self.oski
+        self.started = time.time()
+        searches = Queue()
+        for query in oski.queries:
+            searches.put(oski.search_args(query))
+        num_searchers = max(1, min(oski.max_in_flight, len(oski.queries)))
+        searchers = [threading.Thread(target=self.search_stage,
+                                      args=(searches, ))
+                     for _ in range(num_searchers)]
+        stages = [threading.Thread(target=self.store_stage)]
+        if oski.save_pdfs:
+            stages.append(threading.Thread(target=self.archive_stage))
+        for thread in searchers:
+            searches.put(None)
+        for thread in searchers + stages:
+            thread.daemon = True
+            thread.start()
+
+        for thread in searchers:
+            thread.join()
+        self.pages.put(None)
+        for thread in stages:
+            thread.join()
+        oski.notify(self.added)
+
+        secs = time.time() - self.started
+        print "Oski: Streamed %d new articles in %.2fs%s" % \
+              (len(self.added), secs, "" if self.first_archived is None else
+               ", first archived after %.2fs" % self.first_archived)
+        METRICS.log("oski_stream", secs=round(secs, 6),
+                    added=len(self.added),
+                    first_archived=self.first_archived)
+        return self.added
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Scores and ranks search results before they are archived."""
+
+import argparse
+import math
+import time
+from datetime import datetime
+from ArticleDB import ArticleDB
+from Deduplicator import WORD_RE
+from Metrics import METRICS
+
+
+def stem(word):
+    """Fold possessives and plurals, ex: "Cal's" and "kickers"."""
+    word = word.replace("'", "")
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+    return word
+
+def words(text):
+    return [stem(word) for word in WORD_RE.findall((text or "").lower())]
+
+def term_counts(text):
+    counts = {}
+    for word in words(text):
+        counts[word] = counts.get(word, 0) + 1
+    return counts
+
+def published_age_days(published, now):
+    """Days from an ISO date to now, None if unknown."""
+    try:
+        stamp = time.mktime(datetime.strptime(published, "%Y-%m-%d")
+                            .timetuple())
+    except (TypeError, ValueError):  return None
+    return max(0.0, (now - stamp) / 86400.0)
+
+
+class Ranker:
+    """Scores a batch of search results from 0 to 1, and splits it into
+    results to archive now, to archive later and to skip.
+
+    The score weighs three signals:
+        terms: hits of the result's query terms in its title and snippet,
+               each term weighted by how rare it is across the batch
+        reputation: the mean score of the source's earlier articles and
+                    how often archiving them succeeded, from ArticleDB
+        recency: halves every half_life_days since publication
+    Term statistics are gathered over the whole batch in one pass, and
+    reputation in one query per batch.
+    """
+    ARCHIVE = "archive"
+    DEFER = "defer"
+    SKIP = "skip"
+    WEIGHTS = {"terms": 0.6, "reputation": 0.25, "recency": 0.15}
+    # Title hits count this many times a snippet hit
+    TITLE_WEIGHT = 2.0
+    # Term frequency saturation, a second hit adds less than the first
+    SATURATION = 0.5
+    # Score assumed for sources and dates never seen, and how many
+    # articles of history it takes to outweigh it
+    PRIOR = 0.5
+    PRIOR_WEIGHT = 5.0
+
+    def __init__(self, db, queries=(), archive_at=0.4, defer_at=0.25,
+                 weights=None, half_life_days=30, defer_secs=0, kind="pdf"):
+        self.db = db
+        self.archive_at = archive_at
+        self.defer_at = defer_at
+        self.weights = dict(self.WEIGHTS, **(weights or {}))
+        self.half_life_days = half_life_days
+        # Deferred jobs are first due this long after being queued
+        self.defer_secs = defer_secs
+        self.kind = kind
+        # Terms every result of a query must hold, on top of its words
+        self.exact_terms = dict(
+            (query["search"], query.get("options", {}).get("exact_terms", ""))
+            for query in queries)
+
+    def query_terms(self, query_id):
+        terms = words(query_id) + words(self.exact_terms.get(query_id, ""))
+        return sorted(set(terms))
+
+    def term_scores(self, articles):
+        """Score query term hits of every article against the batch."""
+        titles = [term_counts(article.title) for article in articles]
+        snippets = [term_counts(article.snippet) for article in articles]
+        terms = dict((query_id, self.query_terms(query_id)) for query_id in
+                     set(article.query_id for article in articles))
+        # Documents holding each query term, across the whole batch
+        num_docs = dict((term, 0) for query_terms in terms.values()
+                        for term in query_terms)
+        all_terms = set(num_docs.keys())
+        for title, snippet in zip(titles, snippets):
+            for term in all_terms.intersection(title).union(
+                         all_terms.intersection(snippet)):
+                num_docs[term] += 1
+        idf = dict((term, math.log(1.0 + (len(articles) + 1.0) /
+                                   (count + 0.5)))
+                   for term, count in num_docs.items())
+        # Terms no result holds tell results apart no more than they do
+        # in a batch of one, so they do not count against any result
+        terms = dict((query_id, [term for term in query_terms
+                                 if num_docs[term]])
+                     for query_id, query_terms in terms.items())
+
+        sat = lambda count: count / (count + self.SATURATION)
+        best = (self.TITLE_WEIGHT + 1.0) * sat(1.0)
+        scores = []
+        for article, title, snippet in zip(articles, titles, snippets):
+            query_terms = terms[article.query_id]
+            total = sum(idf[term] for term in query_terms)
+            if not total:
+                scores.append(0.0)
+                continue
+            hits = sum(idf[term] * (self.TITLE_WEIGHT *
+                                    sat(title.get(term, 0)) +
+                                    sat(snippet.get(term, 0)))
+                       for term in query_terms)
+            scores.append(min(1.0, hits / (total * best)))
+        return scores
+
+    def reputations(self, articles):
+        """Return {source: reputation} of every source in articles."""
+        sources = list(set(article.source for article in articles
+                           if article.source))
+        history = self.db.source_history(sources, self.kind)
+        reputations = {}
+        for source in sources:
+            scored, total, done, dead = history.get(source, (0, 0.0, 0, 0))
+            relevance = (total + self.PRIOR * self.PRIOR_WEIGHT) / \
+                        (scored + self.PRIOR_WEIGHT)
+            archived = (done + 1.0) / (done + dead + 2.0)
+            reputations[source] = (relevance + archived) / 2.0
+        return reputations
+
+    def recency(self, published, now):
+        age = published_age_days(published, now)
+        if age is None:  return self.PRIOR
+        return 0.5 ** (age / self.half_life_days)
+
+    @METRICS.timed("oski_stage_seconds", stage="rank")
+    def score(self, articles, now=None):
+        """Set the score of each article. Return articles, best first."""
+        if not articles:  return []
+        now = time.time() if now is None else now
+        terms = self.term_scores(articles)
+        reputations = self.reputations(articles)
+        # Dates repeat across results, so parse each once
+        recency = dict((published, self.recency(published, now)) for
+                       published in set(article.published
+                                        for article in articles))
+        weights = self.weights
+        total = sum(weights.values())
+        for article, term_score in zip(articles, terms):
+            article.score = round((weights["terms"] * term_score +
+                weights["reputation"] * reputations.get(article.source,
+                                                        self.PRIOR) +
+                weights["recency"] * recency[article.published]) / total, 4)
+        return sorted(articles, key=lambda article: -article.score)
+
+    def decide(self, article):
+        if article.score is None or article.score >= self.archive_at:
+            return self.ARCHIVE
+        return self.DEFER if article.score >= self.defer_at else self.SKIP
+
+    def split(self, articles):
+        """Return {decision: articles}, each list in the input order."""
+        decisions = dict((decision, []) for decision in
+                         [self.ARCHIVE, self.DEFER, self.SKIP])
+        for article in articles:
+            decisions[self.decide(article)].append(article)
+        for decision, chosen in decisions.items():
+            METRICS.inc("oski_ranked_total", len(chosen), decision=decision)
+        return decisions
+
+
+def main(args):
+    """Score stored articles as if they were new, ex: to tune thresholds."""
+    db = ArticleDB(args.dbfile)
+    ranker = Ranker(db, archive_at=args.archive_at, defer_at=args.defer_at)
+    articles = ranker.score(db.get_articles())
+    for article in articles[:args.limit]:
+        print "%.3f  %-7s %s\n              %s" % \
+              (article.score, ranker.decide(article), article.title,
+               article.source)
+    for decision, chosen in sorted(ranker.split(articles).items()):
+        print "Ranker: %d %s" % (len(chosen), decision)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-db", "--dbfile", type=str, default=ArticleDB.DB_NAME,
+        help="specify database file")
+    parser.add_argument("-a", "--archive-at", type=float, default=0.4,
+        help="specify lowest score archived right away")
+    parser.add_argument("-d", "--defer-at", type=float, default=0.25,
+        help="specify lowest score archived later, lower ones are skipped")
+    parser.add_argument("-n", "--limit", type=int, default=20,
+        help="specify number of top articles to list")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""Extracts the readable article body from a web page."""
+
+import argparse
+import re
+from cgi import escape
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
+
+
+# Content of these tags is never part of the article
+SKIP_TAGS = set(["script", "style", "noscript", "iframe", "svg", "form",
+                 "button", "select", "textarea", "template", "head"])
+VOID_TAGS = set(["area", "base", "br", "col", "embed", "hr", "img", "input",
+                 "link", "meta", "param", "source", "track", "wbr"])
+# Starting one of these implicitly closes an open <p>
+CLOSES_P = set(["p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol",
+                "dl", "table", "article", "section", "main", "aside", "nav",
+                "header", "footer", "blockquote", "pre", "figure", "hr",
+                "form"])
+# Blocks copied into the extracted article
+KEEP_TAGS = set(["p", "h1", "h2", "h3", "h4", "blockquote", "li", "pre"])
+POSITIVE_RE = re.compile(r"article|body|content|entry|main|page|post|story|"
+                         r"text|blog", re.I)
+NEGATIVE_RE = re.compile(r"comment|foot|footer|nav|menu|sidebar|side|ad-|ads|"
+                         r"advert|promo|related|share|social|sponsor|widget|"
+                         r"banner|masthead|meta|outbrain|taboola|popup", re.I)
+TAG_SCORES = {"article": 10, "main": 10, "div": 5, "section": 3,
+              "pre": 3, "td": 3, "blockquote": 3, "form": -3, "ul": -3,
+              "ol": -3, "li": -3, "nav": -10, "aside": -10, "footer": -10,
+              "header": -5, "h1": -5, "h2": -5, "h3": -5}
+MIN_PARAGRAPH = 25
+
+
+class Node:
+    """Element of a lightweight document tree."""
+    def __init__(self, tag, attrs=None, parent=None):
+        self.tag = tag
+        self.attrs = dict(attrs or [])
+        self.parent = parent
+        self.children = []
+        self.score = None
+
+    def text(self):
+        parts = []
+        for child in self.children:
+            parts.append(child if isinstance(child, unicode) else child.text())
+        return u"".join(parts)
+
+    def iter(self, tags=None):
+        """Yield descendant elements, depth first."""
+        for child in self.children:
+            if isinstance(child, unicode):  continue
+            if tags is None or child.tag in tags:
+                yield child
+            for node in child.iter(tags):
+                yield node
+
+    def link_density(self):
+        length = len(self.text())
+        if not length:  return 0.0
+        links = sum(len(node.text()) for node in self.iter(["a"]))
+        return float(links) / length
+
+    def class_weight(self):
+        names = u"%s %s" % (self.attrs.get("class") or "",
+                            self.attrs.get("id") or "")
+        weight = 0
+        if NEGATIVE_RE.search(names):  weight -= 25
+        if POSITIVE_RE.search(names):  weight += 25
+        return weight
+
+
+class TreeBuilder(HTMLParser):
+    """Builds a Node tree, tolerating unclosed and stray tags."""
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.root = Node("document")
+        self.stack = [self.root]
+        # Tag whose content is being skipped, and its nesting depth
+        self.skip_tag = None
+        self.skip = 0
+        self.title = u""
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self.in_title = True
+        if self.skip:
+            if tag == self.skip_tag:
+                self.skip += 1
+            return
+        self.close_implied(tag)
+        if tag in SKIP_TAGS:
+            self.skip_tag, self.skip = tag, 1
+            return
+        node = Node(tag, attrs, self.stack[-1])
+        self.stack[-1].children.append(node)
+        if tag not in VOID_TAGS:
+            self.stack.append(node)
+
+    def close_implied(self, tag):
+        """Apply HTML's implied end tags for <p> and <li>."""
+        closes = {"li": "li"}.get(tag, "p" if tag in CLOSES_P else None)
+        if closes is None:  return
+        for idx in range(len(self.stack) - 1, 0, -1):
+            open_tag = self.stack[idx].tag
+            if open_tag == closes:
+                del self.stack[idx:]
+                return
+            # Lists and tables scope the elements inside them
+            if open_tag in ("ul", "ol", "table", "div", "article"):
+                return
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.skip and tag not in SKIP_TAGS:
+            self.stack[-1].children.append(Node(tag, attrs, self.stack[-1]))
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self.in_title = False
+        if self.skip:
+            if tag == self.skip_tag:
+                self.skip -= 1
+            return
+        # Close up to the matching open tag, ignore stray end tags
+        for idx in range(len(self.stack) - 1, 0, -1):
+            if self.stack[idx].tag == tag:
+                del self.stack[idx:]
+                return
+
+    def add_text(self, text):
+        if self.in_title:
+            self.title += text
+        if not self.skip:
+            self.stack[-1].children.append(text)
+
+    def handle_data(self, data):
+        self.add_text(data if isinstance(data, unicode) else
+                      data.decode("utf-8", "ignore"))
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.add_text(unichr(name2codepoint[name]))
+
+    def handle_charref(self, name):
+        try:
+            code = int(name[1:], 16) if name[0] in "xX" else int(name)
+            self.add_text(unichr(code))
+        except (ValueError, OverflowError):  pass
+
+
+class ReadableArticle:
+    """Title, cleaned HTML body and plain text of a page's article."""
+    def __init__(self, title, html, text):
+        self.title = title
+        self.html = html
+        self.text = text
+
+    def document(self, url=""):
+        """Standalone HTML document of the article."""
+        return (u'<!DOCTYPE html><html><head><meta charset="utf-8">'
+                u'<title>%s</title></head><body><h1>%s</h1>'
+                u'<p><a href="%s">%s</a></p>%s</body></html>' %
+                (escape(self.title), escape(self.title),
+                 escape(url, quote=True), escape(url), self.html))
+
+
+def normalize_space(text):
+    return u" ".join(text.split())
+
+def score_candidates(root):
+    """Score parents of paragraphs, in the style of Arc90 readability."""
+    candidates = []
+    for para in root.iter(["p", "pre", "td"]):
+        text = normalize_space(para.text())
+        if len(text) < MIN_PARAGRAPH:  continue
+        score = 1 + text.count(",") + min(len(text) // 100, 3)
+        for level, node in enumerate([para.parent, para.parent and
+                                      para.parent.parent]):
+            if node is None or node.tag == "document":  continue
+            if node.score is None:
+                node.score = TAG_SCORES.get(node.tag, 0) + node.class_weight()
+                candidates.append(node)
+            node.score += score if level == 0 else score / 2.0
+    for node in candidates:
+        node.score *= 1 - node.link_density()
+    return candidates
+
+def extract(html):
+    """Return the ReadableArticle of an HTML page."""
+    builder = TreeBuilder()
+    try:
+        builder.feed(html)
+        builder.close()
+    except Exception:
+        # HTMLParser gives up on badly broken markup, keep what was parsed
+        pass
+    root = builder.root
+    candidates = score_candidates(root)
+    best = max(candidates, key=lambda node: node.score) if candidates \
+           else root
+
+    blocks, texts = [], []
+    for node in best.iter(KEEP_TAGS):
+        # Nested blocks are covered by their outermost kept ancestor
+        parent, nested = node.parent, False
+        while parent is not None and parent is not best:
+            if parent.tag in KEEP_TAGS:
+                nested = True
+                break
+            parent = parent.parent
+        text = normalize_space(node.text())
+        if nested or not text:  continue
+        if node.tag == "p" and node.link_density() > 0.5:  continue
+        blocks.append(u"<%s>%s</%s>" % (node.tag, escape(text), node.tag))
+        texts.append(text)
+    if not blocks:
+        text = normalize_space(best.text())
+        blocks, texts = [u"<p>%s</p>" % escape(text)], [text]
+    return ReadableArticle(normalize_space(builder.title), u"".join(blocks),
+                           u"\n\n".join(texts))
+
+
+def main(args):
+    with open(args.htmlfile, 'r') as f:
+        article = extract(f.read().decode("utf-8", "ignore"))
+    print article.title.encode("utf-8")
+    print
+    print article.text.encode("utf-8")
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("htmlfile", type=str,
+        help="specify html file to extract article from")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""Runs Oski as a long-lived server, searching each query on its own
+schedule and keeping clients, connections and validated parameters warm.
+"""
+
+import os
+import random
+import threading
+import time
+from Queue import Queue, Empty
+from Oski import Oski, get_value
+from Metrics import METRICS
+
+
+def file_mtimes(files):
+    """Map each existing file to its modification time."""
+    return dict((name, os.path.getmtime(name)) for name in files
+                if os.path.exists(name))
+
+
+class OskiServer:
+    """Schedules each query on its own interval, with jitter.
+
+    Search, store, notify and archive run as separate stages connected by
+    bounded queues, so one query can be archived while another is searched.
+    Parameter files are reloaded when they change on disk. Stages take
+    turns on the database connection through db_lock. While idle, the
+    archive stage retries queued archive jobs. Given a topic, serves only
+    that topic's queries, see Topics.TopicRunner.
+    """
+    DEFAULT_INTERVAL = 3600
+    DEFAULT_JITTER = 0.1
+    DRAIN_INTERVAL = 60
+
+    def __init__(self, oski_file, keys, notif_json="", poll_secs=5,
+                 queue_size=16, topic=None, searcher=None):
+        self.oski_file = oski_file
+        self.keys = keys
+        self.notif_json = notif_json
+        self.poll_secs = poll_secs
+        self.topic = topic
+        # Shared with other topics' servers, kept across reloads
+        self.searcher = searcher
+
+        self.oski = Oski(oski_file, keys, notif_json, topic, searcher)
+        self.mtimes = file_mtimes(self.oski.watch_files)
+
+        self.next_run = {}
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.next_drain = 0
+
+        self.searches = Queue()
+        self.found = Queue(queue_size)
+        self.to_notify = Queue(queue_size)
+        self.to_archive = Queue(queue_size)
+        self.threads = []
+
+    def interval(self, oski, query):
+        """Seconds until query runs again, with random jitter."""
+        searcher = oski.params["searcher"]
+        secs = get_value(query, "interval",
+                         get_value(searcher, "interval",
+                                   self.DEFAULT_INTERVAL))
+        jitter = get_value(searcher, "jitter", self.DEFAULT_JITTER)
+        return secs * (1 + random.uniform(-jitter, jitter))
+
+    def reload(self):
+        """Rebuild Oski if any parameter file changed. A file that fails
+        validation keeps the previous parameters running.
+        """
+        mtimes = file_mtimes(self.oski.watch_files)
+        if mtimes == self.mtimes:  return False
+        self.mtimes = mtimes
+        try:
+            oski = Oski(self.oski_file, self.keys, self.notif_json,
+                        self.topic, self.searcher)
+        except SystemExit:
+            print "OskiServer: Reload FAILED, keeping previous parameters"
+            return False
+        self.mtimes = file_mtimes(oski.watch_files)
+        self.oski = oski
+        # New queries run right away, removed ones are dropped
+        searches = set(query["search"] for query in oski.queries)
+        for search in list(self.next_run.keys()):
+            if search not in searches:
+                del self.next_run[search]
+        print "OskiServer: Reloaded parameters"
+        return True
+
+    def schedule(self):
+        """Queue every query that is due and not already running."""
+        now = time.time()
+        oski = self.oski
+        for query in oski.queries:
+            search = query["search"]
+            with self.lock:
+                if search in self.in_flight:  continue
+                if self.next_run.get(search, 0) > now:  continue
+                self.in_flight.add(search)
+                self.next_run[search] = now + self.interval(oski, query)
+            self.searches.put((oski, query))
+
+    ## Stages
+    def search_stage(self):
+        while True:
+            oski, query = self.searches.get()
+            if oski is None:  return
+            try:
+                started = time.time()
+                with self.db_lock:
+                    args = oski.search_args(query)
+                with METRICS.timer("oski_stage_seconds", log=True,
+                                   stage="search"):
+                    results = oski.searcher.query(*args)
+                with self.db_lock:
+                    oski.record_crawl(args, started, results)
+                self.found.put((oski, results))
+            except Exception as e:
+                print 'OskiServer: Search FAILED on "%s": %s' % \
+                      (query["search"], e)
+            finally:
+                with self.lock:
+                    self.in_flight.discard(query["search"])
+
+    def store_stage(self):
+        while True:
+            oski, results = self.found.get()
+            if oski is None:  break
+            try:
+                with self.db_lock:
+                    added = oski.store(oski.filter_results(results))
+            except Exception as e:
+                print "OskiServer: Store FAILED: %s" % e
+                continue
+            if added:
+                self.to_notify.put((oski, added))
+                self.to_archive.put((oski, added))
+        self.to_notify.put((None, None))
+        self.to_archive.put((None, None))
+
+    def notify_stage(self):
+        while True:
+            try:
+                oski, added = self.to_notify.get(timeout=self.poll_secs)
+            except Empty:
+                # Send hourly and daily digests that came due meanwhile
+                self.flush_digests()
+                continue
+            if oski is None:  return
+            # Fold everything stored meanwhile into the same email
+            done = False
+            while not done:
+                try:
+                    more_oski, more = self.to_notify.get_nowait()
+                except Empty:  break
+                if more_oski is None:
+                    done = True
+                else:
+                    oski, added = more_oski, added + more
+            try:
+                oski.notify(added, self.db_lock)
+            except Exception as e:
+                print "OskiServer: Notify FAILED: %s" % e
+            if done:  return
+
+    def flush_digests(self):
+        outbox = self.oski.outbox
+        if not outbox:  return
+        try:
+            outbox.flush(self.db_lock)
+        except Exception as e:
+            print "OskiServer: Digest FAILED: %s" % e
+
+    def archive_stage(self):
+        while True:
+            try:
+                oski, added = self.to_archive.get(timeout=self.poll_secs)
+            except Empty:
+                self.drain()
+                continue
+            if oski is None:  return
+            try:
+                outcomes = oski.archive(added, store_archived=False)
+                with self.db_lock:
+                    oski.store_archived(outcomes)
+            except Exception as e:
+                print "OskiServer: Archive FAILED: %s" % e
+
+    def drain(self):
+        """Work through a batch of due archive jobs while no new articles
+        wait to be archived. Checks again after DRAIN_INTERVAL once no jobs
+        are due.
+        """
+        if time.time() < self.next_drain:  return
+        oski = self.oski
+        tried = 0
+        try:
+            tried = oski.drain(limit=oski.archiver.workers * 2,
+                               lock=self.db_lock) if oski.archiver else 0
+        except Exception as e:
+            print "OskiServer: Drain FAILED: %s" % e
+        if not tried:
+            self.next_drain = time.time() + self.DRAIN_INTERVAL
+
+    def start(self):
+        num_searchers = max(1, self.oski.max_in_flight)
+        targets = [self.search_stage] * num_searchers + \
+                  [self.store_stage, self.notify_stage, self.archive_stage]
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.num_searchers = num_searchers
+
+    def stop(self):
+        """Let queued work drain, then stop every stage."""
+        self.stopping.set()
+        for _ in range(self.num_searchers):
+            self.searches.put((None, None))
+        for thread in self.threads[:self.num_searchers]:
+            thread.join()
+        self.found.put((None, None))
+        for thread in self.threads[self.num_searchers:]:
+            thread.join()
+
+    def serve(self):
+        """Schedule queries until interrupted."""
+        self.start()
+        print "OskiServer: Serving %d queries" % len(self.oski.queries)
+        try:
+            while not self.stopping.is_set():
+                self.reload()
+                self.schedule()
+                METRICS.write_prometheus()
+                self.stopping.wait(self.poll_secs)
+        except KeyboardInterrupt:
+            print "OskiServer: Stopping"
+        self.stop()
+        METRICS.export()
+        return
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""Caches Custom Search API responses on disk."""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from Metrics import METRICS
+
+
+class CacheStats:
+    """Counts cache traffic for a single run."""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    def __repr__(self):
+        return "%d hits, %d misses, %d API calls made, %d API calls saved" % \
+               (self.hits, self.misses, self.api_calls, self.hits)
+
+
+class SearchCache:
+    """Persistent, size-bounded LRU cache of search API responses.
+
+    Entries are keyed on the normalized request parameters and expire after
+    a per-request TTL. In replay_only mode, misses never reach the API and
+    expired entries are still served.
+    """
+    DB_NAME = "SearchCache.db"
+    TABLE_NAME = "Responses"
+
+    def __init__(self, db_name=DB_NAME, ttl=3600, max_bytes=50 * 2**20,
+                 replay_only=False):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replay_only = replay_only
+        self.stats = CacheStats()
+        # Shared by the search threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_name, check_same_thread=False)
+        create_cmd = """CREATE TABLE IF NOT EXISTS %s (
+                        key TEXT PRIMARY KEY,
+                        content TEXT,
+                        stored REAL,
+                        accessed REAL,
+                        size INTEGER);""" % self.TABLE_NAME
+        self.connection.execute(create_cmd)
+        self.connection.execute("""CREATE INDEX IF NOT EXISTS
+            idx_responses_accessed ON %s (accessed)""" % self.TABLE_NAME)
+        self.connection.commit()
+
+    def __del__(self):
+        self.connection.close()
+
+    def get(self, params, ttl=None):
+        """Return cached content for request params, or None."""
+        ttl = self.ttl if ttl is None else ttl
+        key = make_key(params)
+        now = time.time()
+        with self.lock:
+            select_cmd = """SELECT content, stored FROM %s
+                            WHERE key = ?""" % self.TABLE_NAME
+            result = self.connection.execute(select_cmd, (key, )).fetchone()
+            if result is None or (now - result[1] > ttl and
+                                  not self.replay_only):
+                self.stats.misses += 1
+                return None
+            update_cmd = """UPDATE %s SET accessed = ?
+                            WHERE key = ?""" % self.TABLE_NAME
+            self.connection.execute(update_cmd, (now, key))
+            self.connection.commit()
+            self.stats.hits += 1
+        return json.loads(result[0])
+
+    def put(self, params, content):
+        """Store content for request params, evicting old entries."""
+        data = json.dumps(content)
+        now = time.time()
+        with self.lock:
+            insert_cmd = """INSERT OR REPLACE INTO %s
+                            (key, content, stored, accessed, size)
+                            VALUES (?, ?, ?, ?, ?)""" % self.TABLE_NAME
+            self.connection.execute(insert_cmd, (make_key(params), data,
+                                                 now, now, len(data)))
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        """Drop least recently used entries until under max_bytes."""
+        size_cmd = """SELECT COALESCE(SUM(size), 0) FROM %s""" % self.TABLE_NAME
+        total = self.connection.execute(size_cmd).fetchone()[0]
+        if total <= self.max_bytes:  return
+        select_cmd = """SELECT key, size FROM %s
+                        ORDER BY accessed""" % self.TABLE_NAME
+        stale = []
+        for key, size in self.connection.execute(select_cmd):
+            if total <= self.max_bytes:  break
+            stale.append((key, ))
+            total -= size
+        delete_cmd = """DELETE FROM %s WHERE key = ?""" % self.TABLE_NAME
+        self.connection.executemany(delete_cmd, stale)
+
+    def fetch(self, request, params, ttl=None):
+        """Return cached content for params, else execute request.
+
+        In replay_only mode a miss returns an empty page instead.
+        """
+        content = self.get(params, ttl)
+        if content is not None:
+            METRICS.inc("oski_search_cache_total", result="hit")
+            return content
+        METRICS.inc("oski_search_cache_total", result="miss")
+        if self.replay_only:
+            return {}
+        content = request.execute()
+        with self.lock:
+            self.stats.api_calls += 1
+        self.put(params, content)
+        return content
+
+    def export(self, directory):
+        """Write every cached response to directory as <key>.json, ex: to
+        record fixtures for offline benchmarks. Return the number written.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        select_cmd = """SELECT key, content FROM %s""" % self.TABLE_NAME
+        count = 0
+        with self.lock:
+            rows = self.connection.execute(select_cmd).fetchall()
+        for key, content in rows:
+            with open(os.path.join(directory, key + ".json"), 'w') as f:
+                json.dump(json.loads(content), f, indent=2, sort_keys=True)
+            count += 1
+        return count
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM %s" % self.TABLE_NAME)
+            self.connection.commit()
+
+
+def make_key(params):
+    """Hash normalized request parameters, ignoring unset options."""
+    normal = {}
+    for name, value in params.items():
+        if value in ("", None):  continue
+        if isinstance(value, basestring):
+            value = " ".join(value.lower().split())
+        normal[name] = value
+    return hashlib.sha1(json.dumps(normal, sort_keys=True)).hexdigest()
+
+
+def main(args):
+    cache = SearchCache(args.cachefile)
+    if args.clear:
+        cache.clear()
+    count_cmd = """SELECT COUNT(*), COALESCE(SUM(size), 0) FROM %s""" % \
+                SearchCache.TABLE_NAME
+    count, size = cache.connection.execute(count_cmd).fetchone()
+    print "SearchCache: %d responses, %d bytes" % (count, size)
+    if args.export:
+        print "SearchCache: Exported %d responses to %s" % \
+              (cache.export(args.export), args.export)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-cf", "--cachefile", type=str,
+        default=SearchCache.DB_NAME, help="specify cache database file")
+    parser.add_argument("--clear", action="store_true",
+        help="flag to remove all cached responses")
+    parser.add_argument("--export", type=str,
+        help="specify directory to write cached responses to as json")
+    args = parser.parse_args()
+
+    main(args)
@@ -4,36 +4,124 @@
 import argparse
 import json
 import os
+import re
 import sys
-import tldextract
+import threading
+import time
+from functools32 import lru_cache
+from Queue import Queue
 from pprint import pprint
-from googleapiclient.discovery import build
 from urlparse import urlparse
 from Archiver import save_article
+from ArticleDB import Article
+from Metrics import METRICS
 
 
 def to_ascii(text):
     """Convert text input to ascii."""
     return text.encode('ascii', errors='ignore')
 
+# Page metadata holding the publication date, most specific first
+PUBLISHED_TAGS = ("article:published_time", "og:article:published_time",
+                  "datepublished", "dc.date.issued", "pubdate", "date")
+# Google prefixes snippets of dated pages with the date, ex: "Oct 21, 2017 ..."
+SNIPPET_DATE_RE = re.compile(r"^([A-Z][a-z]{2}) (\d{1,2}), (\d{4}) \.\.\. ")
+MONTHS = dict((name, idx + 1) for idx, name in
+              enumerate("Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()))
+
+# Custom Search discovery document, bundled so clients are built without
+# fetching it from Google on every start
+DISCOVERY_DOC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "Discovery", "customsearch.v1.json")
+
+@lru_cache(maxsize=1)
+def extractor():
+    """Offline extractor, uses the public suffix snapshot bundled with
+    tldextract instead of fetching the latest list. Built on first use.
+    """
+    import tldextract
+    return tldextract.TLDExtract(suffix_list_urls=None)
+
+@lru_cache(maxsize=4096)
+def parse_host(host):
+    """Split host name into (subdomain, domain, suffix), cached."""
+    ext = extractor()(host)
+    return ext.subdomain, ext.domain, ext.suffix
+
 def parse_domain(url):
     """Parses domain name from url string."""
-    ext = tldextract.extract(url)
-    return ext.domain
+    return parse_host(urlparse(url).netloc)[1]
+
+
+class DomainFilter:
+    """Compiled set of banned domain rules.
+
+    Each line of a ban file holds one rule:
+        facebook         domain name under any suffix (facebook.com, .co.uk)
+        espn.com         host and all of its subdomains
+        *.blogspot.com   subdomains only, not the host itself
+    Blank lines and lines starting with # are ignored. Domain names are
+    checked against a hashed set, host rules against a reversed-label trie.
+    """
+    HOST_AND_SUBDOMAINS = "$"
+    SUBDOMAINS = "*"
+
+    def __init__(self, rules=()):
+        self.names = set()
+        self.trie = {}
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        rule = rule.strip().lower()
+        if not rule or rule.startswith("#"):  return
+        marker = self.HOST_AND_SUBDOMAINS
+        if rule.startswith("*."):
+            rule, marker = rule[2:], self.SUBDOMAINS
+        if "." not in rule and marker == self.HOST_AND_SUBDOMAINS:
+            self.names.add(rule)
+            return
+        node = self.trie
+        for label in reversed(rule.split(".")):
+            node = node.setdefault(label, {})
+        node[marker] = True
+
+    def match_host(self, host):
+        """Check whether a host name is banned by a suffix rule."""
+        node = self.trie
+        labels = host.split(".")
+        for idx in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[idx])
+            if node is None:  return False
+            if self.HOST_AND_SUBDOMAINS in node:  return True
+            if self.SUBDOMAINS in node and idx > 0:  return True
+        return False
+
+    def banned(self, url):
+        """Check whether url belongs to a banned site."""
+        host = urlparse(url).netloc.lower().split("@")[-1].split(":")[0]
+        if self.names and parse_host(host)[1] in self.names:
+            return True
+        return bool(self.trie) and self.match_host(host)
+
+    def __len__(self):
+        return len(self.names) + len(self.trie)
+
 
 def rem_banned_domains(results, banned):
     """Removes search results from banned sites."""
-    check = lambda result: parse_domain(result.url).lower() not in banned
-    return filter(check, results)
+    if not banned:  return list(results)
+    if not isinstance(banned, DomainFilter):
+        banned = DomainFilter(banned)
+    return [result for result in results if not banned.banned(result.url)]
 
 def read_banned_domains(banned_file):
-    """Read text file of domains to filter from search results."""
+    """Read text file of domain rules to filter from search results."""
     if os.path.exists(banned_file):
         with open(banned_file, 'r') as f:
-            content = f.readlines()
-            return [domain.strip() for domain in content]
+            return DomainFilter(f.readlines())
     print "SearchEngine: Cannot locate input banned domain file."
-    return []
+    return DomainFilter()
     
 def read_engine_json(json_file, key_str, engine_str):
     """Read value of key_str in json_file."""
@@ -46,60 +134,275 @@ def read_engine_json(json_file, key_str, engine_str):
     return "", ""
 
 
+class TokenBucket:
+    """Thread-safe token bucket, limits callers to rate requests per second."""
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(max(1, capacity))
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
 class SearchEngine:
     """Queries Google API for article results."""
     SINGLE_QUERY_MAX_RES = 10
     MULTI_QUERY_MAX_RES = 100
 
-    def __init__(self, dev_key, engine_id):
+    def __init__(self, dev_key, engine_id, service=None, qps=0, cache=None):
         # Custom search engine defined in Google Dev Console
         self.engine_id = engine_id
-        # Service for Google API Console
-        self.service = build("customsearch", "v1", developerKey=dev_key)
+        self.dev_key = dev_key
+        # Optional stand-in service (ex: FakeService), shared by all threads
+        self.shared_service = service
+        # Discovery clients are not thread-safe, so build one per thread
+        self.local = threading.local()
+        # Optionally stay inside the Custom Search QPS quota
+        self.limiter = TokenBucket(qps) if qps else None
+        # Optional SearchCache of previous responses
+        self.cache = cache
+
+    @property
+    def service(self):
+        """Service for Google API Console."""
+        if self.shared_service is not None:
+            return self.shared_service
+        if not hasattr(self.local, "service"):
+            self.local.service = build_service(self.dev_key)
+        return self.local.service
 
+    @METRICS.timed("oski_search_query_seconds")
     def query(self, search_str, num_results, 
-              exact_terms="", or_terms="", date_restr=""):
-        """Query engine with search string, leaf through multiple pages."""
+              exact_terms="", or_terms="", date_restr="", ttl=None,
+              until_known=None):
+        """Query engine with search string, leaf through multiple pages.
+        Cached responses are reused for up to ttl seconds. Paging stops
+        early once until_known(page_results), ex: a PageTracker, is True.
+        """
         results = []
+        for page in self.query_pages(search_str, num_results, exact_terms,
+                                     or_terms, date_restr, ttl, until_known):
+            results += page
+        return results
+
+    def query_pages(self, search_str, num_results,
+                    exact_terms="", or_terms="", date_restr="", ttl=None,
+                    until_known=None):
+        """Yield the results of query() a page at a time, as each page
+        arrives, so later stages can start on them while paging goes on.
+        """
         page_start = 1
         res_to_go = min(num_results, self.MULTI_QUERY_MAX_RES)
 
         while (res_to_go > 0):
             # Query results from current page
             num_query = min(res_to_go, self.SINGLE_QUERY_MAX_RES)
-            content = self.service.cse().list(q=search_str, 
-                                              cx=self.engine_id,
-                                              num=num_query,
-                                              start=page_start,
-                                              exactTerms=exact_terms,
-                                              orTerms=or_terms,
-                                              dateRestrict=date_restr).execute()
+            content = self.fetch(ttl, q=search_str,
+                                 cx=self.engine_id,
+                                 num=num_query,
+                                 start=page_start,
+                                 exactTerms=exact_terms,
+                                 orTerms=or_terms,
+                                 dateRestrict=date_restr)
             # Check if out of results
             if "items" not in content.keys():  break
             
             # Add results and move to next page
             res_to_go -= len(content["items"])
-            results += content["items"]
+            page = [create_result(res, search_str)
+                    for res in content["items"]]
+            # Check before handing the page on, a consumer storing it
+            # would make its own new results look known
+            known = until_known and until_known(page)
+            yield page
+            if known:  break
             try:
                 page_start = content["queries"]["nextPage"][0]["startIndex"]
             except KeyError:  break
 
-        return [SearchResult(res) for res in results]
+    def fetch(self, ttl=None, **params):
+        """Fetch a single page of results, through the cache if enabled."""
+        request = LimitedRequest(self.service.cse().list(**params),
+                                 self.limiter)
+        if self.cache:
+            return self.cache.fetch(request, params, ttl)
+        return request.execute()
+
+    def query_many(self, queries, max_in_flight=1, merge=True):
+        """Run several queries concurrently.
+
+        Each entry of queries is a tuple of query() arguments. Results are
+        merged in the order of the input queries, regardless of which search
+        finishes first. With merge=False, return one result list per query.
+        """
+        results = [None] * len(queries)
+        errors = [None] * len(queries)
+        jobs = Queue()
+        for idx, args in enumerate(queries):
+            jobs.put((idx, args))
+
+        def worker():
+            while True:
+                idx, args = jobs.get()
+                if idx is None:  return
+                try:
+                    results[idx] = self.query(*args)
+                except Exception as e:
+                    errors[idx] = e
+
+        num_threads = max(1, min(max_in_flight, len(queries)))
+        threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+        for thread in threads:
+            jobs.put((None, None))
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Surface the first failure, as a serial loop would
+        for error in errors:
+            if error is not None:  raise error
+        if not merge:  return results
+        merged = []
+        for result in results:
+            merged += result
+        return merged
 
     def __repr__(self):
         return self.engine_id
 
 
-class SearchResult:
-    """Extracts and stores relevant content from search result."""
-    def __init__(self, api_result):
-        self.title = to_ascii(api_result["title"])
-        self.url = to_ascii(api_result["link"])
-        self.snippet = to_ascii(api_result["snippet"])
+def build_service(dev_key):
+    """Build a Custom Search client from the bundled discovery document,
+    falling back to fetching it if the bundle is missing.
+    """
+    from googleapiclient.discovery import build, build_from_document
+    if not os.path.exists(DISCOVERY_DOC):
+        return build("customsearch", "v1", developerKey=dev_key)
+    with open(DISCOVERY_DOC, 'r') as f:
+        return build_from_document(f.read(), developerKey=dev_key)
+
+
+class PageTracker:
+    """Stops paging once a page holds only known results.
+
+    Remembers which page that was, so crawl state can record where the
+    results of a query became all-known.
+    """
+    def __init__(self, is_known):
+        self.is_known = is_known
+        self.pages = 0
+        self.known_page = None
+
+    def __call__(self, results):
+        self.pages += 1
+        if results and self.is_known(results):
+            self.known_page = self.pages
+            return True
+        return False
+
+
+class LimitedRequest:
+    """Wraps an API request, waiting on the rate limiter before executing."""
+    def __init__(self, request, limiter=None):
+        self.request = request
+        self.limiter = limiter
+
+    def execute(self):
+        if self.limiter:
+            with METRICS.timer("oski_search_wait_seconds"):
+                self.limiter.acquire()
+        try:
+            with METRICS.timer("oski_search_api_seconds"):
+                return self.request.execute()
+        except Exception:
+            METRICS.inc("oski_search_api_errors_total")
+            raise
+
+
+class FakeService:
+    """Offline stand-in for the customsearch discovery service.
+
+    Serves canned API items, either a single list for every query or a dict
+    keyed by search string, paged like the Custom Search API.
+    """
+    def __init__(self, items, latency=0.0):
+        self.items = items
+        self.latency = latency
+        self.calls = []
+
+    def cse(self):
+        return self
+
+    def list(self, **params):
+        self.calls.append(params)
+        return FakeRequest(self, params)
+
+    def page(self, params):
+        """Build API-formatted content for a single request."""
+        time.sleep(self.latency)
+        items = self.items
+        if isinstance(items, dict):
+            items = items.get(params["q"], [])
+        first = params["start"] - 1
+        last = first + params["num"]
+        content = {"queries": {}}
+        if items[first:last]:
+            content["items"] = items[first:last]
+        if last < len(items):
+            content["queries"]["nextPage"] = [{"startIndex": last + 1}]
+        return content
+
+
+class FakeRequest:
+    """Request returned by FakeService.list."""
+    def __init__(self, service, params):
+        self.service = service
+        self.params = params
+
+    def execute(self):
+        return self.service.page(self.params)
+
+
+def published_date(api_result):
+    """ISO date a search result was published, None if unknown."""
+    for tags in api_result.get("pagemap", {}).get("metatags", [])[:1]:
+        for name in PUBLISHED_TAGS:
+            if tags.get(name):
+                return intern(to_ascii(tags[name])[:10])
+    match = SNIPPET_DATE_RE.match(api_result.get("snippet", ""))
+    if match and match.group(1) in MONTHS:
+        return intern("%04d-%02d-%02d" % (int(match.group(3)),
+                                          MONTHS[match.group(1)],
+                                          int(match.group(2))))
+    return None
+
+def create_result(api_result, query_id=None):
+    """Create an Article straight from a Custom Search result item.
+    Dates and hosts repeat across results, so they are interned.
+    """
+    source = api_result.get("displayLink")
+    return Article(to_ascii(api_result["title"]),
+                   to_ascii(api_result["link"]),
+                   to_ascii(api_result["snippet"]),
+                   published_date(api_result),
+                   intern(to_ascii(source).lower()) if source else None,
+                   query_id)
 
-    def __repr__(self):
-        return self.title
-    
 
 def main(args):
     """Run input query in search engine."""
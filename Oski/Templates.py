@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Loads, compiles and renders email templates."""
+
+import argparse
+import os
+import threading
+from cgi import escape
+from string import Formatter
+
+
+class Template:
+    """Template in str.format syntax, compiled once into literal and field
+    pieces so rendering is a single join. Field values are HTML-escaped.
+    """
+    def __init__(self, text):
+        self.text = text.replace("\n", "")
+        self.pieces = []
+        auto_idx = 0
+        for literal, field, spec, conv in Formatter().parse(self.text):
+            if literal:
+                self.pieces.append((literal, None))
+            if field is None:  continue
+            if field == "":
+                field, auto_idx = auto_idx, auto_idx + 1
+            else:
+                field = int(field)
+            self.pieces.append((None, field))
+
+    def render_into(self, parts, *fields):
+        """Append rendered pieces to parts, a list joined by the caller."""
+        for literal, field in self.pieces:
+            if field is None:
+                parts.append(literal)
+            else:
+                parts.append(escape(str(fields[field]), quote=True))
+        return parts
+
+    def render(self, *fields):
+        return "".join(self.render_into([], *fields))
+
+
+class TemplateCache:
+    """Caches compiled templates by path, recompiling when a file's
+    modification time changes.
+    """
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            cached = self.templates.get(path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        with open(path, 'r') as f:
+            template = Template(f.read())
+        with self.lock:
+            self.templates[path] = (mtime, template)
+        return template
+
+
+# Shared by every render in this process
+TEMPLATES = TemplateCache()
+
+def render_digest(articles, header_html, article_html, cache=TEMPLATES):
+    """Render the article digest table, linear in the number of articles."""
+    header = cache.get(header_html)
+    article_template = cache.get(article_html)
+    parts = ['<table style="width: 600px">']
+    header.render_into(parts)
+    for article in articles:
+        article_template.render_into(parts, article.url, article.title,
+                                     article.snippet)
+    parts.append("</table>")
+    return "".join(parts)
+
+
+def main(args):
+    template = TEMPLATES.get(args.template)
+    print template.render(*args.fields)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--template", type=str, required=True,
+        help="specify template file")
+    parser.add_argument("fields", type=str, nargs="*",
+        help="specify values of template fields")
+    args = parser.parse_args()
+
+    main(args)
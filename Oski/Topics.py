@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Runs Oski for several topics, each with its own database shard."""
+
+import argparse
+import heapq
+import os
+import threading
+from Queue import Queue
+from ArticleDB import ArticleDB
+from Metrics import METRICS
+from Oski import Oski, get_value, load_json, topic_params
+
+
+def shard_files(params):
+    """Return [(topic name, database shard)] in parameter file order."""
+    return [(topic["name"], topic_params(params, topic["name"])["db_file"])
+            for topic in get_value(params, "topics", [])]
+
+
+class ShardReader:
+    """Read-only view across every topic's database shard.
+
+    Shards that do not exist yet are skipped. Each call reads the shards
+    one after another, so a slow shard never holds another's write lock.
+    """
+    def __init__(self, shards):
+        self.dbs = [(name, ArticleDB(db_file)) for name, db_file in shards
+                    if os.path.exists(db_file)]
+
+    def topics(self):
+        return [name for name, _ in self.dbs]
+
+    def get_article(self, title, topic=None):
+        """Return (topic, article) of the first shard holding title."""
+        for name, db in self.dbs:
+            if topic not in (None, name):  continue
+            article = db.get_article(title)
+            if article is not None:
+                return name, article
+        return None
+
+    def iter_articles(self, topic=None):
+        """Yield (topic, article) from each shard in turn."""
+        for name, db in self.dbs:
+            if topic not in (None, name):  continue
+            for article in db.iter_articles():
+                yield name, article
+
+    def search(self, text, limit=20, raw=False):
+        """Return the best (topic, article, score) matches over all shards.
+        bm25 scores of different shards are only roughly comparable.
+        """
+        matches = []
+        for name, db in self.dbs:
+            matches += [(name, article, score)
+                        for article, score in db.search(text, limit, raw)]
+        return heapq.nlargest(limit, matches, key=lambda match: match[2])
+
+    def counts(self):
+        """Return {topic: number of articles}."""
+        return dict((name, db.count_articles()) for name, db in self.dbs)
+
+
+class TopicRunner:
+    """One Oski per topic, all sharing a search engine so they stay inside
+    a single API quota. Topics run concurrently, each through its own
+    pipeline and database shard, so they never wait on each other's
+    database locks.
+    """
+    def __init__(self, oski_json, keys, notif_json=""):
+        self.oski_json = oski_json
+        self.keys = keys
+        self.notif_json = notif_json
+        [_, params] = load_json(oski_json)
+        self.workers = get_value(params, "topic_workers",
+                                 len(params["topics"]))
+        self.oskis = []
+        searcher = None
+        for topic in params["topics"]:
+            oski = Oski(oski_json, keys, notif_json, topic["name"], searcher)
+            searcher = oski.searcher
+            self.oskis.append(oski)
+
+    def each(self, func):
+        """Call func(oski) for every topic on up to workers threads.
+        Return {topic: result}. A failing topic does not stop the others.
+        """
+        results = {}
+        jobs = Queue()
+        for oski in self.oskis:
+            jobs.put(oski)
+
+        def worker():
+            while True:
+                oski = jobs.get()
+                if oski is None:  return
+                try:
+                    results[oski.topic] = func(oski)
+                except Exception as e:
+                    print 'Oski: Topic "%s" FAILED: %s' % (oski.topic, e)
+
+        num_threads = max(1, min(self.workers, len(self.oskis)))
+        threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+        for thread in threads:
+            jobs.put(None)
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def run(self):
+        self.each(lambda oski: oski.run())
+
+    def drain(self):
+        """Work through every topic's archive jobs. Return jobs tried."""
+        return sum(self.each(lambda oski: oski.drain()).values())
+
+    def verify(self):
+        """Verify each topic's archive in turn, each one using every cpu.
+        Return {topic: {status: number of pdfs}}.
+        """
+        return dict((oski.topic, oski.verify()) for oski in self.oskis)
+
+    def serve(self):
+        """Serve every topic on its queries' schedules until interrupted."""
+        from Scheduler import OskiServer
+        searcher = self.oskis[0].searcher
+        servers = [OskiServer(self.oski_json, self.keys, self.notif_json,
+                              topic=oski.topic, searcher=searcher)
+                   for oski in self.oskis]
+        threads = [threading.Thread(target=server.serve)
+                   for server in servers]
+        for thread in threads:
+            thread.start()
+        try:
+            # Join with a timeout, so KeyboardInterrupt still arrives
+            while any(thread.is_alive() for thread in threads):
+                threads[0].join(1)
+                threads.append(threads.pop(0))
+        except KeyboardInterrupt:
+            print "Oski: Stopping %d topics" % len(servers)
+            for server in servers:
+                server.stopping.set()
+            for thread in threads:
+                thread.join()
+        METRICS.export()
+
+    def reader(self):
+        return ShardReader([(oski.topic, oski.db.db_name)
+                            for oski in self.oskis])
+
+
+def main(args):
+    [success, params] = load_json(args.oskifile)
+    if not success:  return
+    reader = ShardReader(shard_files(params))
+    if args.command == "counts":
+        for topic, count in sorted(reader.counts().items()):
+            print "%-20s %d" % (topic, count)
+    elif args.command == "search":
+        for topic, article, score in reader.search(args.text, args.limit,
+                                                   args.raw):
+            print "%7.2f  [%s] %s\n         %s" % (score, topic, article.title,
+                                                article.url)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-op", "--oskifile", type=str, required=True,
+        help="specify parameter file listing the topics")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("counts", help="count articles in each topic")
+    search = commands.add_parser("search", help="full-text search all topics")
+    search.add_argument("text", type=str,
+        help="specify words to search for")
+    search.add_argument("-n", "--limit", type=int, default=20,
+        help="specify max number of results")
+    search.add_argument("--raw", action="store_true",
+        help="flag to pass text as FTS5 query syntax")
+    args = parser.parse_args()
+
+    main(args)
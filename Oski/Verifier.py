@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""Verifies archived pdfs and indexes their text for full-text search."""
+
+import argparse
+import gzip
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import tempfile
+import zlib
+from ArchiveQueue import ArchiveQueue
+from ArchiveStore import ArchiveStore, file_digest
+from Archiver import extract_pdf_text
+from ArticleDB import ArticleDB
+from Metrics import METRICS
+
+
+PDF_HEADER = "%PDF-"
+PDF_EOF = "%%EOF"
+# Bytes read from the end of a pdf to find its trailer
+TAIL_SIZE = 4096
+XREF_OBJ_RE = re.compile(r"\s*\d+\s+\d+\s+obj\b")
+
+
+def check_pdf(pdf_file):
+    """Check the structure every complete pdf has: a header, and a trailer
+    whose startxref points at the cross-reference table. Return what is
+    wrong, "" if nothing.
+    """
+    size = os.path.getsize(pdf_file)
+    with open(pdf_file, 'rb') as f:
+        if PDF_HEADER not in f.read(1024):
+            return "no %PDF header"
+        f.seek(max(0, size - TAIL_SIZE))
+        tail = f.read()
+        end = tail.rfind(PDF_EOF)
+        if end < 0:
+            return "no %%EOF marker, truncated"
+        start = tail.rfind("startxref", 0, end)
+        if start < 0:
+            return "no startxref"
+        try:
+            offset = int(tail[start + len("startxref"):end].split()[0])
+        except (ValueError, IndexError):
+            return "bad startxref"
+        if not 0 < offset < size:
+            return "startxref out of range"
+        f.seek(offset)
+        xref = f.read(64)
+    # Classic xref table, or an xref stream object in pdf 1.5+
+    if not (xref.lstrip().startswith("xref") or XREF_OBJ_RE.match(xref)):
+        return "startxref points at no xref"
+    return ""
+
+def _decompress(path, tmp_dir):
+    handle, plain = tempfile.mkstemp(suffix=ArchiveStore.EXT, dir=tmp_dir)
+    try:
+        with os.fdopen(handle, 'wb') as f_out:
+            with gzip.open(path, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f_out)
+    except:
+        os.remove(plain)
+        raise
+    return plain
+
+def _verify_blob(job):
+    """Verify a single blob in a pool worker. Return the check's fields."""
+    digest, path, tmp_dir, extract_text = job
+    result = {"digest": digest, "path": path, "mtime": None, "size": None,
+              "sha256": None, "text": ""}
+    try:
+        stat = os.stat(path)
+        result["mtime"], result["size"] = stat.st_mtime, stat.st_size
+        plain = path
+        if path.endswith(ArchiveStore.GZ_EXT):
+            plain = _decompress(path, tmp_dir)
+        try:
+            result["sha256"] = file_digest(plain)[0]
+            error = check_pdf(plain)
+            if not error and result["sha256"] != digest:
+                error = "content does not match digest"
+            if not error and extract_text:
+                result["text"] = extract_pdf_text(plain)
+        finally:
+            if plain != path:
+                os.remove(plain)
+    # Truncated or corrupt gzip raises EOFError or struct.error
+    except (IOError, OSError, EOFError, struct.error, zlib.error) as e:
+        error = repr(e)
+    result["error"] = error
+    result["status"] = ArchiveVerifier.BROKEN if error else ArchiveVerifier.OK
+    return result
+
+
+class ArchiveVerifier:
+    """Checks every archived pdf over a process pool.
+
+    Valid pdfs have their text extracted into the database. Broken or
+    missing ones, ex: left truncated by a timed-out render, are moved to
+    the store's broken/ directory and their articles queued to be
+    archived again. The path, mtime, size and hash of each verified file
+    are recorded, so later runs skip files that did not change.
+    """
+    KIND = "pdf"
+    OK = "ok"
+    BROKEN = "broken"
+    MISSING = "missing"
+    SKIPPED = "skipped"
+    # Verified blobs recorded per transaction
+    BATCH_SIZE = 100
+
+    def __init__(self, db, store, queue, workers=None, extract_text=True):
+        self.db = db
+        self.store = store
+        self.queue = queue
+        self.workers = workers or multiprocessing.cpu_count()
+        self.extract_text = extract_text
+
+    def jobs(self, titles, counts):
+        """Return pool jobs of the blobs changed since their last check.
+        Missing blobs are returned as broken results.
+        """
+        jobs, missing = [], []
+        checks = self.db.blob_checks(self.KIND)
+        for digest in sorted(titles):
+            path = self.store.find(digest, self.KIND)
+            if path is None:
+                missing.append({"digest": digest, "status": self.MISSING,
+                                "error": "blob missing"})
+                continue
+            stat = os.stat(path)
+            if checks.get(digest) == (path, stat.st_mtime, stat.st_size):
+                counts[self.SKIPPED] += 1
+                continue
+            jobs.append((digest, path, self.store.tmp_dir, self.extract_text))
+        return jobs, missing
+
+    def run(self):
+        """Verify the archive. Return {status: number of blobs}."""
+        titles = self.db.blob_titles(self.KIND)
+        counts = dict((status, 0) for status in
+                      [self.OK, self.BROKEN, self.MISSING, self.SKIPPED])
+        jobs, broken = self.jobs(titles, counts)
+        counts[self.MISSING] = len(broken)
+        print "Verifier: Checking %d of %d pdfs on %d workers" % \
+              (len(jobs), len(titles), self.workers)
+
+        checks, texts = [], []
+        if jobs:
+            pool = multiprocessing.Pool(min(self.workers, len(jobs)))
+            try:
+                for result in pool.imap_unordered(_verify_blob, jobs, 4):
+                    counts[result["status"]] += 1
+                    if result["status"] != self.OK:
+                        broken.append(result)
+                        continue
+                    checks.append(tuple(result[key] for key in
+                        ["digest", "path", "mtime", "size", "sha256",
+                         "status", "error"]))
+                    if result["text"]:
+                        texts += [(title, result["text"])
+                                  for title in titles[result["digest"]]]
+                    if len(checks) >= self.BATCH_SIZE:
+                        self.record(checks, texts)
+                        checks, texts = [], []
+            finally:
+                pool.close()
+                pool.join()
+        self.record(checks, texts)
+
+        for result in broken:
+            self.requeue(result["digest"], titles[result["digest"]],
+                         result["error"])
+        for status, count in counts.items():
+            METRICS.inc("oski_verify_total", count, status=status)
+        return counts
+
+    def record(self, checks, texts):
+        if checks:
+            self.db.set_blob_checks(checks, self.KIND)
+        if texts:
+            self.db.set_texts(texts)
+
+    def requeue(self, digest, titles, error):
+        """Set a broken blob aside and queue its articles again."""
+        print "Verifier: BROKEN pdf %s (%s), re-queued %d articles" % \
+              (digest[:12], error, len(titles))
+        self.store.quarantine(digest, self.KIND)
+        self.db.drop_blob(digest, self.KIND)
+        self.queue.requeue(titles, self.KIND)
+
+
+def main(args):
+    db = ArticleDB(args.dbfile)
+    verifier = ArchiveVerifier(db, ArchiveStore(args.path), ArchiveQueue(db),
+                               args.workers, not args.no_text)
+    counts = verifier.run()
+    print "Verifier: %s" % ", ".join("%d %s" % (counts[status], status)
+                                     for status in sorted(counts.keys()))
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--path", type=str, required=True,
+        help="specify archive directory")
+    parser.add_argument("-db", "--dbfile", type=str, default=ArticleDB.DB_NAME,
+        help="specify database file")
+    parser.add_argument("-w", "--workers", type=int,
+        help="specify number of worker processes, one per cpu by default")
+    parser.add_argument("--no-text", action="store_true",
+        help="flag to skip extracting text")
+    args = parser.parse_args()
+
+    main(args)
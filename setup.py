@@ -19,6 +19,7 @@ setup(
         'jsonschema',
         'functools32',
         'tldextract',
-        'google-api-python-client'
+        'google-api-python-client',
+        'requests'
     ]
 )
\ No newline at end of file